@@ -0,0 +1,93 @@
+# ------------------------------------------------------------------------
+# PROB: Probabilistic Objectness for Open World Object Detection
+# Orr Zohar, Jackson Wang, Serena Yeung
+# ------------------------------------------------------------------------
+
+"""
+Measures the inference throughput (images/sec) of the detector and its PostProcess on synthetic images
+going through the default test transform (800px shorter side, at most 1333px).
+Takes the model arguments of main_open_world.py, e.g. --device cpu --cpu_threads 8 --pretrain exps/MOWODB/PROB/t1.pth
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+import util.misc as utils
+from datasets.coco import make_coco_transforms
+from main_open_world import attach_early_exit, get_args_parser as get_main_args_parser
+from models import build_model
+from models.ops.functions import ms_deform_attn_extension_available
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('PROB inference benchmark', add_help=False)
+    parser.add_argument('--bench_iters', default=20, type=int, help='timed batches')
+    parser.add_argument('--bench_warmup', default=3, type=int, help='untimed batches run first')
+    parser.add_argument('--bench_batch_size', default=1, type=int)
+    parser.add_argument('--bench_image_size', default=[500, 375], type=int, nargs=2,
+                        help='width and height of the synthetic images before the test transform')
+    parser.add_argument('--bench_all_layer_heads', action='store_true',
+                        help='run the heads on every decoder layer as in training, to measure the last-layer-only inference')
+    return parser
+
+
+def main(args):
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+
+    model, _, postprocessors, _ = build_model(args, mode=args.model_type)
+    checkpoint_path = args.resume or args.pretrain
+    if checkpoint_path:
+        checkpoint = torch.load(checkpoint_path, map_location='cpu')
+        print(model.load_state_dict(checkpoint['model'], strict=False))
+    model.to(device)
+    model.eval()
+    model.last_layer_inference = not args.bench_all_layer_heads
+    attach_early_exit(args, model, postprocessors)
+    if device.type == 'cpu':
+        num_threads = utils.setup_cpu_inference(args.cpu_threads)
+        model.backbone[0].use_channels_last()
+        if args.quantize_int8:
+            model = utils.quantize_dynamic_int8(model, args.quant_keep_float)
+    else:
+        num_threads = torch.get_num_threads()
+
+    transform = make_coco_transforms('test')[-1]
+    width, height = args.bench_image_size
+    images = [transform(Image.fromarray(np.random.randint(0, 256, (height, width, 3), dtype=np.uint8)), None)[0]
+              for _ in range(args.bench_batch_size)]
+    samples = utils.nested_tensor_from_tensor_list(images).to(device)
+    orig_target_sizes = torch.tensor([[height, width]] * args.bench_batch_size, device=device)
+
+    use_extension = ms_deform_attn_extension_available(samples.tensors)
+    print('device: {}, threads: {}, MSDeformAttn: {}, channels_last backbone: {}, int8: {}, heads: {}, input: {}'.format(
+        device, num_threads, 'CUDA extension' if use_extension else 'pytorch', model.backbone[0].channels_last,
+        device.type == 'cpu' and args.quantize_int8, 'all layers' if args.bench_all_layer_heads else 'last layer',
+        tuple(samples.tensors.shape)))
+
+    with torch.no_grad():
+        for i in range(args.bench_warmup + args.bench_iters):
+            if i == args.bench_warmup:
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                start_time = time.time()
+            outputs = model(samples)
+            postprocessors['bbox'](outputs, orig_target_sizes)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    total_time = time.time() - start_time
+
+    num_images = args.bench_iters * args.bench_batch_size
+    print('{} images in {:.2f}s: {:.2f} images/sec, {:.1f} ms/image'.format(
+        num_images, total_time, num_images / total_time, 1000 * total_time / num_images))
+    if model.shape_cache is not None:
+        print('shape cache: {}'.format(model.shape_cache))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('PROB inference benchmark', parents=[get_main_args_parser(), get_args_parser()])
+    args = parser.parse_args()
+    main(args)
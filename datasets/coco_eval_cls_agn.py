@@ -15,14 +15,17 @@ in the end of the file, as python3 can suppress prints with contextlib
 """
 import contextlib
 import copy
+import datetime
 import os
+from collections import OrderedDict
 
 import numpy as np
 import pycocotools.mask as mask_util
 import torch
 from pycocotools.coco import COCO
 
-from util.misc import all_gather
+from util.misc import all_gather, all_gather_columns, get_rank
+from .open_world_eval import ColumnStore
 from .os_cocoeval import ClsAgnCOCOEval
 
 COCO_CATEGORIES = [
@@ -168,6 +171,15 @@ COCO_INVOC_CATEGORIES = [
 ]
 coco_name_id_dic = {cats["name"]:cats["id"] for cats in COCO_CATEGORIES}
 COCO_INVOC_IDS = [coco_name_id_dic[name_cat] for name_cat in COCO_INVOC_CATEGORIES]
+# contiguous label of the detector -> COCO category id
+COCO_ID_MAP = {0: 1, 1: 2, 2: 3, 3: 4, 4: 5, 5: 6, 6: 7, 7: 8, 8: 9, 9: 10, 
+    10: 11, 11: 13, 12: 14, 13: 15, 14: 16, 15: 17, 16: 18, 17: 19, 18: 20, 19: 21, 
+    20: 22, 21: 23, 22: 24, 23: 25, 24: 27, 25: 28, 26: 31, 27: 32, 28: 33, 29: 34, 
+    30: 35, 31: 36, 32: 37, 33: 38, 34: 39, 35: 40, 36: 41, 37: 42, 38: 43, 39: 44, 
+    40: 46, 41: 47, 42: 48, 43: 49, 44: 50, 45: 51, 46: 52, 47: 53, 48: 54, 49: 55, 
+    50: 56, 51: 57, 52: 58, 53: 59, 54: 60, 55: 61, 56: 62, 57: 63, 58: 64, 59: 65, 
+    60: 67, 61: 70, 62: 72, 63: 73, 64: 74, 65: 75, 66: 76, 67: 77, 68: 78, 69: 79, 
+    70: 80, 71: 81, 72: 82, 73: 84, 74: 85, 75: 86, 76: 87, 77: 88, 78: 89, 79: 90}
 
 GRASPNET_COCO_CATEGORIES = [
     {"color": [220, 20, 60], "id": 1, "name": "cracker_box"},
@@ -275,14 +287,7 @@ class CocoEvaluatorClsAgn(object):
         assert isinstance(iou_types, (list, tuple))
         if dataset == 'coco':
             known_ids = COCO_INVOC_IDS
-            self.id_map = {0: 1, 1: 2, 2: 3, 3: 4, 4: 5, 5: 6, 6: 7, 7: 8, 8: 9, 9: 10, 
-                10: 11, 11: 13, 12: 14, 13: 15, 14: 16, 15: 17, 16: 18, 17: 19, 18: 20, 19: 21, 
-                20: 22, 21: 23, 22: 24, 23: 25, 24: 27, 25: 28, 26: 31, 27: 32, 28: 33, 29: 34, 
-                30: 35, 31: 36, 32: 37, 33: 38, 34: 39, 35: 40, 36: 41, 37: 42, 38: 43, 39: 44, 
-                40: 46, 41: 47, 42: 48, 43: 49, 44: 50, 45: 51, 46: 52, 47: 53, 48: 54, 49: 55, 
-                50: 56, 51: 57, 52: 58, 53: 59, 54: 60, 55: 61, 56: 62, 57: 63, 58: 64, 59: 65, 
-                60: 67, 61: 70, 62: 72, 63: 73, 64: 74, 65: 75, 66: 76, 67: 77, 68: 78, 69: 79, 
-                70: 80, 71: 81, 72: 82, 73: 84, 74: 85, 75: 86, 76: 87, 77: 88, 78: 89, 79: 90}
+            self.id_map = COCO_ID_MAP
         elif dataset == 'graspnet':
             known_ids = GRASPNET_KNOWN_IDS
         
@@ -460,6 +465,89 @@ class CocoEvaluatorClsAgn(object):
         return coco_results
 
 
+class VectorizedCocoEvaluatorClsAgn(object):
+    """
+    Drop-in replacement of CocoEvaluatorClsAgn for boxes. Predictions are kept in flat arrays and the known and
+    unknown class-agnostic evaluations are computed at once in accumulate(): IoUs per image, greedy matching of
+    blocks of images for all IoU thresholds and area ranges together, and one score sort shared by every
+    area range and maxDets. Results are the same as pycocotools.
+    """
+    def __init__(self, coco_gt, iou_types, dataset='coco'):
+        assert isinstance(iou_types, (list, tuple))
+        if any(iou_type != 'bbox' for iou_type in iou_types):
+            raise ValueError("VectorizedCocoEvaluatorClsAgn only supports bbox, got {}".format(iou_types))
+        if dataset == 'coco':
+            known_ids = COCO_INVOC_IDS
+            self.id_map = COCO_ID_MAP
+        elif dataset == 'graspnet':
+            known_ids = GRASPNET_KNOWN_IDS
+            self.id_map = None
+
+        self.iou_types = iou_types
+        self.coco_eval_k = {}
+        self.coco_eval_unk = {}
+        for iou_type in iou_types:
+            for coco_eval in (self.coco_eval_k, self.coco_eval_unk):
+                coco_eval[iou_type] = ClsAgnCOCOEval(coco_gt, iouType=iou_type)
+                coco_eval[iou_type].params.useCats = False
+                coco_eval[iou_type].params.maxDets = [10,20,30,50,100,200,300,500,1000]
+        self.gt = ClsAgnGT(coco_gt, self.coco_eval_k['bbox'].params.catIds, known_ids)
+
+        self.img_ids = []
+        self._seen_img_ids = set()
+        self.predictions = ColumnStore(CLS_AGN_PREDICTION_COLUMNS)
+        self.useCats = False
+
+    def update(self, predictions):
+        for original_id, prediction in predictions.items():
+            # as in CocoEvaluatorClsAgn, an image evaluated twice keeps its first results
+            if original_id in self._seen_img_ids:
+                continue
+            self._seen_img_ids.add(original_id)
+            self.img_ids.append(original_id)
+            labels = prediction["labels"].cpu().numpy()
+            if self.id_map is not None:
+                labels = np.array([self.id_map[label] for label in labels.tolist()], dtype=np.int64)
+            self.predictions.append(image=original_id, cls=labels, score=prediction["scores"].cpu().numpy(),
+                                    box=convert_to_xywh(prediction["boxes"]).cpu().numpy())
+
+    def synchronize_between_processes(self):
+        rank = get_rank()
+        img_ids = all_gather_columns(OrderedDict(
+            image=torch.as_tensor(self.img_ids, dtype=torch.int64),
+            rank=torch.full((len(self.img_ids),), rank, dtype=torch.int64)))
+        columns = OrderedDict((k, torch.from_numpy(v)) for k, v in self.predictions.columns().items())
+        columns['rank'] = torch.full((len(self.predictions),), rank, dtype=torch.int64)
+        columns = OrderedDict((k, v.numpy()) for k, v in all_gather_columns(columns).items())
+
+        # keep only unique images, with the predictions of the first rank that evaluated them
+        self.img_ids, first = np.unique(img_ids['image'].numpy(), return_index=True)
+        first_rank = img_ids['rank'].numpy()[first]
+        keep = columns.pop('rank') == first_rank[np.searchsorted(self.img_ids, columns['image'])]
+        self.predictions = ColumnStore.from_columns(
+            OrderedDict((k, v[keep]) for k, v in columns.items()), CLS_AGN_PREDICTION_COLUMNS)
+        self.img_ids = list(self.img_ids)
+
+    def accumulate(self):
+        img_ids = np.unique(np.asarray(self.img_ids, dtype=np.int64))
+        p = self.coco_eval_k['bbox'].params
+        dets = cls_agn_detections(self.predictions, img_ids, p.catIds, p.maxDets[-1])
+        for coco_eval, unknown in ((self.coco_eval_k['bbox'], False), (self.coco_eval_unk['bbox'], True)):
+            coco_eval.params.imgIds = list(img_ids)
+            gts = self.gt.view(img_ids, unknown)
+            dt_matched, dt_ignore, gt_ignore = cls_agn_match(dets, gts, coco_eval.params)
+            coco_eval.eval = cls_agn_accumulate(dets, dt_matched, dt_ignore, gt_ignore, coco_eval.params)
+            coco_eval._paramsEval = copy.deepcopy(coco_eval.params)
+
+    def summarize(self):
+        for iou_type, coco_eval_k in self.coco_eval_k.items():
+            print("KNOWN IoU metric: {}".format(iou_type))
+            coco_eval_k.summarize()
+        for iou_type, coco_eval_unk in self.coco_eval_unk.items():
+            print("UNKNOWN IoU metric: {}".format(iou_type))
+            coco_eval_unk.summarize()
+
+
 def convert_to_xywh(boxes):
     xmin, ymin, xmax, ymax = boxes.unbind(1)
     return torch.stack((xmin, ymin, xmax - xmin, ymax - ymin), dim=1)
@@ -497,6 +585,193 @@ def create_common_coco_eval(coco_eval, img_ids, eval_imgs):
     coco_eval._paramsEval = copy.deepcopy(coco_eval.params)
 
 
+CLS_AGN_PREDICTION_COLUMNS = OrderedDict(image=(np.int64, ()), cls=(np.int64, ()), score=(np.float32, ()),
+                                         box=(np.float32, (4,)))
+
+
+class ClsAgnGT(object):
+    """
+    Ground-truth boxes of a COCO api, sorted by image and, within an image, in the order pycocotools evaluates
+    them without categories: by category id, then annotation order.
+    """
+    def __init__(self, coco_gt, cat_ids, known_ids):
+        anns = [ann for ann in coco_gt.dataset['annotations'] if ann['category_id'] in set(cat_ids)]
+        image = np.array([ann['image_id'] for ann in anns], dtype=np.int64)
+        cat_rank = np.searchsorted(np.asarray(cat_ids), [ann['category_id'] for ann in anns])
+        order = np.lexsort((np.arange(len(anns)), cat_rank, image))
+        anns = [anns[i] for i in order]
+        self.image = image[order]
+        self.box = np.array([ann['bbox'] for ann in anns], dtype=np.float64).reshape(-1, 4)
+        self.area = np.array([ann['area'] for ann in anns], dtype=np.float64)
+        self.crowd = np.array([bool(ann.get('iscrowd', 0)) for ann in anns], dtype=bool)
+        ignore = np.array([bool(ann.get('ignore', 0)) for ann in anns], dtype=bool)
+        known = np.isin([ann['category_id'] for ann in anns], known_ids)
+        # the known evaluation ignores unknown objects and the other way around, crowds are always ignored
+        self.ignore_k = ignore | ~known | self.crowd
+        self.ignore_unk = ignore | known | self.crowd
+
+    def view(self, img_ids, unknown=False):
+        """Ground truth of the given sorted image ids, with per-image offsets."""
+        start = np.searchsorted(self.image, img_ids, side='left')
+        stop = np.searchsorted(self.image, img_ids, side='right')
+        counts = stop - start
+        index = np.repeat(start - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        return dict(box=self.box[index], area=self.area[index], crowd=self.crowd[index],
+                    ignore=(self.ignore_unk if unknown else self.ignore_k)[index],
+                    offsets=np.concatenate([[0], np.cumsum(counts)]))
+
+
+def cls_agn_detections(predictions, img_ids, cat_ids, max_det):
+    """
+    Detections of the given sorted image ids as pycocotools evaluates them without categories: grouped by image,
+    sorted by decreasing score (ties by category id, then prediction order) and cut to max_det per image.
+    """
+    image, cls, score, box = (predictions[k] for k in ('image', 'cls', 'score', 'box'))
+    keep = np.isin(cls, cat_ids) & np.isin(image, img_ids)
+    image_pos = np.searchsorted(img_ids, image[keep])
+    score = score[keep].astype(np.float64)
+    order = np.lexsort((np.arange(len(score)), np.searchsorted(np.asarray(cat_ids), cls[keep]), -score, image_pos))
+    image_pos = image_pos[order]
+    counts = np.bincount(image_pos, minlength=len(img_ids))
+    rank = np.arange(len(order)) - np.repeat(np.cumsum(counts) - counts, counts)
+    keep_rank = rank < max_det
+    order, image_pos, rank = order[keep_rank], image_pos[keep_rank], rank[keep_rank]
+    box = box[keep][order].astype(np.float64)
+    return dict(box=box, score=score[order], area=box[:, 2] * box[:, 3], image_pos=image_pos, rank=rank,
+                offsets=np.concatenate([[0], np.cumsum(np.bincount(image_pos, minlength=len(img_ids)))]))
+
+
+def cls_agn_iou(dets, gts, crowd):
+    """IoU of paired [x, y, w, h] boxes, with the same operations as pycocotools' bbIou."""
+    w = np.minimum(dets[:, 2] + dets[:, 0], gts[:, 2] + gts[:, 0]) - np.maximum(dets[:, 0], gts[:, 0])
+    h = np.minimum(dets[:, 3] + dets[:, 1], gts[:, 3] + gts[:, 1]) - np.maximum(dets[:, 1], gts[:, 1])
+    inter = w * h
+    det_area = dets[:, 2] * dets[:, 3]
+    union = np.where(crowd, det_area, det_area + gts[:, 2] * gts[:, 3] - inter)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where((w > 0) & (h > 0), inter / union, 0.)
+
+
+def cls_agn_match(dets, gts, p, block_size=256):
+    """
+    Greedy matching of COCOeval.evaluateImg for every area range and IoU threshold at once.
+    Returns the [A x T x D] matched and ignored flags of the detections and the [A x G] ignore flags of the gts.
+    """
+    num_images = len(dets['offsets']) - 1
+    num_dets, num_gts = np.diff(dets['offsets']), np.diff(gts['offsets'])
+    area_rng = np.asarray(p.areaRng, dtype=np.float64)
+    thresholds = np.array([min([t, 1 - 1e-10]) for t in p.iouThrs])
+    A, T = len(area_rng), len(thresholds)
+    gt_ignore = gts['ignore'][None] | (gts['area'][None] < area_rng[:, :1]) | (gts['area'][None] > area_rng[:, 1:])
+
+    # IoUs of every (det, gt) pair of the same image
+    pairs = num_dets * num_gts
+    pair_start = np.cumsum(pairs) - pairs
+    pair_image = np.repeat(np.arange(num_images), pairs)
+    pair_index = np.arange(pairs.sum()) - np.repeat(pair_start, pairs)
+    pair_det = dets['offsets'][pair_image] + pair_index // num_gts[pair_image]
+    pair_gt = gts['offsets'][pair_image] + pair_index % num_gts[pair_image]
+    ious = cls_agn_iou(dets['box'][pair_det], gts['box'][pair_gt], gts['crowd'][pair_gt])
+
+    # only detections above the lowest threshold with some gt can be matched
+    candidate = np.zeros(len(dets['score']), dtype=bool)
+    candidate[pair_det[ious >= thresholds.min()]] = True
+
+    dt_matched = np.zeros((A, T, len(candidate)), dtype=bool)
+    dt_ignore = np.zeros((A, T, len(candidate)), dtype=bool)
+    # images sorted by number of gts so that blocks need little padding
+    by_size = np.argsort(num_gts, kind='stable')
+    by_size = by_size[num_gts[by_size] > 0]
+    for block in np.array_split(by_size, max(1, -(-len(by_size) // block_size))):
+        if len(block) == 0:
+            continue
+        cand_index = [np.flatnonzero(candidate[dets['offsets'][i]:dets['offsets'][i + 1]]) + dets['offsets'][i]
+                      for i in block]
+        D, G = max(len(c) for c in cand_index), num_gts[block].max()
+        if D == 0:
+            continue
+        B = len(block)
+        block_ious = np.full((B, D, G), -1.)
+        block_gt = np.full((B, G), -1, dtype=np.int64)
+        block_det = np.full((B, D), -1, dtype=np.int64)
+        for b, (i, c) in enumerate(zip(block, cand_index)):
+            block_gt[b, :num_gts[i]] = gts['offsets'][i] + np.arange(num_gts[i])
+            block_det[b, :len(c)] = c
+            pairs_of_c = pair_start[i] + (c - dets['offsets'][i])[:, None] * num_gts[i] + np.arange(num_gts[i])
+            block_ious[b, :len(c), :num_gts[i]] = ious[pairs_of_c]
+        valid_gt = block_gt >= 0
+        crowd = np.where(valid_gt, gts['crowd'][block_gt], False)
+        ignore = np.where(valid_gt[:, None], gt_ignore[:, block_gt].transpose(1, 0, 2), True)
+        taken = np.zeros((B, A, T, G), dtype=bool)
+        for d in range(D):
+            iou = block_ious[:, d, None, None, :]
+            cand = (iou >= thresholds[:, None]) & ~(taken & ~crowd[:, None, None, :])
+            # a non-ignored gt is always preferred, and among them the last one with the highest IoU
+            preferred = cand & ~ignore[:, :, None, :]
+            cand = np.where(preferred.any(-1, keepdims=True), preferred, cand)
+            matched = cand.any(-1)
+            m = G - 1 - np.argmax(np.where(cand, iou, -np.inf)[..., ::-1], axis=-1)[..., None]
+            np.put_along_axis(taken, m, np.take_along_axis(taken, m, -1) | matched[..., None], -1)
+            det = block_det[:, d]
+            has_det = det >= 0
+            dt_matched[:, :, det[has_det]] = matched[has_det].transpose(1, 2, 0)
+            dt_ignore[:, :, det[has_det]] = (matched & np.take_along_axis(
+                np.broadcast_to(ignore[:, :, None, :], taken.shape), m, -1)[..., 0])[has_det].transpose(1, 2, 0)
+
+    # unmatched detections outside of the area range are ignored
+    det_outside = (dets['area'][None] < area_rng[:, :1]) | (dets['area'][None] > area_rng[:, 1:])
+    dt_ignore |= ~dt_matched & det_outside[:, None, :]
+    return dt_matched, dt_ignore, gt_ignore
+
+
+def cls_agn_accumulate(dets, dt_matched, dt_ignore, gt_ignore, p):
+    """COCOeval.accumulate of the class-agnostic matching, with a single sort of all the detections."""
+    T, R, A, M = len(p.iouThrs), len(p.recThrs), len(p.areaRng), len(p.maxDets)
+    precision = -np.ones((T, R, 1, A, M))
+    recall = -np.ones((T, 1, A, M))
+    scores = -np.ones((T, R, 1, A, M))
+    # sorted by decreasing score, ties by image and rank within the image, like the mergesort of pycocotools
+    order = np.lexsort((dets['rank'], dets['image_pos'], -dets['score']))
+    for m, max_det in enumerate(p.maxDets):
+        sel = order[dets['rank'][order] < max_det]
+        if m > 0 and len(sel) == len(prev_sel):
+            # no image has more detections than the previous maxDets
+            precision[..., m], recall[..., m], scores[..., m] = precision[..., m - 1], recall[..., m - 1], scores[..., m - 1]
+            continue
+        prev_sel = sel
+        dt_scores_sorted = dets['score'][sel]
+        for a in range(A):
+            npig = np.count_nonzero(gt_ignore[a] == 0)
+            if npig == 0:
+                continue
+            dtm, dt_ig = dt_matched[a][:, sel], dt_ignore[a][:, sel]
+            tp_sum = np.cumsum(dtm & ~dt_ig, axis=1).astype(dtype=float)
+            fp_sum = np.cumsum(~dtm & ~dt_ig, axis=1).astype(dtype=float)
+            nd = tp_sum.shape[1]
+            rc = tp_sum / npig
+            pr = tp_sum / (fp_sum + tp_sum + np.spacing(1))
+            recall[:, 0, a, m] = rc[:, -1] if nd else 0
+            if nd == 0:
+                precision[:, :, 0, a, m] = 0
+                scores[:, :, 0, a, m] = 0
+                continue
+            # precision envelope
+            pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+            for t in range(T):
+                inds = np.searchsorted(rc[t], p.recThrs, side='left')
+                valid = inds < nd
+                precision[t, :, 0, a, m] = np.where(valid, pr[t][np.minimum(inds, nd - 1)], 0)
+                scores[t, :, 0, a, m] = np.where(valid, dt_scores_sorted[np.minimum(inds, nd - 1)], 0)
+    return {
+        'params': p,
+        'counts': [T, R, 1, A, M],
+        'date': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'precision': precision,
+        'recall': recall,
+        'scores': scores,
+    }
+
+
 #################################################################
 # From pycocotools, just removed the prints and fixed
 # a Python3 bug about unicode not defined
@@ -3,14 +3,72 @@ import shutil
 import datetime
 import functools
 import subprocess
+import multiprocessing
+from multiprocessing import shared_memory
 import xml.etree.ElementTree as ET
 import numpy as np
 import torch
 import logging
-from util.misc import all_gather
+from util.misc import all_gather_columns, is_main_process
 from collections import OrderedDict, defaultdict
 
 
+class ColumnStore:
+    """
+    Columnar, append-only store of typed records, e.g. one record per detection.
+    Columns are kept in numpy buffers that grow geometrically, so appending a batch
+    costs a copy of the batch and nothing else.
+    Args:
+        columns: OrderedDict of column name -> (dtype, shape of one record)
+    """
+
+    def __init__(self, columns, capacity=1024):
+        self.spec = OrderedDict(columns)
+        self._buffers = {k: np.empty((capacity,) + tuple(shape), dtype=dtype) for k, (dtype, shape) in self.spec.items()}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, column):
+        return self._buffers[column][:self._size]
+
+    def _reserve(self, n):
+        capacity = len(next(iter(self._buffers.values())))
+        if self._size + n <= capacity:
+            return
+        capacity = max(2 * capacity, self._size + n)
+        for k, buf in self._buffers.items():
+            grown = np.empty((capacity,) + buf.shape[1:], dtype=buf.dtype)
+            grown[:self._size] = buf[:self._size]
+            self._buffers[k] = grown
+
+    def append(self, **values):
+        """Append a batch of records, given one array per column. Scalars are broadcast to the batch."""
+        n = len(next(v for v in values.values() if np.ndim(v) > 0))
+        self._reserve(n)
+        for k in self.spec:
+            self._buffers[k][self._size:self._size + n] = values[k]
+        self._size += n
+
+    def columns(self):
+        return OrderedDict((k, self[k]) for k in self.spec)
+
+    @classmethod
+    def from_columns(cls, columns, spec):
+        store = cls(spec, capacity=max(len(next(iter(columns.values()))), 1))
+        store.append(**columns)
+        return store
+
+
+# recall levels at which Wilderness Impact and the unknown precision are reported
+RECALL_LEVELS = [r / 10 for r in range(1, 10)]
+
+# image index (in voc_gt.image_set), class, score and xyxy box of every detection
+PREDICTION_COLUMNS = OrderedDict(image=(np.int64, ()), cls=(np.int64, ()), score=(np.float32, ()),
+                                 box=(np.float32, (4,)))
+
+
 class OWEvaluator:
     def __init__(self, voc_gt, iou_types, args=None, use_07_metric=True, ovthresh=list(range(50, 100, 5))):
         assert tuple(iou_types) == ('bbox',)
@@ -20,7 +78,7 @@ class OWEvaluator:
         self.eps = torch.finfo(torch.float64).eps
         self.num_classes = len(self.voc_gt.CLASS_NAMES)
         self._class_names = self.voc_gt.CLASS_NAMES
-        self.AP = torch.zeros(self.num_classes, 1)
+        self.AP = torch.zeros(self.num_classes, len(self.ovthresh))
         self.all_recs = defaultdict(list)
         self.all_precs = defaultdict(list)
         self.recs = defaultdict(list)
@@ -34,8 +92,16 @@ class OWEvaluator:
         self.coco_eval['bbox'].eval = dict()
 
         self.img_ids = []
-        self.lines = []
-        self.lines_cls = []
+        self.predictions = ColumnStore(PREDICTION_COLUMNS)
+        self.image_index = {img_id: i for i, img_id in enumerate(self.voc_gt.imgids)}
+        self._gt_index = None
+        self.num_workers = getattr(args, 'eval_workers', 0)
+        # in streaming mode update() matches every image right away and only keeps per-detection match flags
+        self.streaming = getattr(args, 'eval_streaming', False)
+        self.matches = ColumnStore(OrderedDict(cls=(np.int64, ()), score=(np.float32, ()),
+                                               tp=(bool, (len(self.ovthresh),)), fp=(bool, (len(self.ovthresh),)),
+                                               unk=(bool, (len(self.ovthresh),))))
+        self._stream_gt = None
         if args is not None:
             self.prev_intro_cls = args.PREV_INTRODUCED_CLS
             self.curr_intro_cls = args.CUR_INTRODUCED_CLS
@@ -52,164 +118,282 @@ class OWEvaluator:
 
     def update(self, predictions):
         for img_id, pred in predictions.items():
-            pred_boxes, pred_labels, pred_scores = [pred[k].cpu() for k in ['boxes', 'labels', 'scores']]
-            image_id = self.voc_gt.convert_image_id(int(img_id), to_string=True)
+            pred_boxes, pred_labels, pred_scores = [pred[k].cpu().numpy() for k in ['boxes', 'labels', 'scores']]
             self.img_ids.append(img_id)
-            classes = pred_labels.tolist()
-            for (xmin, ymin, xmax, ymax), cls, score in zip(pred_boxes.tolist(), classes , pred_scores.tolist()):
-                xmin += 1
-                ymin += 1
-                self.lines.append(f"{image_id} {score:.3f} {xmin:.1f} {ymin:.1f} {xmax:.1f} {ymax:.1f}")
-                self.lines_cls.append(cls)
-
-    def compute_avg_precision_at_many_recall_level_for_unk(self, precisions, recalls):
-        precs = {}
-        for r in range(1, 10):
-            r = r/10
-            p = self.compute_avg_precision_at_a_recall_level_for_unk(precisions, recalls, recall_level=r)
-            precs[r] = p
-        return precs
+            if self.streaming:
+                self.match_image(self.image_index[int(img_id)], pred_labels, pred_scores, pred_boxes)
+            else:
+                self.predictions.append(image=self.image_index[int(img_id)], cls=pred_labels, score=pred_scores,
+                                        box=pred_boxes)
+
+    def match_image(self, image, labels, scores, boxes):
+        if self._stream_gt is None:
+            gt = self.gt_index
+            self._stream_gt = (gt.boxes, gt.difficult, gt.offsets, gt.class_ids(self.known_classes, self._class_names))
+        gt_boxes, gt_difficult, gt_offsets, gt_class = self._stream_gt
+        g0, g1 = gt_offsets[image], gt_offsets[image + 1]
+        boxes = boxes.astype(float)
+        boxes[:, :2] += 1
+        order, tp, fp, is_unk = match_image(labels, scores, boxes, gt_boxes[g0:g1], gt_difficult[g0:g1],
+                                            gt_class[g0:g1], self._class_names.index('unknown'),
+                                            [ovthresh / 100.0 for ovthresh in self.ovthresh])
+        self.matches.append(cls=labels[order], score=scores[order], tp=tp, fp=fp, unk=is_unk)
+
+    def voc_lines(self, class_label_ind):
+        """Detections of one class in the VOC devkit text format (1-based xmin/ymin)."""
+        preds = self.predictions
+        keep = np.flatnonzero(preds['cls'] == class_label_ind)
+        lines = []
+        for image, score, (xmin, ymin, xmax, ymax) in zip(preds['image'][keep].tolist(), preds['score'][keep].tolist(),
+                                                          preds['box'][keep].tolist()):
+            lines.append(f"{self.voc_gt.image_set[image]} {score:.3f} {xmin + 1:.1f} {ymin + 1:.1f} {xmax:.1f} {ymax:.1f}")
+        return lines
+
+    def write_voc_results(self, out_dir, prefix='comp4_det_test_'):
+        """Write one VOC devkit detection file per class into out_dir."""
+        os.makedirs(out_dir, exist_ok=True)
+        for class_label_ind, class_label in enumerate(self._class_names):
+            with open(os.path.join(out_dir, prefix + class_label + '.txt'), 'w') as f:
+                f.writelines(line + '\n' for line in self.voc_lines(class_label_ind))
+
+    def recall_level_table(self, recalls, recall_levels=RECALL_LEVELS, **curves):
+        """
+        Sample per-class curves at the detection whose recall is closest to each recall level.
+        Args:
+            recalls: {iou: [per-class recall array]}
+            recall_levels: recall levels to sample at
+            curves: named {iou: [per-class array or None]} curves aligned with recalls
+        Returns:
+            dict of dense [class x recall_level x IoU] float64 arrays for 'recall' and every curve (NaN for
+            classes without detections or without that curve), the [class x IoU] 'has_dets' mask and the
+            'recall_levels' and 'ious' axes
+        """
+        ious = list(recalls)
+        shape = (self.num_classes, len(recall_levels), len(ious))
+        table = OrderedDict(recall_levels=np.asarray(recall_levels, dtype=np.float64), ious=np.asarray(ious),
+                            has_dets=np.zeros((self.num_classes, len(ious)), dtype=bool),
+                            recall=np.full(shape, np.nan))
+        for name in curves:
+            table[name] = np.full(shape, np.nan)
+        for iou_ind, iou in enumerate(ious):
+            for cls_id, rec in enumerate(recalls[iou]):
+                if len(rec) == 0:
+                    continue
+                index = recall_level_indices(rec, recall_levels)
+                table['has_dets'][cls_id, iou_ind] = True
+                table['recall'][cls_id, :, iou_ind] = np.asarray(rec)[index]
+                for name, curve in curves.items():
+                    if curve[iou][cls_id] is not None:
+                        table[name][cls_id, :, iou_ind] = np.asarray(curve[iou][cls_id])[index]
+        return table
+
+    def avg_precision_for_unk_from_table(self, table):
+        unknown = [cls_id for cls_id in [self.unknown_class_index] if cls_id < self.num_classes]
+        return self._reduce_recall_level_table(table, unknown,
+                                               lambda values: np.mean(values('precision')))
+
+    def WI_from_table(self, table):
+        seen = list(range(min(self.num_seen_classes, self.num_classes)))
+        return self._reduce_recall_level_table(table, seen,
+                                               lambda values: np.mean(values('fp_os')) / np.mean(values('tp_plus_fp_cs')))
+
+    @staticmethod
+    def _reduce_recall_level_table(table, class_ids, reduce):
+        """{recall_level: {iou: reduce(values)}} over the given classes that have detections, 0 if there are none."""
+        reduced = {}
+        for r_ind, r in enumerate(table['recall_levels'].tolist()):
+            reduced[r] = {}
+            for iou_ind, iou in enumerate(table['ious'].tolist()):
+                has_dets = table['has_dets'][class_ids, iou_ind]
+                values = lambda name: table[name][class_ids, r_ind, iou_ind][has_dets]
+                reduced[r][iou] = reduce(values) if has_dets.any() else 0
+        return reduced
+
+    def compute_avg_precision_at_many_recall_level_for_unk(self, precisions, recalls, recall_levels=RECALL_LEVELS):
+        table = self.recall_level_table(recalls, recall_levels, precision=precisions)
+        return self.avg_precision_for_unk_from_table(table)
 
     def compute_avg_precision_at_a_recall_level_for_unk(self, precisions, recalls, recall_level=0.5):
-        precs = {}
-        for iou, recall in recalls.items():
-            prec = []
-            for cls_id, rec in enumerate(recall):
-                if cls_id == self.unknown_class_index and len(rec)>0:
-                    p = precisions[iou][cls_id][min(range(len(rec)), key=lambda i: abs(rec[i] - recall_level))]
-                    prec.append(p)
-            if len(prec) > 0:
-                precs[iou] = np.mean(prec)
-            else:
-                precs[iou] = 0
-        return precs
+        return self.compute_avg_precision_at_many_recall_level_for_unk(precisions, recalls, [recall_level])[recall_level]
 
-    def compute_WI_at_many_recall_level(self, recalls, tp_plus_fp_cs, fp_os):
-        wi_at_recall = {}
-        for r in range(1, 10):
-            r = r/10
-            wi = self.compute_WI_at_a_recall_level(recalls, tp_plus_fp_cs, fp_os, recall_level=r)
-            wi_at_recall[r] = wi
-        return wi_at_recall
+    def compute_WI_at_many_recall_level(self, recalls, tp_plus_fp_cs, fp_os, recall_levels=RECALL_LEVELS):
+        table = self.recall_level_table(recalls, recall_levels, tp_plus_fp_cs=tp_plus_fp_cs, fp_os=fp_os)
+        return self.WI_from_table(table)
 
     def compute_WI_at_a_recall_level(self, recalls, tp_plus_fp_cs, fp_os, recall_level=0.5):
-        wi_at_iou = {}
-        for iou, recall in recalls.items():
-            tp_plus_fps = []
-            fps = []
-            for cls_id, rec in enumerate(recall):
-                if cls_id in range(self.num_seen_classes) and len(rec) > 0:
-                    index = min(range(len(rec)), key=lambda i: abs(rec[i] - recall_level))
-                    tp_plus_fp = tp_plus_fp_cs[iou][cls_id][index]
-                    tp_plus_fps.append(tp_plus_fp)
-                    fp = fp_os[iou][cls_id][index]
-                    fps.append(fp)
-            if len(tp_plus_fps) > 0:
-                wi_at_iou[iou] = np.mean(fps) / np.mean(tp_plus_fps)
-            else:
-                wi_at_iou[iou] = 0
-        return wi_at_iou
+        return self.compute_WI_at_many_recall_level(recalls, tp_plus_fp_cs, fp_os, [recall_level])[recall_level]
 
     def synchronize_between_processes(self):
         self.img_ids = torch.tensor(self.img_ids, dtype=torch.int64)
-        self.lines_cls = torch.tensor(self.lines_cls, dtype=torch.int64)
-        self.img_ids, self.lines, self.lines_cls = self.merge(self.img_ids, self.lines, self.lines_cls)
-
-    def merge(self, img_ids, lines, lines_cls):
-        flatten = lambda ls: [s for l in ls for s in l]
-
-        all_img_ids = torch.cat(all_gather(img_ids))
-        all_lines_cls = torch.cat(all_gather(lines_cls))
-        all_lines = flatten(all_gather(lines))
-        return all_img_ids, all_lines, all_lines_cls
+        if self.streaming:
+            self.img_ids, self.matches = self.merge(self.img_ids, self.matches)
+        else:
+            self.img_ids, self.predictions = self.merge(self.img_ids, self.predictions)
+
+    def merge(self, img_ids, store):
+        all_img_ids = all_gather_columns({'img_ids': img_ids})['img_ids']
+        columns = all_gather_columns(OrderedDict((k, torch.from_numpy(v)) for k, v in store.columns().items()))
+        all_store = ColumnStore.from_columns(OrderedDict((k, v.numpy()) for k, v in columns.items()), store.spec)
+        return all_img_ids, all_store
+
+    @property
+    def gt_index(self):
+        if self._gt_index is None:
+            self._gt_index = VOCGTIndex.from_dataset(self.voc_gt)
+        return self._gt_index
+
+    def eval_arrays(self):
+        """Detections sorted by class (with per-class offsets) and the flat ground truth, as plain arrays."""
+        preds = self.predictions
+        order = np.argsort(preds['cls'], kind='stable')
+        det_box = preds['box'][order].astype(float)
+        det_box[:, :2] += 1
+        gt = self.gt_index
+        return dict(det_image=preds['image'][order], det_score=preds['score'][order].astype(float), det_box=det_box,
+                    det_offsets=np.searchsorted(preds['cls'][order], np.arange(self.num_classes + 1)),
+                    gt_boxes=gt.boxes, gt_difficult=gt.difficult, gt_offsets=gt.offsets,
+                    gt_class=gt.class_ids(self.known_classes, self._class_names))
+
+    def evaluate_classes(self, arrays, **kwargs):
+        """Run evaluate_class for every class, on a process pool when num_workers > 0. Results are in class order."""
+        classes = range(self.num_classes)
+        if self.num_workers <= 0:
+            return [evaluate_class(arrays, class_ind, **kwargs) for class_ind in classes]
+        shared = SharedArrays(arrays)
+        try:
+            ctx = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+            with ctx.Pool(min(self.num_workers, self.num_classes), initializer=_init_class_worker,
+                          initargs=(shared.specs, kwargs)) as pool:
+                return pool.map(_class_worker, classes)
+        finally:
+            shared.close()
+
+    def streamed_results(self):
+        """Per-class results from the match flags collected by update() in streaming mode."""
+        matches = self.matches
+        order = np.argsort(matches['cls'], kind='stable')
+        offsets = np.searchsorted(matches['cls'][order], np.arange(self.num_classes + 1))
+        gt = self.gt_index
+        gt_class = gt.class_ids(self.known_classes, self._class_names)
+        npos = np.bincount(gt_class[~gt.difficult], minlength=self.num_classes)
+        unknown_ind = self._class_names.index('unknown')
+        results = []
+        for class_ind in range(self.num_classes):
+            inds = order[offsets[class_ind]:offsets[class_ind + 1]]
+            inds = inds[np.argsort(-matches['score'][inds].astype(float))]
+            tp, fp, is_unk = [matches[k][inds].astype(np.float64) for k in ('tp', 'fp', 'unk')]
+            results.append([voc_curves(tp[:, t], fp[:, t], None if class_ind == unknown_ind else is_unk[:, t],
+                                       int(npos[class_ind]), int(npos[unknown_ind]), self.use_07_metric)
+                            for t in range(len(self.ovthresh))])
+        return results, np.diff(offsets)
 
     def accumulate(self):
-        for class_label_ind, class_label in enumerate(self.voc_gt.CLASS_NAMES):
-            lines_by_class = [l + '\n' for l, c in zip(self.lines, self.lines_cls.tolist()) if c == class_label_ind]
-            if len(lines_by_class) == 0:
-                lines_by_class = []
-            print(class_label + " has " + str(len(lines_by_class)) + " predictions.")
-            ovthresh = 50
-            ovthresh_ind, _ = map(self.ovthresh.index, [50, 75])
-           
-            self.rec, self.prec, self.AP[class_label_ind, ovthresh_ind], self.unk_det_as_known, \
-                self.num_unk, self.tp_plus_fp_closed_set, self.fp_open_set = voc_eval(lines_by_class, \
-                self.voc_gt.annotations, self.voc_gt.image_set, class_label, ovthresh=ovthresh / 100.0, use_07_metric=self.use_07_metric, known_classes=self.known_classes) #[-1]
-            
-            self.AP[class_label_ind, ovthresh_ind] = self.AP[class_label_ind, ovthresh_ind] * 100
-            self.all_recs[ovthresh].append(self.rec)
-            self.all_precs[ovthresh].append(self.prec)
-            self.num_unks[ovthresh].append(self.num_unk)
-            self.unk_det_as_knowns[ovthresh].append(self.unk_det_as_known)
-            self.tp_plus_fp_cs[ovthresh].append(self.tp_plus_fp_closed_set)
-            self.fp_os[ovthresh].append(self.fp_open_set)
-            try:
-                self.recs[ovthresh].append(self.rec[-1] * 100)
-                self.precs[ovthresh].append(self.prec[-1] * 100)
-            except:
-                self.recs[ovthresh].append(0.)
-                self.precs[ovthresh].append(0.)
+        if self.streaming:
+            results, num_dets = self.streamed_results()
+        else:
+            arrays = self.eval_arrays()
+            # every class is matched once and resolved for all the IoU thresholds in self.ovthresh
+            results = self.evaluate_classes(arrays, unknown_ind=self._class_names.index('unknown'),
+                                            ovthresh=[ovthresh / 100.0 for ovthresh in self.ovthresh],
+                                            use_07_metric=self.use_07_metric)
+            num_dets = np.diff(arrays['det_offsets'])
+        for class_label_ind, (class_label, class_results) in enumerate(zip(self.voc_gt.CLASS_NAMES, results)):
+            print(class_label + " has " + str(num_dets[class_label_ind]) + " predictions.")
+            for ovthresh_ind, (ovthresh, result) in enumerate(zip(self.ovthresh, class_results)):
+                self.add_class_result(class_label_ind, ovthresh_ind, ovthresh, result)
+
+    def add_class_result(self, class_label_ind, ovthresh_ind, ovthresh, result):
+        self.rec, self.prec, self.AP[class_label_ind, ovthresh_ind], self.unk_det_as_known, \
+            self.num_unk, self.tp_plus_fp_closed_set, self.fp_open_set = result
+
+        self.AP[class_label_ind, ovthresh_ind] = self.AP[class_label_ind, ovthresh_ind] * 100
+        self.all_recs[ovthresh].append(self.rec)
+        self.all_precs[ovthresh].append(self.prec)
+        self.num_unks[ovthresh].append(self.num_unk)
+        self.unk_det_as_knowns[ovthresh].append(self.unk_det_as_known)
+        self.tp_plus_fp_cs[ovthresh].append(self.tp_plus_fp_closed_set)
+        self.fp_os[ovthresh].append(self.fp_open_set)
+        try:
+            self.recs[ovthresh].append(self.rec[-1] * 100)
+            self.precs[ovthresh].append(self.prec[-1] * 100)
+        except:
+            self.recs[ovthresh].append(0.)
+            self.precs[ovthresh].append(0.)
 
     def summarize(self, fmt='{:.06f}'):
         o50, _ = map(self.ovthresh.index, [50, 75])
         mAP = float(self.AP.mean())
-        mAP50 = float(self.AP[:, o50].mean())
+        # a contiguous copy keeps the float32 reductions identical to a single-IoU AP tensor
+        AP50 = self.AP[:, o50].contiguous()
+        mAP50 = float(AP50.mean())
         print('detection mAP50:', fmt.format(mAP50))
         print('detection mAP:', fmt.format(mAP))
         print('---AP50---')
-        wi = self.compute_WI_at_many_recall_level(self.all_recs, self.tp_plus_fp_cs, self.fp_os)
+        # curves sampled at every recall level, kept as dense [class x recall_level x IoU] arrays
+        table = self.recall_level_table(self.all_recs, precision=self.all_precs,
+                                        tp_plus_fp_cs=self.tp_plus_fp_cs, fp_os=self.fp_os)
+        self.coco_eval['bbox'].eval['recall_levels'] = table
+        wi = self.WI_from_table(table)
         print('Wilderness Impact: ' + str(wi))
-        avg_precision_unk = self.compute_avg_precision_at_many_recall_level_for_unk(self.all_precs, self.all_recs)
+        avg_precision_unk = self.avg_precision_for_unk_from_table(table)
         print('avg_precision: ' + str(avg_precision_unk))
         total_num_unk_det_as_known = {iou: np.sum(x) for iou, x in self.unk_det_as_knowns.items()} #torch.sum(self.unk_det_as_knowns[:, o50]) #[np.sum(x) for x in self.unk_det_as_knowns[:, o50]]
         total_num_unk = self.num_unks[50][0]
         print('Absolute OSE (total_num_unk_det_as_known): ' + str(total_num_unk_det_as_known))
         print('total_num_unk ' + str(total_num_unk))
-        print("AP50: " + str(['%.1f' % x for x in self.AP[:, o50]]))
+        print("AP50: " + str(['%.1f' % x for x in AP50]))
         print("Precisions50: " + str(['%.1f' % x for x in self.precs[50]]))
         print("Recall50: " + str(['%.1f' % x for x in self.recs[50]]))
 
         if self.prev_intro_cls > 0:
-            print("Prev class AP50: " + str(self.AP[:, o50][:self.prev_intro_cls].mean()))
+            print("Prev class AP50: " + str(AP50[:self.prev_intro_cls].mean()))
             print("Prev class Precisions50: " + str(np.mean(self.precs[50][:self.prev_intro_cls])))
             print("Prev class Recall50: " + str(np.mean(self.recs[50][:self.prev_intro_cls])))
 
-        print("Current class AP50: " + str(self.AP[:, o50][self.prev_intro_cls:self.prev_intro_cls + self.curr_intro_cls].mean()))
+        print("Current class AP50: " + str(AP50[self.prev_intro_cls:self.prev_intro_cls + self.curr_intro_cls].mean()))
         print("Current class Precisions50: " + str(np.mean(self.precs[50][self.prev_intro_cls:self.prev_intro_cls + self.curr_intro_cls])))
         print("Current class Recall50: " + str(np.mean(self.recs[50][self.prev_intro_cls:self.prev_intro_cls + self.curr_intro_cls])))
 
-        print("Known AP50: " + str(self.AP[:, o50][:self.prev_intro_cls + self.curr_intro_cls].mean()))
+        print("Known AP50: " + str(AP50[:self.prev_intro_cls + self.curr_intro_cls].mean()))
         print("Known Precisions50: " + str(np.mean(self.precs[50][:self.prev_intro_cls + self.curr_intro_cls])))
         print("Known Recall50: " + str(np.mean(self.recs[50][:self.prev_intro_cls + self.curr_intro_cls])))
 
-        print("Unknown AP50: " + str(self.AP[:, o50][-1]))
+        print("Unknown AP50: " + str(AP50[-1]))
         print("Unknown Precisions50: " + str(self.precs[50][-1]))
         print("Unknown Recall50: " + str(self.recs[50][-1]))
 
-        for class_name, ap in zip(self.voc_gt.CLASS_NAMES, self.AP[:, o50].cpu().tolist()):
+        iou_range = '[{:.2f}:{:.2f}]'.format(self.ovthresh[0] / 100, self.ovthresh[-1] / 100)
+        print("Known AP" + iou_range + ": " + str(self.AP[:self.prev_intro_cls + self.curr_intro_cls].mean()))
+        print("Unknown Recall per IoU: " + str({iou: '%.1f' % self.recs[iou][-1] for iou in self.ovthresh}))
+
+        for class_name, ap in zip(self.voc_gt.CLASS_NAMES, AP50.cpu().tolist()):
             print(class_name, fmt.format(ap))
         self.coco_eval['bbox'].stats = torch.cat(
-            [self.AP[:, o50].mean(dim=0, keepdim=True),
+            [AP50.mean(dim=0, keepdim=True),
              self.AP.flatten().mean(dim=0, keepdim=True), self.AP.flatten()])
         
         Res  = {
             "WI":wi[0.8][50],
             "AOSA": total_num_unk_det_as_known[50],
             
-            "CK_AP50": float(self.AP[:, o50][self.prev_intro_cls:self.prev_intro_cls + self.curr_intro_cls].mean().detach().cpu()),
+            "CK_AP50": float(AP50[self.prev_intro_cls:self.prev_intro_cls + self.curr_intro_cls].mean().detach().cpu()),
             "CK_P50": np.mean(self.precs[50][self.prev_intro_cls:self.prev_intro_cls + self.curr_intro_cls]),
             "CK_R50": np.mean(self.recs[50][self.prev_intro_cls:self.prev_intro_cls + self.curr_intro_cls]),
             
-            "K_AP50": float(self.AP[:, o50][:self.prev_intro_cls + self.curr_intro_cls].mean().detach().cpu()),
+            "K_AP50": float(AP50[:self.prev_intro_cls + self.curr_intro_cls].mean().detach().cpu()),
             "K_P50": np.mean(self.precs[50][:self.prev_intro_cls + self.curr_intro_cls]),
             "K_R50": np.mean(self.recs[50][:self.prev_intro_cls + self.curr_intro_cls]),
             
-            "U_AP50": float(self.AP[:, o50][-1].detach().cpu()),
+            "U_AP50": float(AP50[-1].detach().cpu()),
             "U_P50": self.precs[50][-1],
-            "U_R50": self.recs[50][-1]
+            "U_R50": self.recs[50][-1],
+
+            "K_AP": float(self.AP[:self.prev_intro_cls + self.curr_intro_cls].mean().detach().cpu()),
         }
+        for iou in self.ovthresh:
+            Res[f"U_R{iou}"] = self.recs[iou][-1]
         if self.prev_intro_cls > 0:
-            Res["PK_AP50"]=float(self.AP[:, o50][:self.prev_intro_cls].mean().detach().cpu())
+            Res["PK_AP50"]=float(AP50[:self.prev_intro_cls].mean().detach().cpu())
             Res["PK_P50"]=np.mean(self.precs[50][:self.prev_intro_cls])
             Res["PK_R50"]=np.mean(self.recs[50][:self.prev_intro_cls])
         
@@ -224,12 +408,12 @@ def voc_ap(rec, prec, use_07_metric=False):
     """
     if use_07_metric:
         # 11 point metric
+        thresholds = np.arange(0., 1.1, 0.1)
+        above = rec[None, :] >= thresholds[:, None]
+        points = np.where(above.any(1), np.max(np.where(above, prec[None, :], -np.inf), axis=1, initial=-np.inf), 0)
+        # accumulate in the same order as the reference loop to keep the result bit-identical
         ap = 0.
-        for t in np.arange(0., 1.1, 0.1):
-            if np.sum(rec >= t) == 0:
-                p = 0
-            else:
-                p = np.max(prec[rec >= t])
+        for p in points:
             ap = ap + p / 11.
     else:
         # correct AP calculation
@@ -238,8 +422,7 @@ def voc_ap(rec, prec, use_07_metric=False):
         mpre = np.concatenate(([0.], prec, [0.]))
 
         # compute the precision envelope
-        for i in range(mpre.size - 1, 0, -1):
-            mpre[i - 1] = np.maximum(mpre[i - 1], mpre[i])
+        mpre = np.maximum.accumulate(mpre[::-1])[::-1]
 
         # to calculate area under PR curve, look for points
         # where X axis (recall) changes value
@@ -250,9 +433,93 @@ def voc_ap(rec, prec, use_07_metric=False):
     return ap
 
 
-@functools.lru_cache(maxsize=None)
-def parse_rec(filename, known_classes):
-    """ Parse a PASCAL VOC xml file """
+def recall_level_indices(rec, recall_levels):
+    """
+    For every recall level, the first index of the recall closest to it, i.e.
+    min(range(len(rec)), key=lambda i: abs(rec[i] - recall_level)), found with a binary search.
+    """
+    rec = np.asarray(rec)
+    if not (np.isfinite(rec).all() and (rec[1:] >= rec[:-1]).all()):
+        # the binary search needs a finite, non-decreasing curve
+        return np.array([min(range(len(rec)), key=lambda i: abs(rec[i] - recall_level))
+                         for recall_level in recall_levels], dtype=np.int64)
+    levels = np.asarray(recall_levels, dtype=np.float64)
+    above = np.searchsorted(rec, levels, side='left')
+    below = np.maximum(above - 1, 0)
+    above = np.minimum(above, len(rec) - 1)
+    # the closest value below may span a plateau, whose first index wins
+    below = np.searchsorted(rec, rec[below], side='left')
+    return np.where(np.abs(rec[below] - levels) <= np.abs(rec[above] - levels), below, above)
+
+
+def voc_iou(dets, gts):
+    """Pairwise VOC IoU (inclusive pixel coordinates) between [N, 4] detections and [M, 4] ground truth."""
+    ixmin = np.maximum(gts[None, :, 0], dets[:, None, 0])
+    iymin = np.maximum(gts[None, :, 1], dets[:, None, 1])
+    ixmax = np.minimum(gts[None, :, 2], dets[:, None, 2])
+    iymax = np.minimum(gts[None, :, 3], dets[:, None, 3])
+    iw = np.maximum(ixmax - ixmin + 1., 0.)
+    ih = np.maximum(iymax - iymin + 1., 0.)
+    inters = iw * ih
+
+    # union
+    uni = ((dets[:, None, 2] - dets[:, None, 0] + 1.) * (dets[:, None, 3] - dets[:, None, 1] + 1.) +
+           (gts[None, :, 2] - gts[None, :, 0] + 1.) *
+           (gts[None, :, 3] - gts[None, :, 1] + 1.) - inters)
+
+    return inters / uni
+
+
+def max_overlaps(det_image, dets, gt_boxes, gt_offsets):
+    """
+    For every detection, find the ground-truth box of the same image with the highest IoU.
+    Detections are grouped by image so that each image costs a single [n_det, n_gt] IoU computation.
+    Args:
+        det_image: [N] image index of every detection
+        dets: [N, 4] detection boxes
+        gt_boxes: [G, 4] ground-truth boxes of all images, grouped by image
+        gt_offsets: [num_images + 1] start of each image's boxes in gt_boxes
+    Returns:
+        ovmax: [N] best IoU, -inf for detections on images without ground truth
+        jmax: [N] flat index into gt_boxes of the best box, -1 where ovmax is -inf
+    """
+    nd = len(det_image)
+    ovmax = np.full(nd, -np.inf)
+    jmax = np.full(nd, -1, dtype=np.int64)
+    if nd == 0:
+        return ovmax, jmax
+    order = np.argsort(det_image, kind='stable')
+    images, starts = np.unique(det_image[order], return_index=True)
+    for image, inds in zip(images, np.split(order, starts[1:])):
+        g0, g1 = gt_offsets[image], gt_offsets[image + 1]
+        if g1 == g0:
+            continue
+        overlaps = voc_iou(dets[inds], gt_boxes[g0:g1])
+        ovmax[inds] = overlaps.max(1)
+        jmax[inds] = g0 + overlaps.argmax(1)
+    return ovmax, jmax
+
+
+def greedy_tp_fp(ovmax, jmax, gt_difficult, ovthresh):
+    """
+    Resolve the greedy VOC assignment for score-sorted detections.
+    The best box of a detection does not depend on which boxes are already taken, so a detection
+    is a true positive iff it is the first (highest scoring) one to claim a non-difficult box.
+    Detections whose best box is difficult are neither TP nor FP.
+    """
+    hit = ovmax > ovthresh
+    difficult = np.zeros(len(ovmax), dtype=bool)
+    difficult[hit] = gt_difficult[jmax[hit]]
+    claims = np.flatnonzero(hit & ~difficult)
+    tp = np.zeros(len(ovmax))
+    tp[claims[np.unique(jmax[claims], return_index=True)[1]]] = 1.
+    fp = (~hit).astype(np.float64)
+    fp[claims] = 1. - tp[claims]
+    return tp, fp
+
+
+def parse_objects(filename):
+    """ Parse the objects of a PASCAL VOC xml file, with COCO class names mapped back to VOC """
 
     VOC_CLASS_NAMES_COCOFIED = [
         "airplane", "dining table", "motorcycle",
@@ -264,15 +531,12 @@ def parse_rec(filename, known_classes):
     ]
 
     tree = ET.parse(filename)
-    # import pdb;pdb.set_trace()
     objects = []
     for obj in tree.findall('object'):
         obj_struct = {}
         cls_name = obj.find('name').text
         if cls_name in VOC_CLASS_NAMES_COCOFIED:
             cls_name = BASE_VOC_CLASS_NAMES[VOC_CLASS_NAMES_COCOFIED.index(cls_name)]
-        if cls_name not in known_classes:
-            cls_name = 'unknown'
         obj_struct['name'] = cls_name
         obj_struct['difficult'] = int(obj.find('difficult').text)
         bbox = obj.find('bndbox')
@@ -285,6 +549,203 @@ def parse_rec(filename, known_classes):
     return objects
 
 
+@functools.lru_cache(maxsize=None)
+def parse_rec(filename, known_classes):
+    """ Parse a PASCAL VOC xml file """
+    objects = parse_objects(filename)
+    for obj_struct in objects:
+        if obj_struct['name'] not in known_classes:
+            obj_struct['name'] = 'unknown'
+    return objects
+
+
+class VOCGTIndex:
+    """
+    Columnar index of the ground truth of an image set.
+
+    All objects are stored in flat arrays (boxes, class name ids, difficult flags) grouped by image,
+    with offsets[i]:offsets[i + 1] the objects of image i. Per-class views are sliced from it
+    without touching the XML files again, and the index is saved next to the ImageSets split
+    so that later runs load it instead of parsing the annotations.
+    """
+    VERSION = 1
+
+    def __init__(self, image_names, names, name_ids, boxes, difficult, offsets):
+        self.image_names = list(image_names)
+        self.names = list(names)
+        self.name_ids = name_ids
+        self.boxes = boxes
+        self.difficult = difficult
+        self.offsets = offsets
+        self._object_classes = {}
+
+    def __len__(self):
+        return len(self.image_names)
+
+    @classmethod
+    def build(cls, image_names, annotations):
+        names, name_ids, boxes, difficult, counts = {}, [], [], [], []
+        for annotation in annotations:
+            objects = parse_objects(annotation)
+            counts.append(len(objects))
+            for obj in objects:
+                name_ids.append(names.setdefault(obj['name'], len(names)))
+                boxes.append(obj['bbox'])
+                difficult.append(obj['difficult'])
+        return cls(image_names, names, np.array(name_ids, dtype=np.int64),
+                   np.array(boxes, dtype=np.float64).reshape(-1, 4), np.array(difficult, dtype=bool),
+                   np.concatenate(([0], np.cumsum(counts))).astype(np.int64))
+
+    @staticmethod
+    def cache_path(split_file):
+        return os.path.splitext(split_file)[0] + '.gt_index.npz'
+
+    @staticmethod
+    def _annotations_mtime(annotations):
+        return max((os.path.getmtime(a) for a in annotations), default=0.)
+
+    def save(self, path, annotations_mtime):
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, version=self.VERSION, mtime=annotations_mtime, image_names=np.array(self.image_names),
+                 names=np.array(self.names), name_ids=self.name_ids, boxes=self.boxes, difficult=self.difficult,
+                 offsets=self.offsets)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, image_names=None, annotations_mtime=None):
+        """Load a saved index, None if it is missing or stale."""
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as f:
+            if int(f['version']) != cls.VERSION:
+                return None
+            if annotations_mtime is not None and float(f['mtime']) != annotations_mtime:
+                return None
+            if image_names is not None and f['image_names'].tolist() != list(image_names):
+                return None
+            return cls(f['image_names'].tolist(), f['names'].tolist(), f['name_ids'], f['boxes'],
+                       f['difficult'], f['offsets'])
+
+    @classmethod
+    def from_dataset(cls, voc_gt, save=True):
+        """Load the index of voc_gt's image set from disk, building (and saving) it when needed."""
+        split_file = getattr(voc_gt, 'split_file', None)
+        if split_file is None:
+            return cls.build(voc_gt.image_set, voc_gt.annotations)
+        path = cls.cache_path(split_file)
+        mtime = cls._annotations_mtime(voc_gt.annotations)
+        index = cls.load(path, voc_gt.image_set, mtime)
+        if index is None:
+            index = cls.build(voc_gt.image_set, voc_gt.annotations)
+            if save and is_main_process():
+                try:
+                    index.save(path, mtime)
+                except OSError as e:
+                    logging.warning(f'could not save the ground truth index to {path}: {e}')
+        return index
+
+    def object_classes(self, known_classes):
+        """Class name of every object, objects whose class is not in known_classes are named 'unknown'."""
+        key = tuple(known_classes)
+        if key not in self._object_classes:
+            mapped = np.array([n if n in key else 'unknown' for n in self.names] + ['unknown'])
+            self._object_classes[key] = mapped[self.name_ids]
+        return self._object_classes[key]
+
+    def class_ids(self, known_classes, class_names):
+        """Index in class_names of the class of every object."""
+        names, inverse = np.unique(self.object_classes(known_classes), return_inverse=True)
+        lookup = {c: i for i, c in enumerate(class_names)}
+        return np.array([lookup[c] for c in names.tolist()], dtype=np.int64)[inverse.reshape(-1)]
+
+    def class_view(self, classname, known_classes):
+        """(boxes, difficult, offsets, npos) of one class, in the format of class_gt."""
+        return gt_view(self.boxes, self.difficult, self.offsets, self.object_classes(known_classes) == classname)
+
+
+def gt_view(boxes, difficult, image_offsets, mask):
+    """Select the objects in mask from flat per-image grouped ground truth, in the format of class_gt."""
+    offsets = np.concatenate(([0], np.cumsum(mask)))[image_offsets].astype(np.int64)
+    difficult = difficult[mask]
+    return boxes[mask], difficult, offsets, int(np.sum(~difficult))
+
+
+def match_image(det_cls, det_score, det_box, gt_box, gt_difficult, gt_cls, unknown_ind, ovthresh):
+    """
+    Match the detections of a single image against its ground truth, for all classes and IoU thresholds.
+    Detections only match ground truth of their own class, so one IoU matrix serves every class.
+    Returns:
+        order: the detections sorted by decreasing score, the order of the flags below
+        tp, fp, is_unk: [N, len(ovthresh)] TP / FP flags and overlap with an unknown object
+    """
+    order = np.argsort(-det_score, kind='stable')
+    det_cls, det_box = det_cls[order], det_box[order]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # overlaps with boxes of other classes are discarded, don't warn about their degenerate unions
+        overlaps = voc_iou(det_box, gt_box)
+    class_overlaps = np.where(det_cls[:, None] == gt_cls[None, :], overlaps, -np.inf)
+    ovmax = class_overlaps.max(1, initial=-np.inf)
+    jmax = class_overlaps.argmax(1) if len(gt_cls) else np.zeros(len(det_cls), dtype=np.int64)
+    unk_ovmax = np.where(gt_cls[None, :] == unknown_ind, overlaps, -np.inf).max(1, initial=-np.inf)
+    tp, fp = zip(*[greedy_tp_fp(ovmax, jmax, gt_difficult, thresh) for thresh in ovthresh])
+    is_unk = unk_ovmax[:, None] > np.asarray(ovthresh)[None, :]
+    return order, np.stack(tp, 1).astype(bool), np.stack(fp, 1).astype(bool), is_unk
+
+
+def evaluate_class(arrays, class_ind, unknown_ind, ovthresh=0.5, use_07_metric=False):
+    """voc_eval_detections for one class, reading detections and ground truth from OWEvaluator.eval_arrays()."""
+    d0, d1 = arrays['det_offsets'][class_ind], arrays['det_offsets'][class_ind + 1]
+    gt = [arrays['gt_boxes'], arrays['gt_difficult'], arrays['gt_offsets']]
+    return voc_eval_detections(arrays['det_image'][d0:d1], arrays['det_score'][d0:d1], arrays['det_box'][d0:d1],
+                               gt_view(*gt, arrays['gt_class'] == class_ind),
+                               gt_view(*gt, arrays['gt_class'] == unknown_ind), ovthresh=ovthresh,
+                               use_07_metric=use_07_metric, is_unknown_class=class_ind == unknown_ind)
+
+
+class SharedArrays:
+    """
+    Copies of numpy arrays in shared memory. Pool workers attach to them by name (see attach)
+    instead of receiving pickled copies with every task.
+    """
+
+    def __init__(self, arrays):
+        self._shms = []
+        self.specs = {}
+        for k, a in arrays.items():
+            a = np.ascontiguousarray(a)
+            shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+            np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)[...] = a
+            self._shms.append(shm)
+            self.specs[k] = (shm.name, a.shape, a.dtype.str)
+
+    @staticmethod
+    def attach(specs):
+        shms, arrays = [], {}
+        for k, (name, shape, dtype) in specs.items():
+            shm = shared_memory.SharedMemory(name=name)
+            shms.append(shm)
+            arrays[k] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        return shms, arrays
+
+    def close(self):
+        for shm in self._shms:
+            shm.close()
+            shm.unlink()
+        self._shms = []
+
+
+_class_worker_state = {}
+
+
+def _init_class_worker(specs, kwargs):
+    shms, arrays = SharedArrays.attach(specs)
+    _class_worker_state.update(shms=shms, arrays=arrays, kwargs=kwargs)
+
+
+def _class_worker(class_ind):
+    return evaluate_class(_class_worker_state['arrays'], class_ind, **_class_worker_state['kwargs'])
+
+
 def voc_eval(detpath,
              annopath,
              imagesetfile,
@@ -317,25 +778,6 @@ def voc_eval(detpath,
         (default False)
     """
 
-    def iou(BBGT, bb):
-        ixmin = np.maximum(BBGT[:, 0], bb[0])
-        iymin = np.maximum(BBGT[:, 1], bb[1])
-        ixmax = np.minimum(BBGT[:, 2], bb[2])
-        iymax = np.minimum(BBGT[:, 3], bb[3])
-        iw = np.maximum(ixmax - ixmin + 1., 0.)
-        ih = np.maximum(iymax - iymin + 1., 0.)
-        inters = iw * ih
-
-        # union
-        uni = ((bb[2] - bb[0] + 1.) * (bb[3] - bb[1] + 1.) +
-               (BBGT[:, 2] - BBGT[:, 0] + 1.) *
-               (BBGT[:, 3] - BBGT[:, 1] + 1.) - inters)
-
-        overlaps = inters / uni
-        ovmax = np.max(overlaps)
-        jmax = np.argmax(overlaps)
-        return ovmax, jmax
-
     # assumes detections are in detpath.format(classname)
     # assumes annotations are in annopath.format(imagename)
     # assumes imagesetfile is a text file with each line an image name
@@ -349,30 +791,8 @@ def voc_eval(detpath,
             lines = f.readlines()
     imagenames = [x.strip() for x in lines]
 
-    # import pdb;pdb.set_trace()
     # load annots
-    recs = {}
-    if isinstance(annopath, list):
-        # print("hi")
-        for a in annopath:
-            imagename = os.path.splitext(os.path.basename(a))[0]
-            recs[imagename] = parse_rec(a, tuple(known_classes))
-    else:
-        for i, imagename in enumerate(imagenames):
-            recs[imagename] = parse_rec(annopath.format(imagename), tuple(known_classes))
-
-    # extract gt objects for this class
-    class_recs = {}
-    npos = 0
-    for imagename in imagenames:
-        R = [obj for obj in recs[imagename] if obj['name'] == classname]
-        bbox = np.array([x['bbox'] for x in R])
-        difficult = np.array([x['difficult'] for x in R]).astype(np.bool)
-        det = [False] * len(R)
-        npos = npos + sum(~difficult)
-        class_recs[imagename] = {'bbox': bbox,
-                                 'difficult': difficult,
-                                 'det': det}
+    recs = load_recs(annopath, known_classes, imagenames)
 
     # read dets
     if isinstance(detpath, list):
@@ -382,48 +802,84 @@ def voc_eval(detpath,
         with open(detfile, 'r') as f:
             lines = f.readlines()
 
-    # import pdb;pdb.set_trace()
     splitlines = [x.strip().split(' ') for x in lines]
-    image_ids = [x[0] for x in splitlines]
+    image_index = {imagename: i for i, imagename in enumerate(imagenames)}
+    det_image = np.array([image_index[x[0]] for x in splitlines], dtype=np.int64)
     confidence = np.array([float(x[1]) for x in splitlines])
-    if len(splitlines) == 0:
-        BB = np.array([[float(z) for z in x[2:]] for x in splitlines]).reshape(-1, 4)
-    else:
-        BB = np.array([[float(z) for z in x[2:]] for x in splitlines])#.reshape(-1, 4)
+    BB = np.array([[float(z) for z in x[2:]] for x in splitlines]).reshape(-1, 4)
 
-    # if BB.size == 0:
-    #     return 0, 0, 0
+    return voc_eval_detections(det_image, confidence, BB, class_gt(recs, imagenames, classname),
+                               class_gt(recs, imagenames, 'unknown'), ovthresh=ovthresh,
+                               use_07_metric=use_07_metric, is_unknown_class=classname == 'unknown')
+
+
+def load_recs(annopath, known_classes, imagenames=None):
+    """Parse the annotations of every image, keyed by image name."""
+    if isinstance(annopath, list):
+        return {os.path.splitext(os.path.basename(a))[0]: parse_rec(a, tuple(known_classes)) for a in annopath}
+    return {imagename: parse_rec(annopath.format(imagename), tuple(known_classes)) for imagename in imagenames}
+
+
+def class_gt(recs, imagenames, classname):
+    """
+    Flatten the ground truth of one class over imagenames.
+    Returns boxes [G, 4], difficult [G], offsets [num_images + 1] (image i owns boxes offsets[i]:offsets[i + 1])
+    and the number of non-difficult objects.
+    """
+    boxes, difficult = [], []
+    for imagename in imagenames:
+        R = [obj for obj in recs[imagename] if obj['name'] == classname]
+        boxes.append(np.array([x['bbox'] for x in R], dtype=float).reshape(-1, 4))
+        difficult.append(np.array([x['difficult'] for x in R], dtype=bool))
+    offsets = np.concatenate(([0], np.cumsum([len(b) for b in boxes]))).astype(np.int64)
+    boxes = np.concatenate(boxes) if boxes else np.zeros((0, 4))
+    difficult = np.concatenate(difficult) if difficult else np.zeros(0, dtype=bool)
+    return boxes, difficult, offsets, int(np.sum(~difficult))
+
+
+def voc_eval_detections(det_image, confidence, BB, gt, unk_gt, ovthresh=0.5, use_07_metric=False,
+                        is_unknown_class=False):
+    """
+    Array version of voc_eval.
+    Args:
+        det_image: [N] image index of every detection
+        confidence: [N] detection scores
+        BB: [N, 4] detection boxes (VOC convention, 1-based xmin/ymin)
+        gt, unk_gt: (boxes, difficult, offsets, npos) of the evaluated class and of the unknown class,
+            as returned by class_gt
+        ovthresh: overlap threshold, or a list of thresholds. The overlaps are computed once and
+            shared by all thresholds.
+    Returns:
+        rec, prec, ap, is_unk_sum, n_unk, tp_plus_fp_closed_set, fp_open_set
+        (a list of these, one per threshold, if ovthresh is a list)
+    """
+    gt_boxes, gt_difficult, gt_offsets, npos = gt
+    unk_boxes, _, unk_offsets, n_unk = unk_gt
 
     # sort by confidence
     sorted_ind = np.argsort(-confidence)
     BB = BB[sorted_ind, :]
+    det_image = det_image[sorted_ind]
+
+    ovmax, jmax = max_overlaps(det_image, BB, gt_boxes, gt_offsets)
+    # Go down each detection and see if it has an overlap with an unknown object.
+    # If so, it is an unknown object that was classified as known.
+    unk_ovmax = None if is_unknown_class else max_overlaps(det_image, BB, unk_boxes, unk_offsets)[0]
+
+    results = []
+    for thresh in np.atleast_1d(ovthresh).tolist():
+        # go down dets and mark TPs and FPs
+        tp, fp = greedy_tp_fp(ovmax, jmax, gt_difficult, thresh)
+        is_unk = None if unk_ovmax is None else (unk_ovmax > thresh).astype(np.float64)
+        results.append(voc_curves(tp, fp, is_unk, npos, n_unk, use_07_metric))
+    return results if np.ndim(ovthresh) else results[0]
 
-    # import pdb;pdb.set_trace()
-    image_ids = [image_ids[x] for x in sorted_ind]
-
-    # go down dets and mark TPs and FPs
-    nd = len(image_ids)
-    tp = np.zeros(nd)
-    fp = np.zeros(nd)
-    for d in range(nd):
-        R = class_recs[image_ids[d]]
-        bb = BB[d, :].astype(float)
-        ovmax = -np.inf
-        BBGT = R['bbox'].astype(float)
-
-        if BBGT.size > 0:
-            ovmax, jmax = iou(BBGT, bb)
-
-        if ovmax > ovthresh:
-            if not R['difficult'][jmax]:
-                if not R['det'][jmax]:
-                    tp[d] = 1.
-                    R['det'][jmax] = 1
-                else:
-                    fp[d] = 1.
-        else:
-            fp[d] = 1.
 
+def voc_curves(tp, fp, is_unk, npos, n_unk, use_07_metric=False):
+    """
+    Precision/recall curves, AP and open-set statistics from the per-detection TP/FP and
+    unknown-overlap flags of score-sorted detections. is_unk is None for the unknown class.
+    """
     # compute precision recall
     fp = np.cumsum(fp)
     tp = np.cumsum(tp)
@@ -439,62 +895,13 @@ def voc_eval(detpath,
     Absolute OSE = # of unknown objects classified as known objects of class 'classname'
     WI = FP_openset / (TP_closed_set + FP_closed_set)
     '''
-    # logger = logging.getLogger(__name__)
-
-    # Finding GT of unknown objects
-    unknown_class_recs = {}
-    n_unk = 0
-    for imagename in imagenames:
-        R = [obj for obj in recs[imagename] if obj["name"] == 'unknown']
-        bbox = np.array([x["bbox"] for x in R])
-        difficult = np.array([x["difficult"] for x in R]).astype(np.bool)
-        det = [False] * len(R)
-        n_unk = n_unk + sum(~difficult)
-        unknown_class_recs[imagename] = {"bbox": bbox, "difficult": difficult, "det": det}
-
-    if classname == 'unknown':
+    if is_unk is None:
         return rec, prec, ap, 0., n_unk, None, None
 
-    # Go down each detection and see if it has an overlap with an unknown object.
-    # If so, it is an unknown object that was classified as known.
-    is_unk = np.zeros(nd)
-    for d in range(nd):
-        R = unknown_class_recs[image_ids[d]]
-        bb = BB[d, :].astype(float)
-        ovmax = -np.inf
-        BBGT = R["bbox"].astype(float)
-
-        if BBGT.size > 0:
-            # compute overlaps
-            # intersection
-            ixmin = np.maximum(BBGT[:, 0], bb[0])
-            iymin = np.maximum(BBGT[:, 1], bb[1])
-            ixmax = np.minimum(BBGT[:, 2], bb[2])
-            iymax = np.minimum(BBGT[:, 3], bb[3])
-            iw = np.maximum(ixmax - ixmin + 1.0, 0.0)
-            ih = np.maximum(iymax - iymin + 1.0, 0.0)
-            inters = iw * ih
-
-            # union
-            uni = (
-                (bb[2] - bb[0] + 1.0) * (bb[3] - bb[1] + 1.0)
-                + (BBGT[:, 2] - BBGT[:, 0] + 1.0) * (BBGT[:, 3] - BBGT[:, 1] + 1.0)
-                - inters
-            )
-
-            overlaps = inters / uni
-            ovmax = np.max(overlaps)
-            jmax = np.argmax(overlaps)
-
-        if ovmax > ovthresh:
-            is_unk[d] = 1.0
-
     is_unk_sum = np.sum(is_unk)
     tp_plus_fp_closed_set = tp+fp
     fp_open_set = np.cumsum(is_unk)
 
-    # import pdb;pdb.set_trace()
-
     return rec, prec, ap, is_unk_sum, n_unk, tp_plus_fp_closed_set, fp_open_set
 
 
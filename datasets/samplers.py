@@ -8,9 +8,15 @@
 
 import os
 import math
+import bisect
+from collections import defaultdict
+
+import numpy as np
 import torch
 import torch.distributed as dist
-from torch.utils.data.sampler import Sampler
+from torch.utils.data.sampler import BatchSampler, Sampler
+
+from datasets.transforms import get_size_with_aspect_ratio
 
 
 class DistributedSampler(Sampler):
@@ -137,3 +143,55 @@ class NodeDistributedSampler(Sampler):
 
     def set_epoch(self, epoch):
         self.epoch = epoch
+
+
+def create_aspect_ratio_groups(image_sizes, k=0):
+    """
+    Aspect ratio group of every image, given its (width, height): the 2 * k + 2 bins of height / width
+    delimited by 2 ** linspace(-1, 1, 2 * k + 1). k = 0 only separates landscape from portrait images.
+    """
+    bins = (2 ** np.linspace(-1, 1, 2 * k + 1)).tolist() if k > 0 else [1.0]
+    return [bisect.bisect_right(bins, h / w) for w, h in image_sizes]
+
+
+class GroupedBatchSampler(BatchSampler):
+    """
+    Wraps a sampler (RandomSampler, DistributedSampler, NodeDistributedSampler, ...) and yields batches of indices
+    of the same group, e.g. the aspect ratio groups of create_aspect_ratio_groups, so that the images of a batch
+    need little padding. A batch is yielded as soon as its group has batch_size indices, which keeps the order of
+    the wrapped sampler (its shuffling and set_epoch) up to the batch level. The indices left over at the end are
+    batched together, ordered by group, so there are as many batches as with BatchSampler and no index is repeated.
+    """
+
+    def __init__(self, sampler, group_ids, batch_size, drop_last):
+        super().__init__(sampler, batch_size, drop_last)
+        self.group_ids = group_ids
+
+    def __iter__(self):
+        buffers = defaultdict(list)
+        for idx in self.sampler:
+            group_id = self.group_ids[idx]
+            buffers[group_id].append(idx)
+            if len(buffers[group_id]) == self.batch_size:
+                yield buffers.pop(group_id)
+
+        leftovers = [idx for group_id in sorted(buffers) for idx in buffers[group_id]]
+        for start in range(0, len(leftovers), self.batch_size):
+            batch = leftovers[start:start + self.batch_size]
+            if self.drop_last and len(batch) < self.batch_size:
+                break
+            yield batch
+
+
+def padding_ratio(batch_sampler, image_sizes, min_size=800, max_size=1333):
+    """
+    Fraction of the pixels of the padded batches of one pass of batch_sampler that are padding, for the images of
+    (width, height) image_sizes resized as by the test transform (shorter side min_size, longer side at most max_size).
+    """
+    resized = [get_size_with_aspect_ratio(size, min_size, max_size) for size in image_sizes]
+    valid = padded = 0
+    for batch in batch_sampler:
+        sizes = np.array([resized[idx] for idx in batch])
+        valid += sizes.prod(1).sum()
+        padded += len(batch) * sizes.max(0).prod()
+    return 1 - valid / padded if padded else 0.0
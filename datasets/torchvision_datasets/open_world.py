@@ -144,6 +144,7 @@ class OWDetection(VisionDataset):
         annotation_dir = os.path.join(self.root, 'Annotations')
         image_dir = os.path.join(self.root, 'JPEGImages')
 
+        self.split_file = self.split_path(image_set, self.root)
         file_names = self.extract_fns(image_set, self.root)
         if image_set == 'voc2007_trainval':
             print('PASCAL-VOC2007 dataset used; clearing images with missing object classes')
@@ -225,10 +226,29 @@ class OWDetection(VisionDataset):
             instances.append(instance)
         return target, instances
 
-    def extract_fns(self, image_set, voc_root):
+    def get_image_sizes(self):
+        """(width, height) of every image, from the size field of its annotation or, if missing, the image header."""
+        sizes = []
+        for image, annotation in zip(self.images, self.annotations):
+            width = height = 0
+            # the size field comes before the objects, no need to parse them
+            for _, elem in ET.iterparse(annotation):
+                if elem.tag == 'size':
+                    width, height = int(float(elem.findtext('width', 0))), int(float(elem.findtext('height', 0)))
+                    break
+            if width <= 0 or height <= 0:
+                with Image.open(image) as img:
+                    width, height = img.size
+            sizes.append((width, height))
+        return sizes
+
+    def split_path(self, image_set, voc_root):
         splits_dir = os.path.join(voc_root, 'ImageSets')
         splits_dir = os.path.join(splits_dir, self.dataset)
-        split_f = os.path.join(splits_dir, image_set.rstrip('\n') + '.txt')
+        return os.path.join(splits_dir, image_set.rstrip('\n') + '.txt')
+
+    def extract_fns(self, image_set, voc_root):
+        split_f = self.split_path(image_set, voc_root)
         with open(os.path.join(split_f), "r") as f:
             file_names = [x.strip() for x in f.readlines()]
         return file_names
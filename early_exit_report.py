@@ -0,0 +1,81 @@
+# ------------------------------------------------------------------------
+# PROB: Probabilistic Objectness for Open World Object Detection
+# Orr Zohar, Jackson Wang, Serena Yeung
+# ------------------------------------------------------------------------
+
+"""
+Evaluates a checkpoint with the decoder early exit (see --early_exit_tol) for several tolerances, and reports
+the model latency per image, the mean number of decoder layers run and the K-AP50 and U-Recall50 of each,
+tolerance 0 running every layer. Takes the dataset and model arguments of main_open_world.py, e.g.
+python early_exit_report.py --dataset TOWOD --PREV_INTRODUCED_CLS 0 --CUR_INTRODUCED_CLS 20 \
+    --test_set 'owod_all_task_test' --pretrain exps/MOWODB/PROB/t1.pth --report_tols 0 0.01 0.05 --wandb_project ""
+"""
+import argparse
+import json
+
+import torch
+from torch.utils.data import DataLoader, SequentialSampler, Subset
+
+import util.misc as utils
+from datasets.coco import make_coco_transforms
+from datasets.torchvision_datasets.open_world import OWDetection
+from engine import evaluate_timed
+from main_open_world import get_args_parser as get_main_args_parser
+from models import build_model
+from models.prob_deformable_detr import DecoderEarlyExit
+
+REPORT_METRICS = ('K_AP50', 'U_R50')
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('PROB decoder early exit report', add_help=False)
+    parser.add_argument('--report_tols', default=[0, 0.01, 0.02, 0.05, 0.1], type=float, nargs='+',
+                        help='early exit tolerances to evaluate, 0 runs every decoder layer')
+    parser.add_argument('--report_images', default=0, type=int,
+                        help='evaluate the first N test images only, 0 for all. Recall is still computed against '
+                             'the ground truth of the whole test set, only the differences between tolerances are meaningful')
+    parser.add_argument('--report_output', default='', type=str, help='json file the report is written to')
+    return parser
+
+
+def main(args):
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+
+    model, _, postprocessors, _ = build_model(args, mode=args.model_type)
+    checkpoint_path = args.resume or args.pretrain
+    if checkpoint_path:
+        checkpoint = torch.load(checkpoint_path, map_location='cpu')
+        print(model.load_state_dict(checkpoint['model'], strict=False))
+    model.to(device)
+    if device.type == 'cpu':
+        print('threads: {}'.format(utils.setup_cpu_inference(args.cpu_threads)))
+        model.backbone[0].use_channels_last()
+
+    dataset_val = OWDetection(args, args.data_root, image_set=args.test_set, dataset=args.dataset,
+                              transforms=make_coco_transforms(args.test_set))
+    dataset = Subset(dataset_val, range(min(args.report_images, len(dataset_val)))) if args.report_images else dataset_val
+    data_loader = DataLoader(dataset, args.batch_size, sampler=SequentialSampler(dataset), drop_last=False,
+                             collate_fn=utils.collate_fn, num_workers=args.num_workers)
+
+    report = {'images': len(dataset), 'tolerances': []}
+    for tol in args.report_tols:
+        model.early_exit = DecoderEarlyExit(postprocessors['bbox'], tol) if tol > 0 else None
+        latency, metrics = evaluate_timed(model, postprocessors, data_loader, dataset_val, args)
+        mean_layers = model.early_exit.stats()['mean_layers'] if tol > 0 else float(args.dec_layers)
+        report['tolerances'].append(dict(tol=tol, ms_per_image=latency, mean_layers=mean_layers,
+                                         **{k: float(metrics[k]) for k in REPORT_METRICS}))
+
+    print('\t'.join(['tol', 'ms/image', 'layers'] + list(REPORT_METRICS)))
+    for r in report['tolerances']:
+        print('\t'.join(['{:g}'.format(r['tol']), '{:.1f}'.format(r['ms_per_image']), '{:.2f}'.format(r['mean_layers'])] +
+                        ['{:.4f}'.format(r[k]) for k in REPORT_METRICS]))
+    if args.report_output:
+        with open(args.report_output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('PROB decoder early exit report', parents=[get_main_args_parser(), get_args_parser()])
+    args = parser.parse_args()
+    main(args)
@@ -13,6 +13,7 @@ Train and eval functions used in main.py
 import math
 import os
 import sys
+import time
 from typing import Iterable
  
 import torch
@@ -23,6 +24,7 @@ from datasets.panoptic_eval import PanopticEvaluator
 from datasets.data_prefetcher import data_prefetcher
 from util.box_ops import box_xyxy_to_cxcywh, box_cxcywh_to_xyxy
 from util.plot_utils import plot_prediction
+from util.output_store import OutputWriter
 import matplotlib.pyplot as plt
 from copy import deepcopy
 
@@ -88,6 +90,8 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
         metric_logger.update(class_error=loss_dict_reduced['class_error'])
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
         metric_logger.update(grad_norm=grad_total_norm)
+        # fraction of the batch that is padding
+        metric_logger.update(padding=samples.mask.float().mean().item())
         
         samples, targets = prefetcher.next()
     # gather the stats from all processes
@@ -95,6 +99,32 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
     print("Averaged stats:", metric_logger)
     return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
 
+@torch.no_grad()
+def evaluate_timed(model, postprocessors, data_loader, base_ds, args):
+    """
+    Returns the mean model latency in ms/image (the first batch is not timed) and the OWEvaluator metrics.
+    """
+    model.eval()
+    device = next(model.parameters()).device
+    evaluator = OWEvaluator(base_ds, ('bbox',), args=args)
+    model_time, num_timed = 0.0, 0
+    for i, (samples, targets) in enumerate(data_loader):
+        samples = samples.to(device)
+        start_time = time.time()
+        outputs = model(samples)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        if i > 0:
+            model_time += time.time() - start_time
+            num_timed += len(targets)
+        orig_target_sizes = torch.stack([t["orig_size"] for t in targets], dim=0).to(device)
+        results = postprocessors['bbox'](outputs, orig_target_sizes)
+        evaluator.update({target['image_id'].item(): output for target, output in zip(targets, results)})
+    evaluator.synchronize_between_processes()
+    evaluator.accumulate()
+    return 1000 * model_time / max(num_timed, 1), evaluator.summarize()
+
+
 ## ORIGINAL FUNCTION
 @torch.no_grad()
 def evaluate(model, criterion, postprocessors, data_loader, base_ds, device, output_dir, args):
@@ -112,13 +142,22 @@ def evaluate(model, criterion, postprocessors, data_loader, base_ds, device, out
             data_loader.dataset.ann_folder,
             output_dir=os.path.join(output_dir, "panoptic_eval"),
         )
+
+    output_writer = None
+    if getattr(args, 'dump_outputs', ''):
+        # raw outputs, to re-run PostProcess and the evaluation offline (see rescore_open_world.py)
+        output_writer = OutputWriter(args.dump_outputs, len(data_loader.batch_sampler.sampler), rank=utils.get_rank())
  
     for samples, targets in metric_logger.log_every(data_loader, 10, header):
+        metric_logger.update(padding=samples.mask.float().mean().item())
         samples = samples.to(device)
         targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
         outputs = model(samples)
 
         orig_target_sizes = torch.stack([t["orig_size"] for t in targets], dim=0)
+        if output_writer is not None:
+            # before PostProcess, which masks the invalid class logits in place
+            output_writer.append(outputs, orig_target_sizes, [t['image_id'].item() for t in targets])
         results = postprocessors['bbox'](outputs, orig_target_sizes)
  
         if 'segm' in postprocessors.keys():
@@ -138,6 +177,9 @@ def evaluate(model, criterion, postprocessors, data_loader, base_ds, device, out
  
             panoptic_evaluator.update(res_pano)
  
+    if output_writer is not None:
+        output_writer.close()
+
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     # print("Averaged stats:", metric_logger)
@@ -155,6 +197,14 @@ def evaluate(model, criterion, postprocessors, data_loader, base_ds, device, out
         panoptic_res = panoptic_evaluator.summarize()
     stats = {k: meter.global_avg for k, meter in metric_logger.meters.items()}
     stats['metrics']=res
+    shape_cache = getattr(getattr(model, 'module', model), 'shape_cache', None)
+    if shape_cache is not None:
+        print('shape cache: {}'.format(shape_cache))
+        stats['shape_cache'] = shape_cache.stats()
+    early_exit = getattr(getattr(model, 'module', model), 'early_exit', None)
+    if early_exit is not None:
+        print('decoder early exit: {}'.format(early_exit.stats()))
+        stats['early_exit'] = early_exit.stats()
     if coco_evaluator is not None:
         if 'bbox' in postprocessors.keys():
             stats['coco_eval_bbox'] = coco_evaluator.coco_eval['bbox'].stats.tolist()
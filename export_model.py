@@ -0,0 +1,119 @@
+# ------------------------------------------------------------------------
+# PROB: Probabilistic Objectness for Open World Object Detection
+# Orr Zohar, Jackson Wang, Serena Yeung
+# ------------------------------------------------------------------------
+
+"""
+Exports the detector and its PostProcess (objectness scaling, invalid class masking, top-k) as an inference-only
+TorchScript or ONNX graph, with inputs (images, image_sizes, orig_sizes) and outputs (scores, labels, boxes),
+see ExportableDetector. The graph is traced on CPU for a fixed padded batch shape (--export_batch_size, --export_size):
+smaller images are padded to it and their size given in image_sizes.
+Takes the model arguments of main_open_world.py, e.g.
+python export_model.py --pretrain exps/MOWODB/PROB/t1.pth --PREV_INTRODUCED_CLS 0 --CUR_INTRODUCED_CLS 20 \
+    --export_output exps/prob_t1.pt --export_check --wandb_project ""
+"""
+import argparse
+
+import torch
+
+import util.misc as utils
+from main_open_world import get_args_parser as get_main_args_parser
+from models import build_model
+from models.prob_deformable_detr import ExportableDetector
+
+INPUT_NAMES = ['images', 'image_sizes', 'orig_sizes']
+OUTPUT_NAMES = ['scores', 'labels', 'boxes']
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('PROB export', add_help=False)
+    parser.add_argument('--export_format', default='torchscript', choices=['torchscript', 'onnx'])
+    parser.add_argument('--export_output', required=True, type=str)
+    parser.add_argument('--export_batch_size', default=1, type=int)
+    parser.add_argument('--export_size', default=[800, 1333], type=int, nargs=2,
+                        help='height and width of the padded batch the graph is traced for')
+    parser.add_argument('--onnx_opset', default=16, type=int)
+    parser.add_argument('--export_check', action='store_true',
+                        help='compare the exported graph with the eager model and PostProcess on random images')
+    return parser
+
+
+def random_images(batch_size, size, generator):
+    """Normalized random images, the first one of the padded size and the others smaller."""
+    height, width = size
+    images = [torch.randn(3, height, width, generator=generator)]
+    for _ in range(batch_size - 1):
+        h = int(torch.randint(height // 2, height + 1, (1,), generator=generator))
+        w = int(torch.randint(width // 2, width + 1, (1,), generator=generator))
+        images.append(torch.randn(3, h, w, generator=generator))
+    return images
+
+
+def export_inputs(images):
+    samples = utils.nested_tensor_from_tensor_list(images)
+    image_sizes = torch.tensor([img.shape[-2:] for img in images], dtype=torch.int64)
+    # boxes scaled to an arbitrary original size, e.g. before the test transform
+    orig_sizes = image_sizes * 3 // 5
+    return samples, image_sizes, orig_sizes
+
+
+def load_exported(args):
+    if args.export_format == 'torchscript':
+        module = torch.jit.load(args.export_output)
+        return lambda *inputs: module(*inputs)
+    import onnxruntime
+    session = onnxruntime.InferenceSession(args.export_output, providers=['CPUExecutionProvider'])
+    return lambda *inputs: [torch.from_numpy(out) for out in session.run(
+        OUTPUT_NAMES, {name: x.numpy() for name, x in zip(INPUT_NAMES, inputs)})]
+
+
+@torch.no_grad()
+def check_export(args, model, postprocess):
+    """
+    Runs the eager model on a NestedTensor of random images and the exported graph on the same padded batch,
+    and compares their scores, labels and boxes. Returns True if they match.
+    """
+    samples, image_sizes, orig_sizes = export_inputs(
+        random_images(args.export_batch_size, args.export_size, torch.Generator().manual_seed(args.seed + 1)))
+    results = postprocess(model(samples), orig_sizes)
+    expected = [torch.stack([r[k] for r in results]) for k in OUTPUT_NAMES]
+    exported = load_exported(args)(samples.tensors, image_sizes, orig_sizes)
+
+    max_err = {k: (e.double() - x.double()).abs().max().item() for k, e, x in zip(OUTPUT_NAMES, expected, exported)}
+    ok = torch.allclose(exported[0], expected[0], rtol=1e-4, atol=1e-5) and torch.equal(exported[1], expected[1]) \
+        and torch.allclose(exported[2], expected[2], rtol=1e-4, atol=1e-2)
+    print('* {} export check: max abs err scores {scores:.2e} labels {labels:.0f} boxes {boxes:.2e}'.format(ok, **max_err))
+    return ok
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    model, _, postprocessors, _ = build_model(args, mode=args.model_type)
+    checkpoint_path = args.resume or args.pretrain
+    if checkpoint_path:
+        checkpoint = torch.load(checkpoint_path, map_location='cpu')
+        print(model.load_state_dict(checkpoint['model'], strict=False))
+    model.eval()
+    exportable = ExportableDetector(model, postprocessors['bbox']).eval()
+
+    samples, image_sizes, orig_sizes = export_inputs(
+        random_images(args.export_batch_size, args.export_size, torch.Generator().manual_seed(args.seed))[:1]
+        * args.export_batch_size)
+    example_inputs = (samples.tensors, image_sizes, orig_sizes)
+    with torch.no_grad():
+        if args.export_format == 'torchscript':
+            torch.jit.trace(exportable, example_inputs, check_trace=False).save(args.export_output)
+        else:
+            torch.onnx.export(exportable, example_inputs, args.export_output, input_names=INPUT_NAMES,
+                              output_names=OUTPUT_NAMES, opset_version=args.onnx_opset)
+    print('exported {} graph for a {} batch to {}'.format(
+        args.export_format, tuple(samples.tensors.shape), args.export_output))
+
+    if args.export_check and not check_export(args, model, postprocessors['bbox']):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('PROB export', parents=[get_main_args_parser(), get_args_parser()])
+    args = parser.parse_args()
+    main(args)
@@ -22,12 +22,14 @@ import torch
 from torch.utils.data import DataLoader
 import datasets
 import util.misc as utils
+from util import box_ops
 import datasets.samplers as samplers
 from datasets import build_dataset, get_coco_api_from_dataset
 from datasets.coco import make_coco_transforms
 from datasets.torchvision_datasets.open_world import OWDetection
 from engine import evaluate, train_one_epoch, get_exemplar_replay
 from models import build_model
+from models.prob_deformable_detr import DecoderEarlyExit
 import wandb
 
 
@@ -93,11 +95,17 @@ def get_args_parser():
                         help="L1 box coefficient in the matching cost")
     parser.add_argument('--set_cost_giou', default=2, type=float,
                         help="giou box coefficient in the matching cost")
+    parser.add_argument('--matcher_threads', default=4, type=int,
+                        help="threads solving the assignment problems of all the layers and images concurrently, 0 for none")
+    parser.add_argument('--matcher_topk', default=0, type=int,
+                        help="match each target among the k queries of lowest class and L1 cost only, 0 for all queries")
     # Loss coefficients
     parser.add_argument('--cls_loss_coef', default=2, type=float)
     parser.add_argument('--bbox_loss_coef', default=5, type=float)
     parser.add_argument('--giou_loss_coef', default=2, type=float)
     parser.add_argument('--focal_alpha', default=0.25, type=float)
+    parser.add_argument('--check_boxes', action='store_true',
+                        help="check for degenerate boxes in the GIoU costs and losses (for debugging)")
     
     # dataset parameters
     parser.add_argument('--coco_panoptic_path', type=str)
@@ -106,6 +114,19 @@ def get_args_parser():
                         help='path where to save, empty for no saving')
     parser.add_argument('--device', default='cuda',
                         help='device to use for training / testing')
+    parser.add_argument('--cpu_threads', default=0, type=int,
+                        help='intra-op threads with --device cpu, 0 uses every available core')
+    parser.add_argument('--quantize_int8', action='store_true',
+                        help='evaluate with dynamic int8 linear layers (--device cpu only)')
+    parser.add_argument('--quant_keep_float', default=['sampling_offsets'], type=str, nargs='*',
+                        help='name keywords of the linear layers kept in float with --quantize_int8')
+    parser.add_argument('--early_exit_tol', default=0, type=float,
+                        help='--eval and the inference tools only: an image leaves the decoder once the scores and '
+                             'normalized boxes of its top predictions change by less than this from one layer to the '
+                             'next, 0 runs every layer')
+    parser.add_argument('--shape_cache_size', default=8, type=int,
+                        help='image size combinations whose position embeddings and reference points are kept '
+                             'for evaluation, 0 disables the cache')
     parser.add_argument('--seed', default=42, type=int)
     parser.add_argument('--resume', default='', help='resume from checkpoint')
     parser.add_argument('--start_epoch', default=0, type=int, metavar='N',
@@ -114,7 +135,13 @@ def get_args_parser():
     parser.add_argument('--viz', action='store_true')
     parser.add_argument('--eval_every', default=5, type=int)
     parser.add_argument('--num_workers', default=3, type=int)
+    parser.add_argument('--eval_workers', default=0, type=int, help='processes used to evaluate classes in parallel, 0 evaluates in the main process')
+    parser.add_argument('--eval_streaming', default=False, action='store_true', help='match predictions against the ground truth batch by batch during evaluation')
+    parser.add_argument('--dump_outputs', default='', type=str, help='directory the raw model outputs are written to during evaluation, for rescore_open_world.py')
     parser.add_argument('--cache_mode', default=False, action='store_true', help='whether to cache images on memory')
+    parser.add_argument('--aspect_ratio_group_factor', default=-1, type=int,
+                        help='batch images of similar aspect ratio together, in 2k+2 groups, to reduce padding. '
+                             '-1 disables the grouping')
     
     ################ OW-DETR ################
     parser.add_argument('--PREV_INTRODUCED_CLS', default=0, type=int)
@@ -174,6 +201,9 @@ def main(args):
 
     if args.frozen_weights is not None:
         assert args.masks, "Frozen training is meant for segmentation only"
+    if args.quantize_int8:
+        assert args.eval and args.device == 'cpu', "int8 quantization is meant for CPU evaluation only"
+    box_ops.check_boxes = args.check_boxes
     print(args)
 
     device = torch.device(args.device)
@@ -186,6 +216,9 @@ def main(args):
 
     model, criterion, postprocessors, exemplar_selection = build_model(args, mode = args.model_type)
     model.to(device)
+    if device.type == 'cpu':
+        print('CPU mode: {} threads, channels_last backbone'.format(utils.setup_cpu_inference(args.cpu_threads)))
+        model.backbone[0].use_channels_last()
 
     model_without_ddp = model
     print(model_without_ddp)
@@ -205,12 +238,17 @@ def main(args):
         sampler_train = torch.utils.data.RandomSampler(dataset_train)
         sampler_val = torch.utils.data.SequentialSampler(dataset_val)
 
-    batch_sampler_train = torch.utils.data.BatchSampler(sampler_train, args.batch_size, drop_last=True)
+    if args.aspect_ratio_group_factor >= 0:
+        batch_sampler_train = grouped_batch_sampler(args, 'train', dataset_train, sampler_train, drop_last=True)
+        batch_sampler_val = grouped_batch_sampler(args, 'val', dataset_val, sampler_val, drop_last=False)
+    else:
+        batch_sampler_train = torch.utils.data.BatchSampler(sampler_train, args.batch_size, drop_last=True)
+        batch_sampler_val = torch.utils.data.BatchSampler(sampler_val, args.batch_size, drop_last=False)
     data_loader_train = DataLoader(dataset_train, batch_sampler=batch_sampler_train,
                                    collate_fn=utils.collate_fn, num_workers=args.num_workers,
                                    pin_memory=True)
-    data_loader_val = DataLoader(dataset_val, args.batch_size, sampler=sampler_val,
-                                 drop_last=False, collate_fn=utils.collate_fn, num_workers=args.num_workers,
+    data_loader_val = DataLoader(dataset_val, batch_sampler=batch_sampler_val,
+                                 collate_fn=utils.collate_fn, num_workers=args.num_workers,
                                  pin_memory=True)
 
     # lr_backbone_names = ["backbone.0", "backbone.neck", "input_proj", "transformer.encoder"]
@@ -273,6 +311,9 @@ def main(args):
         print(msg)
         args.start_epoch = checkpoint['epoch'] + 1
         if args.eval:
+            attach_early_exit(args, model_without_ddp, postprocessors)
+            if args.quantize_int8:
+                model = utils.quantize_dynamic_int8(model_without_ddp, args.quant_keep_float)
             test_stats, coco_evaluator = evaluate(model, criterion, postprocessors, data_loader_val, base_ds, device, args.output_dir, args)
             return
         
@@ -312,6 +353,9 @@ def main(args):
                 model, criterion, postprocessors, data_loader_val, base_ds, device, args.output_dir, args
             )
         if args.eval:
+            attach_early_exit(args, model_without_ddp, postprocessors)
+            if args.quantize_int8:
+                model = utils.quantize_dynamic_int8(model_without_ddp, args.quant_keep_float)
             test_stats, coco_evaluator = evaluate(model, criterion, postprocessors, data_loader_val, base_ds, device, args.output_dir, args)
             if args.output_dir:
                 utils.save_on_master(coco_evaluator.coco_eval["bbox"].eval, output_dir / "eval.pth")
@@ -407,6 +451,35 @@ def get_datasets(args):
     return dataset_train, dataset_val
 
 
+def attach_early_exit(args, model, postprocessors):
+    """
+    Attaches the decoder early exit of --early_exit_tol to model. Only for evaluation (--eval) and the inference tools:
+    the model keeps it in every eval mode forward, which would otherwise also cut short the evaluation during training
+    and the exemplar selection.
+    """
+    if args.model_type == 'prob' and args.early_exit_tol > 0:
+        model.early_exit = DecoderEarlyExit(postprocessors['bbox'], args.early_exit_tol)
+
+
+def grouped_batch_sampler(args, name, dataset, sampler, drop_last):
+    """
+    Batches of images of similar aspect ratio (see --aspect_ratio_group_factor). Prints the fraction of padded pixels
+    of one epoch at the test scale, with and without the grouping.
+    """
+    image_sizes = dataset.get_image_sizes()
+    group_ids = samplers.create_aspect_ratio_groups(image_sizes, args.aspect_ratio_group_factor)
+    batch_sampler = samplers.GroupedBatchSampler(sampler, group_ids, args.batch_size, drop_last)
+    if isinstance(sampler, torch.utils.data.RandomSampler):
+        # a pass of RandomSampler draws from the global RNG, which would change the training order and everything
+        # seeded after it: estimate on a shuffle of its own
+        sampler = torch.utils.data.RandomSampler(dataset, generator=torch.Generator().manual_seed(args.seed))
+    print('{} batches: {:.3f} padded pixels without aspect ratio groups, {:.3f} with {} groups'.format(
+        name, samplers.padding_ratio(torch.utils.data.BatchSampler(sampler, args.batch_size, drop_last), image_sizes),
+        samplers.padding_ratio(samplers.GroupedBatchSampler(sampler, group_ids, args.batch_size, drop_last),
+                               image_sizes), len(set(group_ids))))
+    return batch_sampler
+
+
 def create_ft_dataset(args, image_sorted_scores):
     print(f'found a total of {len(image_sorted_scores.keys())} images')
     tmp_dir=args.data_root +'/ImageSets/'+args.dataset+"/"+args.exemplar_replay_dir+"/"
@@ -82,9 +82,19 @@ class BackboneBase(nn.Module):
             self.strides = [32]
             self.num_channels = [2048]
         self.body = IntermediateLayerGetter(backbone, return_layers=return_layers)
+        self.channels_last = False
+
+    def use_channels_last(self):
+        """Run the ResNet in channels_last memory format, faster for CPU (oneDNN) convolutions."""
+        self.body = self.body.to(memory_format=torch.channels_last)
+        self.channels_last = True
+        return self
 
     def forward(self, tensor_list: NestedTensor):
-        xs = self.body(tensor_list.tensors)
+        tensors = tensor_list.tensors
+        if self.channels_last:
+            tensors = tensors.contiguous(memory_format=torch.channels_last)
+        xs = self.body(tensors)
         out: Dict[str, NestedTensor] = {}
         for name, x in xs.items():
             m = tensor_list.mask
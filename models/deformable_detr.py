@@ -376,9 +376,9 @@ class SetCriterion(nn.Module):
         losses = {}
         losses['loss_bbox'] = loss_bbox.sum() / num_boxes
 
-        loss_giou = 1 - torch.diag(box_ops.generalized_box_iou(
+        loss_giou = 1 - box_ops.paired_generalized_box_iou(
             box_ops.box_cxcywh_to_xyxy(src_boxes),
-            box_ops.box_cxcywh_to_xyxy(target_boxes)))
+            box_ops.box_cxcywh_to_xyxy(target_boxes))
         losses['loss_giou'] = loss_giou.sum() / num_boxes
         return losses
 
@@ -462,7 +462,17 @@ class SetCriterion(nn.Module):
             loss_epoch = 0
 
         outputs_without_aux = {k: v for k, v in outputs.items() if k != 'aux_outputs' and k != 'enc_outputs'}
-        indices = self.matcher(outputs_without_aux, targets)
+        # the matching of every layer, all solved at once
+        layer_outputs = [outputs_without_aux] + outputs.get('aux_outputs', [])
+        layer_targets = [targets] * len(layer_outputs)
+        if 'enc_outputs' in outputs:
+            bin_targets = copy.deepcopy(targets)
+            for bt in bin_targets:
+                bt['labels'] = torch.zeros_like(bt['labels'])
+            layer_outputs.append(outputs['enc_outputs'])
+            layer_targets.append(bin_targets)
+        layer_indices = self.matcher.match_layers(layer_outputs, layer_targets)
+        indices = layer_indices[0]
     
         owod_targets = deepcopy(targets)
         owod_indices = deepcopy(indices)
@@ -528,7 +538,7 @@ class SetCriterion(nn.Module):
         # In case of auxiliary losses, we repeat this process with the output of each intermediate layer.
         if 'aux_outputs' in outputs:
             for i, aux_outputs in enumerate(outputs['aux_outputs']):
-                indices = self.matcher(aux_outputs, targets)
+                indices = layer_indices[i + 1]
 
                 owod_targets = deepcopy(targets)
                 owod_indices = deepcopy(indices)
@@ -591,10 +601,7 @@ class SetCriterion(nn.Module):
 
         if 'enc_outputs' in outputs:
             enc_outputs = outputs['enc_outputs']
-            bin_targets = copy.deepcopy(targets)
-            for bt in bin_targets:
-                bt['labels'] = torch.zeros_like(bt['labels'])
-            indices = self.matcher(enc_outputs, bin_targets)
+            indices = layer_indices[-1]
             for loss in self.losses:
                 if loss == 'masks':
                     # Intermediate masks losses are too costly to compute, we ignore them.
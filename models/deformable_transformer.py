@@ -16,7 +16,7 @@ import torch.nn.functional as F
 from torch import nn, Tensor
 from torch.nn.init import xavier_uniform_, constant_, uniform_, normal_
 
-from util.misc import inverse_sigmoid
+from util.misc import inverse_sigmoid, mask_sizes_key
 from models.ops.modules import MSDeformAttn
 
 from einops import rearrange
@@ -53,6 +53,8 @@ class DeformableTransformer(nn.Module):
             self.pos_trans_norm = nn.LayerNorm(d_model * 2)
         else:
             self.reference_points = nn.Linear(d_model, 2)
+        # optional util.misc.ShapeCache for get_mask_inputs, used in eval mode
+        self.shape_cache = None
 
         self._reset_parameters()
 
@@ -83,8 +85,8 @@ class DeformableTransformer(nn.Module):
         pos = torch.stack((pos[:, :, :, 0::2].sin(), pos[:, :, :, 1::2].cos()), dim=4).flatten(2)
         return pos
 
-    def gen_encoder_output_proposals(self, memory, memory_padding_mask, spatial_shapes):
-        N_, S_, C_ = memory.shape
+    def gen_output_proposals(self, memory_padding_mask, spatial_shapes):
+        N_ = memory_padding_mask.shape[0]
         base_scale = 4.0
         proposals = []
         _cur = 0
@@ -93,8 +95,8 @@ class DeformableTransformer(nn.Module):
             valid_H = torch.sum(~mask_flatten_[:, :, 0, 0], 1)
             valid_W = torch.sum(~mask_flatten_[:, 0, :, 0], 1)
 
-            grid_y, grid_x = torch.meshgrid(torch.linspace(0, H_ - 1, H_, dtype=torch.float32, device=memory.device),
-                                            torch.linspace(0, W_ - 1, W_, dtype=torch.float32, device=memory.device))
+            grid_y, grid_x = torch.meshgrid(torch.linspace(0, H_ - 1, H_, dtype=torch.float32, device=memory_padding_mask.device),
+                                            torch.linspace(0, W_ - 1, W_, dtype=torch.float32, device=memory_padding_mask.device))
             grid = torch.cat([grid_x.unsqueeze(-1), grid_y.unsqueeze(-1)], -1)
 
             scale = torch.cat([valid_W.unsqueeze(-1), valid_H.unsqueeze(-1)], 1).view(N_, 1, 1, 2)
@@ -108,6 +110,11 @@ class DeformableTransformer(nn.Module):
         output_proposals = torch.log(output_proposals / (1 - output_proposals))
         output_proposals = output_proposals.masked_fill(memory_padding_mask.unsqueeze(-1), float('inf'))
         output_proposals = output_proposals.masked_fill(~output_proposals_valid, float('inf'))
+        return output_proposals, output_proposals_valid
+
+    def gen_encoder_output_proposals(self, memory, memory_padding_mask, spatial_shapes, proposals=None):
+        output_proposals, output_proposals_valid = \
+            self.gen_output_proposals(memory_padding_mask, spatial_shapes) if proposals is None else proposals
 
         output_memory = memory
         output_memory = output_memory.masked_fill(memory_padding_mask.unsqueeze(-1), float(0))
@@ -124,10 +131,20 @@ class DeformableTransformer(nn.Module):
         valid_ratio = torch.stack([valid_ratio_w, valid_ratio_h], -1)
         return valid_ratio
     
+    def get_mask_inputs(self, masks, mask_flatten, spatial_shapes):
+        """
+        The encoder and decoder inputs that only depend on the padding masks: valid ratios, encoder reference points
+        and, in two-stage mode, the encoder output proposals with their validity.
+        """
+        valid_ratios = torch.stack([self.get_valid_ratio(m) for m in masks], 1)
+        reference_points = self.encoder.get_reference_points(spatial_shapes, valid_ratios, device=mask_flatten.device)
+        proposals = self.gen_output_proposals(mask_flatten, spatial_shapes) if self.two_stage else None
+        return valid_ratios, reference_points, proposals
+
     def to_4d(self, x,h,w):
         return rearrange(x, 'b (h w) c -> b c h w',h=h,w=w)
 
-    def forward(self, srcs, masks, pos_embeds, query_embed=None):
+    def forward(self, srcs, masks, pos_embeds, query_embed=None, layer_done=None):
 
         assert self.two_stage or query_embed is not None
 
@@ -153,15 +170,21 @@ class DeformableTransformer(nn.Module):
         lvl_pos_embed_flatten = torch.cat(lvl_pos_embed_flatten, 1)
         spatial_shapes = torch.as_tensor(spatial_shapes, dtype=torch.long, device=src_flatten.device)
         level_start_index = torch.cat((spatial_shapes.new_zeros((1, )), spatial_shapes.prod(1).cumsum(0)[:-1]))
-        valid_ratios = torch.stack([self.get_valid_ratio(m) for m in masks], 1)
+        if self.shape_cache is None or self.training or torch.jit.is_tracing():
+            valid_ratios, reference_points, proposals = self.get_mask_inputs(masks, mask_flatten, spatial_shapes)
+        else:
+            valid_ratios, reference_points, proposals = self.shape_cache.get(
+                ('transformer', self.two_stage) + mask_sizes_key(masks),
+                lambda: self.get_mask_inputs(masks, mask_flatten, spatial_shapes))
 
         # encoder
-        memory = self.encoder(src_flatten, spatial_shapes, level_start_index, valid_ratios, lvl_pos_embed_flatten, mask_flatten)
+        memory = self.encoder(src_flatten, spatial_shapes, level_start_index, valid_ratios, lvl_pos_embed_flatten,
+                              mask_flatten, reference_points)
 
         # prepare input for decoder
         bs, _, c = memory.shape
         if self.two_stage:
-            output_memory, output_proposals = self.gen_encoder_output_proposals(memory, mask_flatten, spatial_shapes)
+            output_memory, output_proposals = self.gen_encoder_output_proposals(memory, mask_flatten, spatial_shapes, proposals)
 
             # hack implementation for two-stage Deformable DETR
             enc_outputs_class = self.decoder.class_embed[self.decoder.num_layers](output_memory)
@@ -183,7 +206,7 @@ class DeformableTransformer(nn.Module):
             init_reference_out = reference_points
 
         # decoder
-        hs, inter_references = self.decoder(tgt, reference_points, memory, spatial_shapes, level_start_index, valid_ratios, query_embed, mask_flatten)
+        hs, inter_references = self.decoder(tgt, reference_points, memory, spatial_shapes, level_start_index, valid_ratios, query_embed, mask_flatten, layer_done)
 
         inter_references_out = inter_references
 
@@ -257,9 +280,10 @@ class DeformableTransformerEncoder(nn.Module):
         reference_points = reference_points[:, :, None] * valid_ratios[:, None]
         return reference_points
 
-    def forward(self, src, spatial_shapes, level_start_index, valid_ratios, pos=None, padding_mask=None):
+    def forward(self, src, spatial_shapes, level_start_index, valid_ratios, pos=None, padding_mask=None, reference_points=None):
         output = src
-        reference_points = self.get_reference_points(spatial_shapes, valid_ratios, device=src.device)
+        if reference_points is None:
+            reference_points = self.get_reference_points(spatial_shapes, valid_ratios, device=src.device)
         for _, layer in enumerate(self.layers):
             output = layer(output, pos, reference_points, spatial_shapes, level_start_index, padding_mask)
 
@@ -332,8 +356,16 @@ class DeformableTransformerDecoder(nn.Module):
         self.class_embed = None
 
     def forward(self, tgt, reference_points, src, src_spatial_shapes, src_level_start_index, src_valid_ratios,
-                query_pos=None, src_padding_mask=None):
+                query_pos=None, src_padding_mask=None, layer_done=None):
+        """
+        layer_done: optional early exit, called after every layer with (layer index, its output, its input and output
+                    reference points, batch indices of the rows), returns a bool tensor of the rows whose image can
+                    leave the decoder. The next layers run on the other images only, and layer_done is left to keep
+                    the outputs it needs: nothing is returned.
+        """
         output = tgt
+        # original batch index of every row
+        active = torch.arange(tgt.shape[0], device=tgt.device) if layer_done is not None else None
 
         intermediate = []
         # intermediate_attention_feature = []
@@ -346,6 +378,7 @@ class DeformableTransformerDecoder(nn.Module):
                 assert reference_points.shape[-1] == 2
                 reference_points_input = reference_points[:, :, None] * src_valid_ratios[:, None]
             output = layer(output, query_pos, reference_points_input, src, src_spatial_shapes, src_level_start_index, src_padding_mask)
+            layer_reference_points = reference_points
 
             # hack implementation for iterative bounding box refinement
             if self.bbox_embed is not None:
@@ -360,6 +393,17 @@ class DeformableTransformerDecoder(nn.Module):
                     new_reference_points = new_reference_points.sigmoid()
                 reference_points = new_reference_points.detach()
 
+            if layer_done is not None:
+                keep = ~layer_done(lid, output, layer_reference_points, reference_points, active)
+                if lid == self.num_layers - 1 or not keep.any():
+                    return None, None
+                if not keep.all():
+                    output, reference_points, src, src_valid_ratios, active = \
+                        output[keep], reference_points[keep], src[keep], src_valid_ratios[keep], active[keep]
+                    query_pos = query_pos[keep] if query_pos is not None else None
+                    src_padding_mask = src_padding_mask[keep] if src_padding_mask is not None else None
+                continue
+
             if self.return_intermediate:
                 intermediate.append(output)
                 intermediate_reference_points.append(reference_points)
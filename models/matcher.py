@@ -10,9 +10,12 @@
 """
 Modules to compute the matching cost and solve the corresponding LSAP.
 """
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 from scipy.optimize import linear_sum_assignment
 from torch import nn
+from torch.nn.utils.rnn import pad_sequence
 
 from util.box_ops import box_cxcywh_to_xyxy, generalized_box_iou
 
@@ -28,18 +31,27 @@ class HungarianMatcher(nn.Module):
     def __init__(self,
                  cost_class: float = 1,
                  cost_bbox: float = 1,
-                 cost_giou: float = 1):
+                 cost_giou: float = 1,
+                 num_threads: int = 0,
+                 topk: int = 0):
         """Creates the matcher
 
         Params:
             cost_class: This is the relative weight of the classification error in the matching cost
             cost_bbox: This is the relative weight of the L1 error of the bounding box coordinates in the matching cost
             cost_giou: This is the relative weight of the giou loss of the bounding box in the matching cost
+            num_threads: number of threads solving the assignment problems of match_layers concurrently,
+                         0 solves them one after the other on the calling thread
+            topk: if > 0, only the topk queries of lowest class and L1 cost to each target are candidates for its
+                  matching, see match_layers
         """
         super().__init__()
         self.cost_class = cost_class
         self.cost_bbox = cost_bbox
         self.cost_giou = cost_giou
+        self.num_threads = num_threads
+        self.topk = topk
+        self.executor = None
         assert cost_class != 0 or cost_bbox != 0 or cost_giou != 0, "all costs cant be 0"
 
     def forward(self, outputs, targets):
@@ -62,41 +74,157 @@ class HungarianMatcher(nn.Module):
             For each batch element, it holds:
                 len(index_i) = len(index_j) = min(num_queries, num_target_boxes)
         """
-        with torch.no_grad():
-            bs, num_queries = outputs["pred_logits"].shape[:2]
-
-            # We flatten to compute the cost matrices in a batch
-            out_prob = outputs["pred_logits"].flatten(0, 1).sigmoid()
-            out_bbox = outputs["pred_boxes"].flatten(0, 1)  # [batch_size * num_queries, 4]
+        return self.match_layers([outputs], [targets])[0]
 
-            # Also concat the target labels and boxes
-            tgt_ids = torch.cat([v["labels"] for v in targets])
-            tgt_bbox = torch.cat([v["boxes"] for v in targets])
+    @torch.no_grad()
+    def match_layers(self, layer_outputs, layer_targets):
+        """ Performs the matching of several layers' predictions at once, e.g. of every decoder layer
 
-            # Compute the classification cost.
-            alpha = 0.25
-            gamma = 2.0
-            neg_cost_class = (1 - alpha) * (out_prob ** gamma) * (-(1 - out_prob + 1e-8).log())
-            pos_cost_class = alpha * ((1 - out_prob) ** gamma) * (-(out_prob + 1e-8).log())
-            cost_class = pos_cost_class[:, tgt_ids] - neg_cost_class[:, tgt_ids]
+        Consecutive layers with the same number of queries and the same targets (the same list object) are
+        stacked, and their cost matrices computed in one batched op over the images' targets padded to the same
+        number. The cost matrices of all the layers are then copied to the host at once, and the (layer, image)
+        assignment problems solved on self.num_threads threads.
+        The indices are the same as those of matching each layer separately.
 
-            # Compute the L1 cost between boxes
-            cost_bbox = torch.cdist(out_bbox, tgt_bbox, p=1)
+        With self.topk > 0, the queries of each image are pruned to the union of the topk queries of lowest class
+        and L1 cost to each of its targets. The giou cost is only computed for those, and the assignment problem
+        solved over them. An image is matched over all its queries if it has fewer candidates than targets, and a
+        layer if topk * targets covers its queries anyway.
 
-            # Compute the giou cost betwen boxes
-            cost_giou = -generalized_box_iou(box_cxcywh_to_xyxy(out_bbox),
-                                             box_cxcywh_to_xyxy(tgt_bbox))
-
-            # Final cost matrix
-            C = self.cost_bbox * cost_bbox + self.cost_class * cost_class + self.cost_giou * cost_giou
-            C = C.view(bs, num_queries, -1).cpu()
+        Params:
+            layer_outputs: list of output dicts as for forward, one per layer
+            layer_targets: list of the targets each layer is matched to, as for forward
 
-            sizes = [len(v["boxes"]) for v in targets]
-            indices = [linear_sum_assignment(c[i]) for i, c in enumerate(C.split(sizes, -1))]
-            return [(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64)) for i, j in indices]
+        Returns:
+            A list with the indices of each layer, as returned by forward
+        """
+        groups = []
+        for outputs, targets in zip(layer_outputs, layer_targets):
+            if groups and groups[-1][1] is targets and groups[-1][0][0]["pred_logits"].shape == outputs["pred_logits"].shape:
+                groups[-1][0].append(outputs)
+            else:
+                groups.append(([outputs], targets))
+
+        inputs, costs, candidates = [], [], []
+        for outputs, targets in groups:
+            # padded with a valid box, whose costs are dropped
+            tgt_ids = pad_sequence([v["labels"] for v in targets], batch_first=True)
+            tgt_bbox = pad_sequence([v["boxes"] for v in targets], batch_first=True, padding_value=0.5)
+            pred_logits = torch.cat([o["pred_logits"] for o in outputs])
+            pred_boxes = torch.cat([o["pred_boxes"] for o in outputs])
+            tgt_ids, tgt_bbox = tgt_ids.repeat(len(outputs), 1), tgt_bbox.repeat(len(outputs), 1, 1)
+            inputs.append((pred_logits, pred_boxes, tgt_ids, tgt_bbox))
+            if 0 < self.topk * tgt_ids.shape[1] < pred_logits.shape[1]:
+                sizes = torch.as_tensor([len(v["boxes"]) for v in targets] * len(outputs), device=tgt_ids.device)
+                C, cand = self.pruned_cost_matrix(pred_logits, pred_boxes, tgt_ids, tgt_bbox, sizes)
+                candidates.append(cand)
+            else:
+                C = self.cost_matrix(pred_logits, pred_boxes, tgt_ids, tgt_bbox)
+                candidates.append(None)
+            costs.append(C)
+        # a single device to host copy, and one more for the candidates of pruned matching
+        shapes = [C.shape for C in costs]
+        costs = torch.cat([C.flatten() for C in costs]).cpu().split([C.numel() for C in costs])
+        if any(cand is not None for cand in candidates):
+            pruned = [cand for cand in candidates if cand is not None]
+            pruned = iter(torch.cat([cand.flatten() for cand in pruned]).cpu().split([cand.numel() for cand in pruned]))
+            candidates = [next(pruned).view(cand.shape) if cand is not None else None for cand in candidates]
+
+        problems, rows = [], []
+        for (outputs, targets), group_inputs, C, shape, cand in zip(groups, inputs, costs, shapes, candidates):
+            num_queries = group_inputs[0].shape[1]
+            C = C.view(len(outputs), len(targets), *shape[1:])
+            for l in range(len(outputs)):
+                for i, v in enumerate(targets):
+                    num_targets = len(v["boxes"])
+                    if cand is None:
+                        problems.append(C[l, i, :, :num_targets])
+                        rows.append(None)
+                        continue
+                    image_cand = cand[l * len(targets) + i]
+                    image_cand = image_cand[image_cand >= 0]
+                    if len(image_cand) >= min(num_queries, num_targets):
+                        problems.append(C[l, i, :len(image_cand), :num_targets])
+                        rows.append(image_cand)
+                    else:
+                        b = l * len(targets) + i
+                        dense = self.cost_matrix(*[x[b:b + 1] for x in group_inputs])
+                        problems.append(dense[0, :, :num_targets].cpu())
+                        rows.append(None)
+        indices = [(i, j) if r is None else (r[i], j) for (i, j), r in zip(self.solve(problems), rows)]
+        indices = iter(indices)
+        return [[next(indices) for _ in targets] for outputs, targets in groups for _ in outputs]
+
+    def cost_matrix(self, pred_logits, pred_boxes, tgt_ids, tgt_bbox, with_giou=True):
+        """ Computes the [batch_size, num_queries, num_target_boxes] matching cost of each image's predictions
+        (pred_logits [batch_size, num_queries, num_classes], pred_boxes [batch_size, num_queries, 4]) and targets
+        (tgt_ids [batch_size, num_target_boxes], tgt_bbox [batch_size, num_target_boxes, 4])
+        """
+        num_queries = pred_logits.shape[1]
+
+        # Only the probabilities of the target classes are needed
+        out_prob = pred_logits.sigmoid()
+        out_prob = torch.gather(out_prob, 2, tgt_ids[:, None, :].expand(-1, num_queries, -1))
+
+        # Compute the classification cost.
+        alpha = 0.25
+        gamma = 2.0
+        neg_cost_class = (1 - alpha) * (out_prob ** gamma) * (-(1 - out_prob + 1e-8).log())
+        pos_cost_class = alpha * ((1 - out_prob) ** gamma) * (-(out_prob + 1e-8).log())
+        cost_class = pos_cost_class - neg_cost_class
+
+        # Compute the L1 cost between boxes
+        cost_bbox = torch.cdist(pred_boxes, tgt_bbox, p=1)
+
+        # Final cost matrix
+        C = self.cost_bbox * cost_bbox + self.cost_class * cost_class
+        if with_giou:
+            C = C + self.giou_cost(pred_boxes, tgt_bbox)
+        return C
+
+    def giou_cost(self, pred_boxes, tgt_bbox):
+        # Compute the giou cost betwen boxes
+        cost_giou = -generalized_box_iou(box_cxcywh_to_xyxy(pred_boxes),
+                                         box_cxcywh_to_xyxy(tgt_bbox))
+        return self.cost_giou * cost_giou
+
+    def pruned_cost_matrix(self, pred_logits, pred_boxes, tgt_ids, tgt_bbox, sizes):
+        """ Computes the matching cost of each image's candidate queries, the union of the topk queries of lowest
+        class and L1 cost to each of its sizes[i] targets, sorted and padded to topk * num_target_boxes.
+        Returns the [batch_size, topk * num_target_boxes, num_target_boxes] costs, and the candidates' query indices
+        [batch_size, topk * num_target_boxes], -1 for the padding
+        """
+        bs, num_queries = pred_logits.shape[:2]
+        num_candidates = self.topk * tgt_ids.shape[1]
+        C = self.cost_matrix(pred_logits, pred_boxes, tgt_ids, tgt_bbox, with_giou=False)
+
+        # queries among the topk of a (non padding) target
+        valid = torch.arange(tgt_ids.shape[1], device=sizes.device) < sizes[:, None]
+        topk = C.topk(self.topk, dim=1, largest=False).indices
+        votes = torch.zeros(bs, num_queries, device=C.device).scatter_add_(
+            1, topk.flatten(1), valid[:, None, :].expand(-1, self.topk, -1).flatten(1).float())
+        is_candidate = votes > 0
+
+        # the candidates first, in query order
+        cand = torch.argsort(is_candidate.int(), dim=1, descending=True, stable=True)[:, :num_candidates]
+        C = torch.gather(C, 1, cand[..., None].expand(-1, -1, C.shape[2]))
+        C = C + self.giou_cost(torch.gather(pred_boxes, 1, cand[..., None].expand(-1, -1, 4)), tgt_bbox)
+        return C, cand.masked_fill(~torch.gather(is_candidate, 1, cand), -1)
+
+    def solve(self, cost_matrices):
+        """Solves the assignment problem of each cost matrix, concurrently if num_threads > 0"""
+        if self.num_threads > 0 and len(cost_matrices) > 1:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.num_threads, thread_name_prefix='matcher')
+            indices = list(self.executor.map(linear_sum_assignment, cost_matrices))
+        else:
+            indices = [linear_sum_assignment(c) for c in cost_matrices]
+        return [(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64)) for i, j in indices]
 
 
 def build_matcher(args):
     return HungarianMatcher(cost_class=args.set_cost_class,
                             cost_bbox=args.set_cost_bbox,
-                            cost_giou=args.set_cost_giou)
+                            cost_giou=args.set_cost_giou,
+                            num_threads=getattr(args, 'matcher_threads', 0),
+                            topk=getattr(args, 'matcher_topk', 0))
@@ -15,12 +15,23 @@ import torch.nn.functional as F
 from torch.autograd import Function
 from torch.autograd.function import once_differentiable
 
-import MultiScaleDeformableAttention as MSDA
+try:
+    import MultiScaleDeformableAttention as MSDA
+except ImportError:
+    # the compiled extension is optional, MSDeformAttn falls back to ms_deform_attn_core_fused without it
+    MSDA = None
+
+
+def ms_deform_attn_extension_available(value):
+    """Whether the compiled extension can run on value (CUDA tensors only)."""
+    return MSDA is not None and value.is_cuda
 
 
 class MSDeformAttnFunction(Function):
     @staticmethod
     def forward(ctx, value, value_spatial_shapes, value_level_start_index, sampling_locations, attention_weights, im2col_step):
+        if MSDA is None:
+            raise RuntimeError('MultiScaleDeformableAttention is not compiled, run models/ops/make.sh')
         ctx.im2col_step = im2col_step
         output = MSDA.ms_deform_attn_forward(
             value, value_spatial_shapes, value_level_start_index, sampling_locations, attention_weights, ctx.im2col_step)
@@ -39,8 +50,7 @@ class MSDeformAttnFunction(Function):
 
 
 def ms_deform_attn_core_pytorch(value, value_spatial_shapes, sampling_locations, attention_weights):
-    # for debug and test only,
-    # need to use cuda version instead
+    # reference implementation, one grid_sample per level
     N_, S_, M_, D_ = value.shape
     _, Lq_, M_, L_, P_, _ = sampling_locations.shape
     value_list = value.split([H_ * W_ for H_, W_ in value_spatial_shapes], dim=1)
@@ -59,3 +69,44 @@ def ms_deform_attn_core_pytorch(value, value_spatial_shapes, sampling_locations,
     attention_weights = attention_weights.transpose(1, 2).reshape(N_*M_, 1, Lq_, L_*P_)
     output = (torch.stack(sampling_value_list, dim=-2).flatten(-2) * attention_weights).sum(-1).view(N_, M_*D_, Lq_)
     return output.transpose(1, 2).contiguous()
+
+
+def ms_deform_attn_core_fused(value, value_spatial_shapes, value_level_start_index, sampling_locations, attention_weights):
+    """
+    Same result as ms_deform_attn_core_pytorch, in a single pass over all levels: the four bilinear corners of every
+    sampling point are addressed as rows of the flattened value with index arithmetic (level_start_index + y*W + x),
+    and their attention-weighted sum is accumulated by embedding_bag, so no per-level copies of value and no stacked
+    sampled values are built. Out-of-bounds corners get a zero weight (grid_sample padding_mode='zeros').
+    Differentiable with respect to value, sampling_locations and attention_weights.
+    Used on CPU and when the CUDA extension is not compiled, the CUDA version is faster on GPU.
+    """
+    N_, S_, M_, D_ = value.shape
+    _, Lq_, M_, L_, P_, _ = sampling_locations.shape
+    # row (n, s, m) of value is (n*S_ + s)*M_ + m
+    value_rows = value.reshape(N_ * S_ * M_, D_)
+    H_ = value_spatial_shapes[:, 0].view(L_, 1)
+    W_ = value_spatial_shapes[:, 1].view(L_, 1)
+    # pixel coordinates of the sampling points, align_corners=False
+    x = sampling_locations[..., 0] * W_ - 0.5
+    y = sampling_locations[..., 1] * H_ - 0.5
+    x0, y0 = x.detach().floor(), y.detach().floor()
+    lx, ly = x - x0, y - y0
+    x0, y0 = x0.long(), y0.long()
+    # N_, 1, 1, L_, 1: first position of every level in every image
+    level_start = torch.arange(N_, device=value.device).view(N_, 1, 1, 1, 1) * S_ + value_level_start_index.view(L_, 1)
+    head = torch.arange(M_, device=value.device).view(M_, 1, 1)
+    index, weight = [], []
+    for dy, dx, w in ((0, 0, (1 - ly) * (1 - lx)), (0, 1, (1 - ly) * lx), (1, 0, ly * (1 - lx)), (1, 1, ly * lx)):
+        xc, yc = x0 + dx, y0 + dy
+        valid = (xc >= 0) & (xc < W_) & (yc >= 0) & (yc < H_)
+        index.append((level_start + torch.where(valid, yc * W_ + xc, 0)) * M_ + head)
+        weight.append(w * valid)
+    # N_, Lq_, M_, L_, P_, 4 -> N_*Lq_*M_, L_*P_*4
+    index = torch.stack(index, dim=-1).view(N_ * Lq_ * M_, L_ * P_ * 4)
+    weight = (torch.stack(weight, dim=-1) * attention_weights[..., None]).view(N_ * Lq_ * M_, L_ * P_ * 4)
+    if torch.onnx.is_in_onnx_export():
+        # ONNX has no embedding_bag (it is exported as a Loop of unknown output shape)
+        output = (value_rows[index] * weight[..., None]).sum(1)
+    else:
+        output = F.embedding_bag(index, value_rows, per_sample_weights=weight, mode='sum')
+    return output.view(N_, Lq_, M_ * D_)
@@ -18,7 +18,7 @@ from torch import nn
 import torch.nn.functional as F
 from torch.nn.init import xavier_uniform_, constant_
 
-from ..functions import MSDeformAttnFunction
+from ..functions import MSDeformAttnFunction, ms_deform_attn_core_fused, ms_deform_attn_extension_available
 
 
 def _is_power_of_2(n):
@@ -109,7 +109,11 @@ class MSDeformAttn(nn.Module):
         else:
             raise ValueError(
                 'Last dim of reference_points must be 2 or 4, but get {} instead.'.format(reference_points.shape[-1]))
-        output = MSDeformAttnFunction.apply(
-            value, input_spatial_shapes, input_level_start_index, sampling_locations, attention_weights, self.im2col_step)
+        if ms_deform_attn_extension_available(value):
+            output = MSDeformAttnFunction.apply(
+                value, input_spatial_shapes, input_level_start_index, sampling_locations, attention_weights, self.im2col_step)
+        else:
+            output = ms_deform_attn_core_fused(
+                value, input_spatial_shapes, input_level_start_index, sampling_locations, attention_weights)
         output = self.output_proj(output)
         return output
@@ -16,14 +16,16 @@ import torch
 import torch.nn as nn
 from torch.autograd import gradcheck
 
-from functions.ms_deform_attn_func import MSDeformAttnFunction, ms_deform_attn_core_pytorch
+from functions.ms_deform_attn_func import MSDeformAttnFunction, ms_deform_attn_core_pytorch, ms_deform_attn_core_fused
 
 
 N, M, D = 1, 2, 2
 Lq, L, P = 2, 2, 2
-shapes = torch.as_tensor([(6, 4), (3, 2)], dtype=torch.long).cuda()
-level_start_index = torch.cat((shapes.new_zeros((1, )), shapes.prod(1).cumsum(0)[:-1]))
-S = sum([(H*W).item() for H, W in shapes])
+shapes_cpu = torch.as_tensor([(6, 4), (3, 2)], dtype=torch.long)
+level_start_index_cpu = torch.cat((shapes_cpu.new_zeros((1, )), shapes_cpu.prod(1).cumsum(0)[:-1]))
+if torch.cuda.is_available():
+    shapes, level_start_index = shapes_cpu.cuda(), level_start_index_cpu.cuda()
+S = sum([(H*W).item() for H, W in shapes_cpu])
 
 
 torch.manual_seed(3)
@@ -79,12 +81,70 @@ def check_gradient_numerical(channels=4, grad_value=True, grad_sampling_loc=True
     print(f'* {gradok} check_gradient_numerical(D={channels})')
 
 
-if __name__ == '__main__':
-    check_forward_equal_with_pytorch_double()
-    check_forward_equal_with_pytorch_float()
+def fused_inputs(channels=D, dtype=torch.float64):
+    value = torch.rand(N, S, M, channels, dtype=dtype) * 0.01
+    # partly outside [0, 1] to cover the zero padding
+    sampling_locations = torch.rand(N, Lq, M, L, P, 2, dtype=dtype) * 1.4 - 0.2
+    attention_weights = torch.rand(N, Lq, M, L, P, dtype=dtype) + 1e-5
+    attention_weights /= attention_weights.sum(-1, keepdim=True).sum(-2, keepdim=True)
+    return value, sampling_locations, attention_weights
+
+
+@torch.no_grad()
+def check_fused_forward_equal_with_pytorch(dtype=torch.float64):
+    value, sampling_locations, attention_weights = fused_inputs(dtype=dtype)
+    output_pytorch = ms_deform_attn_core_pytorch(value, shapes_cpu, sampling_locations, attention_weights)
+    output_fused = ms_deform_attn_core_fused(value, shapes_cpu, level_start_index_cpu, sampling_locations, attention_weights)
+    fwdok = torch.allclose(output_fused, output_pytorch) if dtype == torch.float64 else \
+        torch.allclose(output_fused, output_pytorch, rtol=1e-2, atol=1e-3)
+    max_abs_err = (output_fused - output_pytorch).abs().max()
+    max_rel_err = ((output_fused - output_pytorch).abs() / output_pytorch.abs()).max()
+
+    print(f'* {fwdok} check_fused_forward_equal_with_pytorch({dtype}): max_abs_err {max_abs_err:.2e} max_rel_err {max_rel_err:.2e}')
+
+
+def check_fused_gradient_equal_with_pytorch(channels=4):
+    inputs = fused_inputs(channels)
+    for x in inputs:
+        x.requires_grad = True
+    value, sampling_locations, attention_weights = inputs
+    grad_output = torch.rand(N, Lq, M * channels, dtype=torch.float64)
+    grads_pytorch = torch.autograd.grad(
+        ms_deform_attn_core_pytorch(value, shapes_cpu, sampling_locations, attention_weights), inputs, grad_output)
+    grads_fused = torch.autograd.grad(
+        ms_deform_attn_core_fused(value, shapes_cpu, level_start_index_cpu, sampling_locations, attention_weights),
+        inputs, grad_output)
+    gradok = all(torch.allclose(g_fused, g_pytorch) for g_fused, g_pytorch in zip(grads_fused, grads_pytorch))
+    max_abs_err = max((g_fused - g_pytorch).abs().max() for g_fused, g_pytorch in zip(grads_fused, grads_pytorch))
 
-    for channels in [30, 32, 64, 71, 1025, 2048, 3096]:
-        check_gradient_numerical(channels, True, True, True)
+    print(f'* {gradok} check_fused_gradient_equal_with_pytorch(D={channels}): max_abs_err {max_abs_err:.2e}')
+
+
+def check_fused_gradient_numerical(channels=4):
+    inputs = fused_inputs(channels)
+    for x in inputs:
+        x.requires_grad = True
+    value, sampling_locations, attention_weights = inputs
+    func = ms_deform_attn_core_fused
+
+    gradok = gradcheck(func, (value, shapes_cpu, level_start_index_cpu, sampling_locations, attention_weights))
+
+    print(f'* {gradok} check_fused_gradient_numerical(D={channels})')
+
+
+if __name__ == '__main__':
+    check_fused_forward_equal_with_pytorch(torch.float64)
+    check_fused_forward_equal_with_pytorch(torch.float32)
+    for channels in [30, 32, 64, 71]:
+        check_fused_gradient_equal_with_pytorch(channels)
+        check_fused_gradient_numerical(channels)
+
+    if torch.cuda.is_available():
+        check_forward_equal_with_pytorch_double()
+        check_forward_equal_with_pytorch_float()
+
+        for channels in [30, 32, 64, 71, 1025, 2048, 3096]:
+            check_gradient_numerical(channels, True, True, True)
 
 
 
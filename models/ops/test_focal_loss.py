@@ -0,0 +1,91 @@
+# ------------------------------------------------------------------------
+# PROB: Probabilistic Objectness for Open World Object Detection
+# Orr Zohar, Jackson Wang, Serena Yeung
+# ------------------------------------------------------------------------
+
+"""
+Checks sigmoid_focal_loss_fused (SigmoidFocalLossFunction) against the dense path of SetCriterion.loss_labels it
+replaces: logits cloned with -10e10 in the invalid classes, one-hot targets and sigmoid_focal_loss.
+Run next to test.py: cd models/ops && python test_focal_loss.py (should see all checking is True)
+"""
+import os
+import sys
+
+import torch
+from torch.autograd import gradcheck
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from models.prob_deformable_detr import SigmoidFocalLossFunction, sigmoid_focal_loss, sigmoid_focal_loss_fused
+
+B, Q, C = 2, 10, 12
+INVALID = [3, 4, 5, 6]
+NUM_BOXES = 7.0
+
+torch.manual_seed(3)
+
+
+def class_weight(empty_weight, invalid, dtype):
+    weight = torch.ones(C, dtype=dtype)
+    weight[-1] = empty_weight
+    weight[invalid] = 0
+    return weight
+
+
+def focal_inputs(shape, invalid, dtype, num_matched=4, scale=5.0):
+    logits = torch.randn(*shape, C, dtype=dtype) * scale
+    # no object for every query, except num_matched random queries per image of a random valid class
+    target_classes = torch.full(shape, C - 1, dtype=torch.int64)
+    valid = torch.tensor([c for c in range(C - 1) if c not in invalid])
+    for index in torch.randperm(target_classes.numel())[:num_matched * target_classes.numel() // Q]:
+        target_classes.view(-1)[index] = valid[torch.randint(len(valid), ())]
+    return logits, target_classes
+
+
+def focal_loss_pytorch(logits, target_classes, empty_weight, invalid, alpha):
+    src_logits = logits.clone()
+    src_logits[..., invalid] = -10e10
+    target_classes_onehot = torch.zeros_like(src_logits).scatter_(-1, target_classes.unsqueeze(-1), 1)
+    return sigmoid_focal_loss(src_logits, target_classes_onehot, NUM_BOXES, alpha=alpha, num_classes=C,
+                              empty_weight=empty_weight) * src_logits.shape[-2]
+
+
+def check_focal_loss_equal_with_pytorch(shape, dtype, empty_weight=0.1, invalid=INVALID, alpha=0.25, num_matched=4):
+    logits, target_classes = focal_inputs(shape, invalid, dtype, num_matched)
+    logits.requires_grad = True
+    grad_output = torch.rand(shape[:-2], dtype=dtype)
+
+    loss_pytorch = focal_loss_pytorch(logits, target_classes, empty_weight, invalid, alpha)
+    grad_pytorch, = torch.autograd.grad(loss_pytorch, logits, grad_output)
+    loss_fused = sigmoid_focal_loss_fused(logits, target_classes, NUM_BOXES,
+                                          class_weight(empty_weight, invalid, dtype), alpha=alpha)
+    grad_fused, = torch.autograd.grad(loss_fused, logits, grad_output)
+
+    rtol, atol = (1e-7, 1e-10) if dtype == torch.float64 else (1e-4, 1e-6)
+    fwdok = loss_fused.shape == loss_pytorch.shape and torch.allclose(loss_fused, loss_pytorch, rtol=rtol, atol=atol)
+    gradok = torch.allclose(grad_fused, grad_pytorch, rtol=rtol, atol=atol)
+    max_rel_err = ((loss_fused - loss_pytorch).abs() / loss_pytorch.abs()).max()
+    max_abs_err = (grad_fused - grad_pytorch).abs().max()
+
+    print(f'* {fwdok and gradok} check_focal_loss_equal_with_pytorch({list(shape)}, {dtype}, empty_weight={empty_weight}, '
+          f'invalid={invalid}, matched={num_matched}): loss max_rel_err {max_rel_err:.2e} grad max_abs_err {max_abs_err:.2e}')
+
+
+def check_focal_loss_gradient_numerical(shape):
+    logits, target_classes = focal_inputs(shape, INVALID, torch.float64, scale=2.0)
+    logits.requires_grad = True
+    func = SigmoidFocalLossFunction.apply
+
+    gradok = gradcheck(func, (logits, target_classes, class_weight(0.1, INVALID, torch.float64), 0.25, 2.0))
+
+    print(f'* {gradok} check_focal_loss_gradient_numerical({list(shape)})')
+
+
+if __name__ == '__main__':
+    for dtype in [torch.float64, torch.float32]:
+        for shape in [(B, Q), (6, B, Q)]:
+            check_focal_loss_equal_with_pytorch(shape, dtype)
+            check_focal_loss_equal_with_pytorch(shape, dtype, empty_weight=0.5, alpha=0.4)
+            check_focal_loss_equal_with_pytorch(shape, dtype, invalid=[])
+            check_focal_loss_equal_with_pytorch(shape, dtype, num_matched=0)
+    check_focal_loss_gradient_numerical((B, 3))
+    check_focal_loss_gradient_numerical((2, B, 3))
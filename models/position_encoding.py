@@ -14,7 +14,7 @@ import math
 import torch
 from torch import nn
 
-from util.misc import NestedTensor
+from util.misc import NestedTensor, mask_sizes_key
 
 
 class PositionEmbeddingSine(nn.Module):
@@ -32,11 +32,18 @@ class PositionEmbeddingSine(nn.Module):
         if scale is None:
             scale = 2 * math.pi
         self.scale = scale
+        # optional util.misc.ShapeCache, the embedding only depends on the mask
+        self.shape_cache = None
 
     def forward(self, tensor_list: NestedTensor):
-        x = tensor_list.tensors
         mask = tensor_list.mask
         assert mask is not None
+        if self.shape_cache is None or self.training or torch.jit.is_tracing():
+            return self.embed(mask)
+        key = ('pos_sine', self.num_pos_feats, self.temperature, self.normalize, self.scale) + mask_sizes_key([mask])
+        return self.shape_cache.get(key, lambda: self.embed(mask))
+
+    def embed(self, mask):
         not_mask = ~mask
         y_embed = not_mask.cumsum(1, dtype=torch.float32)
         x_embed = not_mask.cumsum(2, dtype=torch.float32)
@@ -45,7 +52,7 @@ class PositionEmbeddingSine(nn.Module):
             y_embed = (y_embed - 0.5) / (y_embed[:, -1:, :] + eps) * self.scale
             x_embed = (x_embed - 0.5) / (x_embed[:, :, -1:] + eps) * self.scale
 
-        dim_t = torch.arange(self.num_pos_feats, dtype=torch.float32, device=x.device)
+        dim_t = torch.arange(self.num_pos_feats, dtype=torch.float32, device=mask.device)
         dim_t = self.temperature ** (2 * (dim_t // 2) / self.num_pos_feats)
 
         pos_x = x_embed[:, :, :, None] / dim_t
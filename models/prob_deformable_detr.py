@@ -9,15 +9,19 @@
 """
 Deformable DETR model and criterion classes.
 """
+from collections import Counter
+
 import torch
 import torch.nn.functional as F
 from torch import nn
+from torch.autograd import Function
+from torch.autograd.function import once_differentiable
 import math
 
 from util import box_ops
 from util.misc import (NestedTensor, nested_tensor_from_tensor_list,
                        accuracy, get_world_size, interpolate,
-                       is_dist_avail_and_initialized, inverse_sigmoid)
+                       is_dist_avail_and_initialized, inverse_sigmoid, ShapeCache)
 
 from .backbone import build_backbone
 from .matcher import build_matcher
@@ -46,7 +50,7 @@ def sigmoid_focal_loss(inputs, targets, num_boxes, alpha: float = 0.25, gamma: f
         gamma: Exponent of the modulating factor (1 - p_t) to
                balance easy vs hard examples.
     Returns:
-        Loss tensor
+        Loss tensor, with the leading dimensions of inputs [..., batch_size, num_queries, num_classes], if any
     """
     prob = inputs.sigmoid()
     W = torch.ones(num_classes, dtype=prob.dtype, layout=prob.layout, device=prob.device)
@@ -60,10 +64,103 @@ def sigmoid_focal_loss(inputs, targets, num_boxes, alpha: float = 0.25, gamma: f
         alpha_t = alpha * targets + (1 - alpha) * (1 - targets)
         loss = alpha_t * loss
 
-    return loss.mean(1).sum() / num_boxes
+    return loss.mean(-2).flatten(-2).sum(-1) / num_boxes
+
+
+class SigmoidFocalLossFunction(Function):
+    """ The focal loss of logits [..., num_classes] with a single positive class per row, target_classes [...],
+        summed over the classes and weighted by class_weight [num_classes]. Only the inputs are saved for the
+        backward, which recomputes the rest.
+    """
+    @staticmethod
+    def forward(ctx, logits, target_classes, class_weight, alpha, gamma):
+        ctx.save_for_backward(logits, target_classes, class_weight)
+        ctx.alpha, ctx.gamma = alpha, gamma
+        target_classes = target_classes.unsqueeze(-1)
+        target_logits = logits.gather(-1, target_classes).squeeze(-1)
+        target_weight = class_weight[target_classes.squeeze(-1)]
+
+        # every class as a negative: (1 - alpha) * p^gamma * -log(1 - p)
+        loss = F.softplus(logits).mul_(logits.sigmoid().pow_(gamma)).matmul(class_weight) * (1 - alpha)
+        # and the target class as a positive instead: alpha * (1 - p)^gamma * -log(p)
+        target_prob = target_logits.sigmoid()
+        loss += target_weight * (alpha * (1 - target_prob) ** gamma * F.softplus(-target_logits)
+                                 - (1 - alpha) * target_prob ** gamma * F.softplus(target_logits))
+        return loss
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_output):
+        logits, target_classes, class_weight = ctx.saved_tensors
+        alpha, gamma = ctx.alpha, ctx.gamma
+        grad_output = grad_output.unsqueeze(-1)
+
+        # d/dx p^gamma * -log(1 - p) = p^gamma * (gamma * (1 - p) * -log(1 - p) + p)
+        prob = logits.sigmoid()
+        grad = F.softplus(logits).mul_(1 - prob).mul_(gamma).add_(prob).mul_(prob.pow(gamma))
+        grad.mul_(class_weight * (1 - alpha)).mul_(grad_output)
+
+        # d/dx (1 - p)^gamma * -log(p) = -(1 - p)^gamma * (gamma * p * -log(p) + 1 - p)
+        target_classes = target_classes.unsqueeze(-1)
+        target_logits = logits.gather(-1, target_classes)
+        target_prob = target_logits.sigmoid()
+        grad_pos = -alpha * (1 - target_prob) ** gamma * (gamma * target_prob * F.softplus(-target_logits) + 1 - target_prob)
+        grad_neg = (1 - alpha) * target_prob ** gamma * (gamma * (1 - target_prob) * F.softplus(target_logits) + target_prob)
+        grad.scatter_add_(-1, target_classes, class_weight[target_classes] * (grad_pos - grad_neg) * grad_output)
+        return grad, None, None, None, None
+
+
+def sigmoid_focal_loss_fused(logits, target_classes, num_boxes, class_weight, alpha: float = 0.25, gamma: float = 2):
+    """
+    sigmoid_focal_loss(logits, one_hot(target_classes), num_boxes, ...) * num_queries, without the one-hot targets
+    and the intermediates of every element kept for the backward.
+    Args:
+        logits: [..., batch_size, num_queries, num_classes]
+        target_classes: [..., batch_size, num_queries] the class of each query, the last one for no object
+        class_weight: [num_classes] weight of each class' loss (empty_weight for the last class), 0 for the classes
+                      whose logits are to be ignored
+    Returns:
+        Loss tensor, with the leading dimensions of logits, if any
+    """
+    loss = SigmoidFocalLossFunction.apply(logits, target_classes, class_weight, alpha, gamma)
+    return loss.flatten(-2).sum(-1) / num_boxes
+
+
+class FoldedStatsHead(nn.Module):
+    """ Base class of the objectness heads, whose score at inference is a fixed quadratic form of their statistics.
+        fold() precomputes that form; it is built lazily on the first forward in eval mode and dropped whenever
+        the statistics may change: train()/eval(), load_state_dict, to()/cuda()/half() and the heads' own updates.
+    """
+    def __init__(self):
+        super().__init__()
+        self._folded = None
 
+    def fold(self):
+        raise NotImplementedError
 
-class ProbObjectnessHead(nn.Module):
+    def folded(self):
+        if self._folded is None:
+            with torch.no_grad():
+                self._folded = self.fold()
+        return self._folded
+
+    def invalidate_folded(self):
+        self._folded = None
+
+    def train(self, mode=True):
+        self.invalidate_folded()
+        return super().train(mode)
+
+    def _apply(self, *args, **kwargs):
+        self.invalidate_folded()
+        return super()._apply(*args, **kwargs)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.invalidate_folded()
+        return super()._load_from_state_dict(*args, **kwargs)
+
+
+class ProbObjectnessHead(FoldedStatsHead):
     def __init__(self, hidden_dim):
         super().__init__()
         self.flatten = nn.Flatten(0,1)
@@ -71,14 +168,23 @@ class ProbObjectnessHead(nn.Module):
 
     def freeze_prob_model(self):
         self.objectness_bn.eval()
+
+    def fold(self):
+        # BatchNorm with running stats: a per-dimension scale and shift
+        bn = self.objectness_bn
+        scale = torch.rsqrt(bn.running_var + bn.eps)
+        return scale, -bn.running_mean * scale
         
     def forward(self, x):
+        if not (self.training or self.objectness_bn.training):
+            scale, shift = self.folded()
+            return torch.addcmul(shift, x, scale).norm(dim=-1)**2
         out=self.flatten(x)
         out=self.objectness_bn(out).unflatten(0, x.shape[:2])
         return out.norm(dim=-1)**2
     
     
-class FullProbObjectnessHead(nn.Module):
+class FullProbObjectnessHead(FoldedStatsHead):
     def __init__(self, hidden_dim=256, device='cpu'):
         super().__init__()
         self.flatten = nn.Flatten(0, 1)
@@ -95,13 +201,30 @@ class FullProbObjectnessHead(nn.Module):
         obj_cov=torch.cov(out.T)
         self.obj_mean.data = self.obj_mean*(1-self.momentum) + self.momentum*obj_mean
         self.obj_cov.data = self.obj_cov*(1-self.momentum) + self.momentum*obj_cov
+        self.invalidate_folded()
         return
     
     def update_icov(self):
         self.inv_obj_cov.data = torch.pinverse(self.obj_cov.detach().cpu(), rcond=1e-6).to(self.device)
+        self.invalidate_folded()
         return
+
+    def fold(self):
+        # inv_obj_cov = L L^T, so that the distance is ||x L - obj_mean L||^2. L is the Cholesky factor, or comes
+        # from the eigendecomposition when the pseudo-inverse is only semi-definite
+        inv_cov = self.inv_obj_cov.double()
+        inv_cov = (inv_cov + inv_cov.T) / 2
+        factor, info = torch.linalg.cholesky_ex(inv_cov)
+        if info != 0:
+            eigvals, eigvecs = torch.linalg.eigh(inv_cov)
+            factor = eigvecs * eigvals.clamp(min=0).sqrt()
+        factor = factor.to(self.inv_obj_cov.dtype)
+        return factor, -self.obj_mean @ factor
         
     def mahalanobis(self, x):
+        if not self.training:
+            factor, shift = self.folded()
+            return (torch.addmm(shift, self.flatten(x), factor).norm(dim=-1)**2).unflatten(0, x.shape[:2])
         out=self.flatten(x)
         delta = out - self.obj_mean
         m = (delta * torch.matmul(self.inv_obj_cov, delta.T).T).sum(dim=-1)
@@ -120,7 +243,7 @@ class FullProbObjectnessHead(nn.Module):
 class DeformableDETR(nn.Module):
     """ This is the Deformable DETR module that performs object detection """
     def __init__(self, backbone, transformer, num_classes, num_queries, num_feature_levels,
-                 aux_loss=True, with_box_refine=False, two_stage=False):
+                 aux_loss=True, with_box_refine=False, two_stage=False, shape_cache=None):
         """ Initializes the model.
         Parameters:
             backbone: torch module of the backbone to be used. See backbone.py
@@ -131,6 +254,8 @@ class DeformableDETR(nn.Module):
             aux_loss: True if auxiliary decoding losses (loss at each decoder layer) are to be used.
             with_box_refine: iterative bounding box refinement
             two_stage: two-stage Deformable DETR
+            shape_cache: optional util.misc.ShapeCache of the inputs that only depend on the image sizes
+                         (position embeddings, reference points, valid ratios), used in eval mode
         """
         super().__init__()
         self.num_queries = num_queries
@@ -170,6 +295,16 @@ class DeformableDETR(nn.Module):
         self.aux_loss = aux_loss
         self.with_box_refine = with_box_refine
         self.two_stage = two_stage
+        # eval mode computes the heads of the last decoder layer only, without aux_outputs
+        self.last_layer_inference = True
+        # optional DecoderEarlyExit, used with last_layer_inference in eval mode. Only the evaluation and inference
+        # entry points attach it (see attach_early_exit in main_open_world.py), exemplar selection runs every layer
+        self.early_exit = None
+        self.shape_cache = shape_cache
+        self.transformer.shape_cache = shape_cache
+        if hasattr(backbone[1], 'shape_cache'):
+            # the sine position embedding, the learned one depends on its weights
+            backbone[1].shape_cache = shape_cache
 
         prior_prob = 0.01
         bias_value = -math.log((1 - prior_prob) / prior_prob)
@@ -201,6 +336,12 @@ class DeformableDETR(nn.Module):
             for box_embed in self.bbox_embed:
                 nn.init.constant_(box_embed.layers[-1].bias.data[2:], 0.0)
 
+    def train(self, mode=True):
+        if mode and self.shape_cache is not None:
+            # the cache is only read in eval mode
+            self.shape_cache.clear()
+        return super().train(mode)
+
     def forward(self, samples: NestedTensor):
         """ The forward expects a NestedTensor, which consists of:
                - samples.tensor: batched images, of shape [batch_size x 3 x H x W]
@@ -213,8 +354,12 @@ class DeformableDETR(nn.Module):
                                (center_x, center_y, height, width). These values are normalized in [0, 1],
                                relative to the size of each individual image (disregarding possible padding).
                                See PostProcess for information on how to retrieve the unnormalized bounding box.
-               - "aux_outputs": Optional, only returned when auxilary losses are activated. It is a list of
+               - "aux_outputs": Optional, only returned when auxilary losses are activated, in training mode
+                                (or with last_layer_inference = False). It is a list of
                                 dictionnaries containing the two above keys for each decoder layer.
+               - "stacked_outputs": Optional, returned with "aux_outputs". The same keys for all the decoder layers
+                                    at once, stacked as [num_decoder_layers x batch_size x num_queries x ...],
+                                    the last layer being the above outputs.
         """
         if not isinstance(samples, NestedTensor):
             samples = nested_tensor_from_tensor_list(samples)
@@ -244,29 +389,48 @@ class DeformableDETR(nn.Module):
         query_embeds = None
         if not self.two_stage:
             query_embeds = self.query_embed.weight
-        hs, init_reference, inter_references, enc_outputs_class, enc_outputs_coord_unact = self.transformer(srcs, masks, pos, query_embeds)
+
+        # in eval mode only the last decoder layer is needed (PostProcess), the others are for the aux losses
+        last_layer_only = not self.training and self.last_layer_inference
+        if last_layer_only and self.early_exit is not None:
+            out = {}
+            layer_done = self.early_exit.layer_done(self, srcs[0].shape[0], out)
+        else:
+            layer_done = None
+        hs, init_reference, inter_references, enc_outputs_class, enc_outputs_coord_unact = \
+            self.transformer(srcs, masks, pos, query_embeds, layer_done)
+        if layer_done is not None:
+            # the outputs of every image are those of the layer it left the decoder at
+            if self.two_stage:
+                out['enc_outputs'] = {'pred_logits': enc_outputs_class, 'pred_boxes': enc_outputs_coord_unact.sigmoid()}
+            return out
 
         outputs_classes = []
         outputs_coords = []
         outputs_objectnesses = []
 
-        for lvl in range(hs.shape[0]):
-            if lvl == 0:
-                reference = init_reference
-            else:
-                reference = inter_references[lvl - 1]
-            reference = inverse_sigmoid(reference)
+        for lvl in range(hs.shape[0] - 1 if last_layer_only else 0, hs.shape[0]):
             outputs_class = self.class_embed[lvl](hs[lvl])
             outputs_objectness = self.prob_obj_head[lvl](hs[lvl])
 
-            tmp = self.bbox_embed[lvl](hs[lvl])
-            if reference.shape[-1] == 4:
-                tmp += reference
+            if last_layer_only and self.transformer.decoder.bbox_embed is not None:
+                # iterative box refinement: the decoder already computed bbox_embed[lvl](hs[lvl]) + reference
+                outputs_coord = inter_references[lvl]
             else:
-                assert reference.shape[-1] == 2
-                tmp[..., :2] += reference
-                
-            outputs_coord = tmp.sigmoid()
+                if lvl == 0:
+                    reference = init_reference
+                else:
+                    reference = inter_references[lvl - 1]
+                reference = inverse_sigmoid(reference)
+
+                tmp = self.bbox_embed[lvl](hs[lvl])
+                if reference.shape[-1] == 4:
+                    tmp += reference
+                else:
+                    assert reference.shape[-1] == 2
+                    tmp[..., :2] += reference
+
+                outputs_coord = tmp.sigmoid()
             outputs_classes.append(outputs_class)
             outputs_coords.append(outputs_coord)
             outputs_objectnesses.append(outputs_objectness)
@@ -277,8 +441,9 @@ class DeformableDETR(nn.Module):
 
         out = {'pred_logits': outputs_class[-1], 'pred_boxes': outputs_coord[-1], 'pred_obj':outputs_objectness[-1]} 
         
-        if self.aux_loss:
+        if self.aux_loss and not last_layer_only:
             out['aux_outputs'] = self._set_aux_loss(outputs_class, outputs_coord, outputs_objectness)
+            out['stacked_outputs'] = {'pred_logits': outputs_class, 'pred_obj': outputs_objectness, 'pred_boxes': outputs_coord}
 
         if self.two_stage:
             enc_outputs_coord = enc_outputs_coord_unact.sigmoid()
@@ -319,6 +484,17 @@ class SetCriterion(nn.Module):
         self.empty_weight=empty_weight
         self.invalid_cls_logits = invalid_cls_logits
         self.min_obj=-hidden_dim*math.log(0.9)
+        self._class_weights = {}
+
+    def class_weight(self, logits):
+        # the focal loss weight of each class: empty_weight for the last (no object) one, 0 for the invalid ones
+        key = (logits.device, logits.dtype)
+        if key not in self._class_weights:
+            weight = torch.ones(self.num_classes, dtype=logits.dtype, device=logits.device)
+            weight[-1] = self.empty_weight
+            weight[self.invalid_cls_logits] = 0
+            self._class_weights[key] = weight
+        return self._class_weights[key]
 
 
     def loss_labels(self, outputs, targets, indices, num_boxes, log=True):
@@ -326,28 +502,25 @@ class SetCriterion(nn.Module):
         targets dicts must contain the key "labels" containing a tensor of dim [nb_target_boxes]
         """
         assert 'pred_logits' in outputs
-        temp_src_logits = outputs['pred_logits'].clone()
-        temp_src_logits[:,:, self.invalid_cls_logits] = -10e10
-        src_logits = temp_src_logits
-        
+        src_logits = outputs['pred_logits']
+
         idx = self._get_src_permutation_idx(indices)
         target_classes_o = torch.cat([t["labels"][J] for t, (_, J) in zip(targets, indices)])
         
         target_classes = torch.full(src_logits.shape[:2], self.num_classes-1, dtype=torch.int64, device=src_logits.device)
         target_classes[idx] = target_classes_o
-        target_classes_onehot = torch.zeros([src_logits.shape[0], src_logits.shape[1], src_logits.shape[2]],
-                                            dtype=src_logits.dtype, layout=src_logits.layout, device=src_logits.device)
-
-        target_classes_onehot.scatter_(2, target_classes.unsqueeze(-1), 1)
 
-        loss_ce = sigmoid_focal_loss(src_logits, target_classes_onehot, num_boxes, alpha=self.focal_alpha, 
-                                     num_classes=self.num_classes, empty_weight=self.empty_weight) * src_logits.shape[1]
+        # the invalid classes are ignored, as if their logits were -inf
+        loss_ce = sigmoid_focal_loss_fused(src_logits, target_classes, num_boxes, self.class_weight(src_logits),
+                                           alpha=self.focal_alpha)
 
         losses = {'loss_ce': loss_ce}
 
         if log:
             # TODO this should probably be a separate loss, not hacked in this one here
-            losses['class_error'] = 100 - accuracy(src_logits[idx], target_classes_o)[0]
+            matched_logits = src_logits[idx].detach()
+            matched_logits[:, self.invalid_cls_logits] = -10e10
+            losses['class_error'] = 100 - accuracy(matched_logits, target_classes_o)[0]
         return losses
 
     @torch.no_grad()
@@ -379,9 +552,9 @@ class SetCriterion(nn.Module):
         losses = {}
         losses['loss_bbox'] = loss_bbox.sum() / num_boxes
 
-        loss_giou = 1 - torch.diag(box_ops.generalized_box_iou(
+        loss_giou = 1 - box_ops.paired_generalized_box_iou(
             box_ops.box_cxcywh_to_xyxy(src_boxes),
-            box_ops.box_cxcywh_to_xyxy(target_boxes)))
+            box_ops.box_cxcywh_to_xyxy(target_boxes))
         losses['loss_giou'] = loss_giou.sum() / num_boxes
         return losses
 
@@ -420,6 +593,75 @@ class SetCriterion(nn.Module):
         pred_obj = outputs["pred_obj"][idx]
         return  {'loss_obj_ll': torch.clamp(pred_obj, min=self.min_obj).sum()/ num_boxes}
 
+    def stacked_loss_labels(self, outputs, targets, layer_indices, num_boxes, log=True):
+        """loss_labels of every layer at once, outputs holding the predictions of all the layers stacked as
+        [num_layers x batch_size x num_queries x ...] and layer_indices the matching of each. class_error is
+        logged for the last layer only
+        """
+        assert 'pred_logits' in outputs
+        src_logits = outputs['pred_logits']
+
+        idx = self._get_stacked_src_permutation_idx(layer_indices)
+        target_classes_o = torch.cat([t["labels"] for t in targets])[self._get_stacked_tgt_idx(targets, layer_indices)]
+
+        target_classes = torch.full(src_logits.shape[:3], self.num_classes-1, dtype=torch.int64, device=src_logits.device)
+        target_classes[idx] = target_classes_o
+
+        loss_ce = sigmoid_focal_loss_fused(src_logits, target_classes, num_boxes, self.class_weight(src_logits),
+                                           alpha=self.focal_alpha)
+
+        losses = [{'loss_ce': l} for l in loss_ce]
+        if log:
+            # every layer has the same number of matches
+            first = len(target_classes_o) - len(target_classes_o) // len(layer_indices)
+            matched_logits = src_logits[tuple(i[first:] for i in idx)].detach()
+            matched_logits[:, self.invalid_cls_logits] = -10e10
+            losses[-1]['class_error'] = 100 - accuracy(matched_logits, target_classes_o[first:])[0]
+        return losses
+
+    @torch.no_grad()
+    def stacked_loss_cardinality(self, outputs, targets, layer_indices, num_boxes):
+        pred_logits = outputs['pred_logits']
+        tgt_lengths = torch.as_tensor([len(v["labels"]) for v in targets], device=pred_logits.device)
+        card_pred = (pred_logits.argmax(-1) != pred_logits.shape[-1] - 1).sum(-1)
+        card_err = F.l1_loss(card_pred.float(), tgt_lengths.float().expand_as(card_pred), reduction='none').mean(-1)
+        return [{'cardinality_error': e} for e in card_err]
+
+    def stacked_loss_boxes(self, outputs, targets, layer_indices, num_boxes):
+        assert 'pred_boxes' in outputs
+        idx = self._get_stacked_src_permutation_idx(layer_indices)
+        src_boxes = outputs['pred_boxes'][idx]
+        target_boxes = torch.cat([t['boxes'] for t in targets])[self._get_stacked_tgt_idx(targets, layer_indices)]
+
+        # every layer has the same number of matches
+        num_layers = len(layer_indices)
+        loss_bbox = F.l1_loss(src_boxes, target_boxes, reduction='none').view(num_layers, -1).sum(1) / num_boxes
+        loss_giou = 1 - box_ops.paired_generalized_box_iou(
+            box_ops.box_cxcywh_to_xyxy(src_boxes),
+            box_ops.box_cxcywh_to_xyxy(target_boxes))
+        loss_giou = loss_giou.view(num_layers, -1).sum(1) / num_boxes
+        return [{'loss_bbox': b, 'loss_giou': g} for b, g in zip(loss_bbox, loss_giou)]
+
+    def stacked_loss_obj_likelihood(self, outputs, targets, layer_indices, num_boxes):
+        assert "pred_obj" in outputs
+        idx = self._get_stacked_src_permutation_idx(layer_indices)
+        pred_obj = torch.clamp(outputs["pred_obj"][idx], min=self.min_obj)
+        return [{'loss_obj_ll': l} for l in pred_obj.view(len(layer_indices), -1).sum(1) / num_boxes]
+
+    def _get_stacked_src_permutation_idx(self, layer_indices):
+        # permute the predictions of every layer following its indices, layer after layer
+        layer_idx = torch.cat([torch.full_like(src, l) for l, indices in enumerate(layer_indices) for (src, _) in indices])
+        batch_idx = torch.cat([torch.full_like(src, i) for indices in layer_indices for i, (src, _) in enumerate(indices)])
+        src_idx = torch.cat([src for indices in layer_indices for (src, _) in indices])
+        return layer_idx, batch_idx, src_idx
+
+    def _get_stacked_tgt_idx(self, targets, layer_indices):
+        # indices of the matched targets of every layer in the concatenated targets, layer after layer
+        offsets = [0]
+        for t in targets[:-1]:
+            offsets.append(offsets[-1] + len(t["labels"]))
+        return torch.cat([tgt + offset for indices in layer_indices for offset, (_, tgt) in zip(offsets, indices)])
+
     def _get_src_permutation_idx(self, indices):
         # permute predictions following indices
         batch_idx = torch.cat([torch.full_like(src, i) for i, (src, _) in enumerate(indices)])
@@ -443,6 +685,16 @@ class SetCriterion(nn.Module):
         assert loss in loss_map, f'do you really want to compute {loss} loss?'
         return loss_map[loss](outputs, targets, indices, num_boxes, **kwargs)
 
+    def get_stacked_loss(self, loss, outputs, targets, layer_indices, num_boxes, **kwargs):
+        loss_map = {
+            'labels': self.stacked_loss_labels,
+            'cardinality': self.stacked_loss_cardinality,
+            'boxes': self.stacked_loss_boxes,
+            'obj_likelihood': self.stacked_loss_obj_likelihood,
+        }
+        assert loss in loss_map, f'do you really want to compute {loss} loss?'
+        return loss_map[loss](outputs, targets, layer_indices, num_boxes, **kwargs)
+
     def forward(self, outputs, targets):
         """ This performs the loss computation.
         Parameters:
@@ -450,10 +702,19 @@ class SetCriterion(nn.Module):
              targets: list of dicts, such that len(targets) == batch_size.
                       The expected keys in each dict depends on the losses applied, see each loss' doc
         """
-        outputs_without_aux = {k: v for k, v in outputs.items() if k != 'aux_outputs' and k != 'enc_outputs' and k !='pred_obj'}
+        outputs_without_aux = {k: v for k, v in outputs.items() if k not in ('aux_outputs', 'stacked_outputs', 'enc_outputs', 'pred_obj')}
 
-        # Retrieve the matching between the outputs of the last layer and the targets
-        indices = self.matcher(outputs_without_aux, targets)
+        # Retrieve the matching between the outputs of every layer and the targets, all solved at once
+        layer_outputs = [outputs_without_aux] + outputs.get('aux_outputs', [])
+        layer_targets = [targets] * len(layer_outputs)
+        if 'enc_outputs' in outputs:
+            bin_targets = copy.deepcopy(targets)
+            for bt in bin_targets:
+                bt['labels'] = torch.zeros_like(bt['labels'])
+            layer_outputs.append(outputs['enc_outputs'])
+            layer_targets.append(bin_targets)
+        layer_indices = self.matcher.match_layers(layer_outputs, layer_targets)
+        indices = layer_indices[0]
 
         # Compute the average number of target boxes accross all nodes, for normalization purposes
         num_boxes = sum(len(t["labels"]) for t in targets)
@@ -464,14 +725,30 @@ class SetCriterion(nn.Module):
 
         # Compute all the requested losses
         losses = {}
-        for loss in self.losses:
-            kwargs = {}
-            losses.update(self.get_loss(loss, outputs, targets, indices, num_boxes, **kwargs))
+        if 'stacked_outputs' in outputs:
+            # the losses of all the decoder layers at once, the last one being the final outputs
+            num_aux = len(outputs['aux_outputs'])
+            layer_losses = [{} for _ in range(num_aux + 1)]
+            for loss in self.losses:
+                if loss == 'masks':
+                    layer_losses[-1].update(self.get_loss(loss, outputs, targets, indices, num_boxes))
+                    continue
+                l_dicts = self.get_stacked_loss(loss, outputs['stacked_outputs'], targets,
+                                                layer_indices[1:num_aux + 1] + [indices], num_boxes)
+                for layer_loss, l_dict in zip(layer_losses, l_dicts):
+                    layer_loss.update(l_dict)
+            losses.update(layer_losses[-1])
+            for i, l_dict in enumerate(layer_losses[:-1]):
+                losses.update({k + f'_{i}': v for k, v in l_dict.items()})
+        else:
+            for loss in self.losses:
+                kwargs = {}
+                losses.update(self.get_loss(loss, outputs, targets, indices, num_boxes, **kwargs))
 
         # In case of auxiliary losses, we repeat this process with the output of each intermediate layer.
-        if 'aux_outputs' in outputs:
+        if 'aux_outputs' in outputs and 'stacked_outputs' not in outputs:
             for i, aux_outputs in enumerate(outputs['aux_outputs']):
-                indices = self.matcher(aux_outputs, targets)
+                indices = layer_indices[i + 1]
                 for loss in self.losses:
                     if loss == 'masks':
                         # Intermediate masks losses are too costly to compute, we ignore them.
@@ -486,10 +763,7 @@ class SetCriterion(nn.Module):
 
         if 'enc_outputs' in outputs:
             enc_outputs = outputs['enc_outputs']
-            bin_targets = copy.deepcopy(targets)
-            for bt in bin_targets:
-                bt['labels'] = torch.zeros_like(bt['labels'])
-            indices = self.matcher(enc_outputs, bin_targets)
+            indices = layer_indices[-1]
             for loss in self.losses:
                 if loss == 'masks':
                     # Intermediate masks losses are too costly to compute, we ignore them.
@@ -523,11 +797,22 @@ class PostProcess(nn.Module):
                           For visualization, this should be the image size after data augment, but before padding
         """        
         out_logits, pred_obj, out_bbox = outputs['pred_logits'], outputs['pred_obj'], outputs['pred_boxes']
-        out_logits[:,:, self.invalid_cls_logits] = -10e10
 
         assert len(out_logits) == len(target_sizes)
         assert target_sizes.shape[1] == 2
 
+        scores, labels, boxes = self.scores_labels_boxes(out_logits, pred_obj, out_bbox, target_sizes)
+        results = [{'scores': s, 'labels': l, 'boxes': b} for s, l, b in zip(scores, labels, boxes)]
+        return results
+
+    def scores_labels_boxes(self, out_logits, pred_obj, out_bbox, target_sizes):
+        """ Tensor part of forward, also used by the exported model (see ExportableDetector).
+            Returns the pred_per_im best scores, labels and absolute xyxy boxes of every image,
+            of shape [batch_size x pred_per_im] ([batch_size x pred_per_im x 4] for the boxes).
+            out_logits is modified in place: the invalid class logits are masked.
+        """
+        out_logits[:,:, self.invalid_cls_logits] = -10e10
+
         obj_prob = torch.exp(-self.temperature*pred_obj).unsqueeze(-1)
         prob = obj_prob*out_logits.sigmoid()
 
@@ -542,8 +827,94 @@ class PostProcess(nn.Module):
         img_h, img_w = target_sizes.unbind(1)
         scale_fct = torch.stack([img_w, img_h, img_w, img_h], dim=1)
         boxes = boxes * scale_fct[:, None, :]
-        results = [{'scores': s, 'labels': l, 'boxes': b} for s, l, b in zip(scores, labels, boxes)]
-        return results
+        return scores, labels, boxes
+
+
+class ExportableDetector(nn.Module):
+    """ Inference-only wrapper of DeformableDETR and PostProcess with plain tensor inputs and outputs, for
+        torch.jit.trace and torch.onnx.export (see export_model.py). The graph is traced for one padded batch shape.
+    """
+    def __init__(self, model, postprocess):
+        super().__init__()
+        self.model = model
+        self.postprocess = postprocess
+
+    def forward(self, images, image_sizes, orig_sizes):
+        """ Parameters:
+            images: padded batch of normalized images, [batch_size x 3 x H x W]
+            image_sizes: [batch_size x 2] (h, w) of every image in the padded batch, the rest is padding
+            orig_sizes: [batch_size x 2] (h, w) the boxes are scaled to, as target_sizes in PostProcess
+        Returns the scores, labels and boxes tensors of PostProcess.scores_labels_boxes
+        """
+        height, width = images.shape[-2:]
+        rows = torch.arange(height, device=images.device)
+        cols = torch.arange(width, device=images.device)
+        mask = (rows[None, :, None] >= image_sizes[:, 0, None, None]) | (cols[None, None, :] >= image_sizes[:, 1, None, None])
+        outputs = self.model(NestedTensor(images, mask))
+        return self.postprocess.scores_labels_boxes(
+            outputs['pred_logits'], outputs['pred_obj'], outputs['pred_boxes'], orig_sizes)
+
+
+class DecoderEarlyExit(object):
+    """ Early exit of the decoder at inference. After every decoder layer, the class, box and objectness heads of that
+        layer are applied to the images still in the decoder, and an image leaves it once the top pred_per_im scores
+        of postprocess and their boxes (normalized) all change by less than tolerance from the previous layer.
+        Its outputs are those of the layer it left at. exit_layers counts the images that left after each layer.
+    """
+    def __init__(self, postprocess, tolerance):
+        self.postprocess = postprocess
+        self.tolerance = tolerance
+        self.exit_layers = Counter()
+
+    def layer_done(self, model, batch_size, out):
+        """ Returns the layer_done function of DeformableTransformerDecoder for a batch of model,
+            which fills out with the pred_logits, pred_boxes and pred_obj of every image.
+        """
+        num_layers = model.transformer.decoder.num_layers
+        previous = {}
+
+        def layer_done(lid, hs, reference, new_reference, active):
+            outputs = {'pred_logits': model.class_embed[lid](hs), 'pred_obj': model.prob_obj_head[lid](hs)}
+            if model.transformer.decoder.bbox_embed is not None:
+                # iterative box refinement: the decoder already computed bbox_embed[lid](hs) + reference
+                outputs['pred_boxes'] = new_reference
+            else:
+                tmp = model.bbox_embed[lid](hs)
+                if reference.shape[-1] == 4:
+                    tmp += inverse_sigmoid(reference)
+                else:
+                    tmp[..., :2] += inverse_sigmoid(reference)
+                outputs['pred_boxes'] = tmp.sigmoid()
+            for k, v in outputs.items():
+                if k not in out:
+                    out[k] = v.new_empty((batch_size,) + v.shape[1:])
+                out[k][active] = v
+
+            if lid == num_layers - 1:
+                done = torch.ones_like(active, dtype=torch.bool)
+            else:
+                # masks the invalid class logits in place, out already has its copy
+                scores, _, boxes = self.postprocess.scores_labels_boxes(
+                    outputs['pred_logits'], outputs['pred_obj'], outputs['pred_boxes'], hs.new_ones(len(active), 2))
+                if previous:
+                    change = torch.maximum((scores - previous['scores'][active]).abs().amax(1),
+                                           (boxes - previous['boxes'][active]).abs().flatten(1).amax(1))
+                    done = change < self.tolerance
+                else:
+                    done = torch.zeros_like(active, dtype=torch.bool)
+                    previous['scores'] = scores.new_empty((batch_size,) + scores.shape[1:])
+                    previous['boxes'] = boxes.new_empty((batch_size,) + boxes.shape[1:])
+                previous['scores'][active] = scores
+                previous['boxes'][active] = boxes
+            self.exit_layers[lid + 1] += int(done.sum())
+            return done
+        return layer_done
+
+    def stats(self):
+        num_images = sum(self.exit_layers.values())
+        return {'images': num_images,
+                'mean_layers': sum(l * n for l, n in self.exit_layers.items()) / num_images if num_images else 0.0,
+                'exit_layers': {l: self.exit_layers[l] for l in sorted(self.exit_layers)}}
 
 
 class MLP(nn.Module):
@@ -610,6 +981,9 @@ def build(args):
         aux_loss=args.aux_loss,
         with_box_refine=args.with_box_refine,
         two_stage=args.two_stage,
+        # per image size combination, a position embedding per feature level and the transformer inputs
+        shape_cache=ShapeCache(args.shape_cache_size * (args.num_feature_levels + 1))
+        if getattr(args, 'shape_cache_size', 0) > 0 else None,
     )
     
     if args.masks:
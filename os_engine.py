@@ -18,7 +18,7 @@ from typing import Iterable
 import torch
 import util.misc as utils
 from datasets.coco_eval import CocoEvaluator
-from datasets.coco_eval_cls_agn import CocoEvaluatorClsAgn
+from datasets.coco_eval_cls_agn import CocoEvaluatorClsAgn, VectorizedCocoEvaluatorClsAgn
 from datasets.panoptic_eval import PanopticEvaluator
 from datasets.data_prefetcher import data_prefetcher
 from util.box_ops import box_xyxy_to_cxcywh, box_cxcywh_to_xyxy
@@ -103,7 +103,10 @@ def evaluate(model, criterion, postprocessors, data_loader, base_ds, device, out
     metric_logger = utils.MetricLogger(delimiter="  ")
     header = 'Test:'
     iou_types = tuple(k for k in ('segm', 'bbox') if k in postprocessors.keys())
-    coco_evaluator = CocoEvaluatorClsAgn(base_ds, iou_types, args=args)
+    if iou_types == ('bbox',):
+        coco_evaluator = VectorizedCocoEvaluatorClsAgn(base_ds, iou_types)
+    else:
+        coco_evaluator = CocoEvaluatorClsAgn(base_ds, iou_types)
  
     panoptic_evaluator = None
     if 'panoptic' in postprocessors.keys():
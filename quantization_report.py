@@ -0,0 +1,78 @@
+# ------------------------------------------------------------------------
+# PROB: Probabilistic Objectness for Open World Object Detection
+# Orr Zohar, Jackson Wang, Serena Yeung
+# ------------------------------------------------------------------------
+
+"""
+Evaluates a checkpoint on CPU twice, in float and with dynamic int8 linear layers (see --quantize_int8),
+and reports the model latency per image and the change in K-AP50 and U-Recall50.
+Takes the dataset and model arguments of main_open_world.py, e.g.
+python quantization_report.py --dataset TOWOD --PREV_INTRODUCED_CLS 0 --CUR_INTRODUCED_CLS 20 \
+    --test_set 'owod_all_task_test' --pretrain exps/MOWODB/PROB/t1.pth --device cpu --wandb_project ""
+"""
+import argparse
+import json
+
+import torch
+from torch.utils.data import DataLoader, SequentialSampler, Subset
+
+import util.misc as utils
+from datasets.coco import make_coco_transforms
+from datasets.torchvision_datasets.open_world import OWDetection
+from engine import evaluate_timed
+from main_open_world import attach_early_exit, get_args_parser as get_main_args_parser
+from models import build_model
+
+REPORT_METRICS = ('K_AP50', 'U_R50')
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('PROB int8 quantization report', add_help=False)
+    parser.add_argument('--report_images', default=0, type=int,
+                        help='evaluate the first N test images only, 0 for all. Recall is still computed against '
+                             'the ground truth of the whole test set, only the float/int8 difference is meaningful')
+    parser.add_argument('--report_output', default='', type=str, help='json file the report is written to')
+    return parser
+
+
+def main(args):
+    assert args.device == 'cpu', "int8 quantization is meant for CPU evaluation only"
+    torch.manual_seed(args.seed)
+    print('threads: {}'.format(utils.setup_cpu_inference(args.cpu_threads)))
+
+    model, _, postprocessors, _ = build_model(args, mode=args.model_type)
+    checkpoint_path = args.resume or args.pretrain
+    if checkpoint_path:
+        checkpoint = torch.load(checkpoint_path, map_location='cpu')
+        print(model.load_state_dict(checkpoint['model'], strict=False))
+    model.backbone[0].use_channels_last()
+    model.eval()
+    attach_early_exit(args, model, postprocessors)
+    models = [('float', model), ('int8', utils.quantize_dynamic_int8(model, args.quant_keep_float))]
+
+    dataset_val = OWDetection(args, args.data_root, image_set=args.test_set, dataset=args.dataset,
+                              transforms=make_coco_transforms(args.test_set))
+    dataset = Subset(dataset_val, range(min(args.report_images, len(dataset_val)))) if args.report_images else dataset_val
+    data_loader = DataLoader(dataset, args.batch_size, sampler=SequentialSampler(dataset), drop_last=False,
+                             collate_fn=utils.collate_fn, num_workers=args.num_workers)
+
+    report = {'keep_float': args.quant_keep_float, 'images': len(dataset)}
+    for name, m in models:
+        latency, metrics = evaluate_timed(m, postprocessors, data_loader, dataset_val, args)
+        report[name] = dict(ms_per_image=latency, **{k: float(metrics[k]) for k in REPORT_METRICS})
+
+    print('\t'.join(['', 'ms/image'] + list(REPORT_METRICS)))
+    for name in ('float', 'int8'):
+        print('\t'.join([name, '{:.1f}'.format(report[name]['ms_per_image'])] +
+                        ['{:.4f}'.format(report[name][k]) for k in REPORT_METRICS]))
+    print('\t'.join(['change', '{:.2f}x'.format(report['float']['ms_per_image'] / report['int8']['ms_per_image'])] +
+                    ['{:+.4f}'.format(report['int8'][k] - report['float'][k]) for k in REPORT_METRICS]))
+    if args.report_output:
+        with open(args.report_output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('PROB int8 quantization report', parents=[get_main_args_parser(), get_args_parser()])
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,70 @@
+# ------------------------------------------------------------------------
+# PROB: Probabilistic Objectness for Open World Object Detection
+# Orr Zohar, Jackson Wang, Serena Yeung
+# ------------------------------------------------------------------------
+
+"""
+Re-runs PostProcess and the open world evaluation on raw outputs stored by an evaluation run
+with --dump_outputs, for a grid of objectness temperatures and predictions per image.
+No model and no images are needed.
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from datasets.open_world_eval import OWEvaluator
+from datasets.torchvision_datasets.open_world import OWDetection
+from main_open_world import get_args_parser as get_main_args_parser
+from models.prob_deformable_detr import PostProcess
+from util.output_store import iter_output_batches
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('PROB offline re-scoring', add_help=False)
+    parser.add_argument('--outputs_dir', required=True, type=str, help='directory written by --dump_outputs')
+    parser.add_argument('--obj_temps', default=[1.0], type=float, nargs='+', help='obj_temp values to evaluate')
+    parser.add_argument('--pred_per_ims', default=[100], type=int, nargs='+', help='predictions kept per image')
+    parser.add_argument('--rescore_batch_size', default=64, type=int)
+    parser.add_argument('--rescore_output', default='', type=str, help='json file the metrics of every setting are written to')
+    return parser
+
+
+def rescore(args, dataset, obj_temp, pred_per_im):
+    invalid_cls_logits = list(range(args.PREV_INTRODUCED_CLS+args.CUR_INTRODUCED_CLS, args.num_classes-1))
+    postprocess = PostProcess(invalid_cls_logits, temperature=obj_temp/args.hidden_dim, pred_per_im=pred_per_im)
+    evaluator = OWEvaluator(dataset, ('bbox',), args=args)
+    for outputs, orig_target_sizes, image_ids in iter_output_batches(args.outputs_dir, args.rescore_batch_size):
+        results = postprocess(outputs, orig_target_sizes)
+        evaluator.update({image_id: output for image_id, output in zip(image_ids, results)})
+    evaluator.synchronize_between_processes()
+    evaluator.accumulate()
+    return evaluator.summarize()
+
+
+def main(args):
+    dataset_val = OWDetection(args, args.data_root, image_set=args.test_set, dataset=args.dataset, transforms=None)
+
+    all_metrics = []
+    for obj_temp in args.obj_temps:
+        for pred_per_im in args.pred_per_ims:
+            start_time = time.time()
+            metrics = rescore(args, dataset_val, obj_temp, pred_per_im)
+            metrics = {k: float(np.asarray(v)) for k, v in metrics.items()}
+            all_metrics.append(dict(obj_temp=obj_temp, pred_per_im=pred_per_im, **metrics))
+            print('obj_temp {} pred_per_im {} done in {:.1f}s'.format(obj_temp, pred_per_im, time.time() - start_time))
+
+    keys = ['obj_temp', 'pred_per_im'] + [k for k in all_metrics[0] if k not in ('obj_temp', 'pred_per_im')]
+    print('\t'.join(keys))
+    for metrics in all_metrics:
+        print('\t'.join('{:.4f}'.format(metrics[k]) if isinstance(metrics[k], float) else str(metrics[k]) for k in keys))
+    if args.rescore_output:
+        with open(args.rescore_output, 'w') as f:
+            json.dump(all_metrics, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('PROB offline re-scoring', parents=[get_main_args_parser(), get_args_parser()])
+    args = parser.parse_args()
+    main(args)
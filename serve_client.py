@@ -0,0 +1,102 @@
+# ------------------------------------------------------------------------
+# PROB: Probabilistic Objectness for Open World Object Detection
+# Orr Zohar, Jackson Wang, Serena Yeung
+# ------------------------------------------------------------------------
+
+"""
+Load-test client for serve_model.py: sends --requests images to /detect from --concurrency connections
+and reports the throughput, the latency percentiles and the server's batching statistics.
+The images are synthetic JPEGs, or the files of --image_dir, e.g.
+python serve_client.py --requests 64 --concurrency 8 --image_size 500 375
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+from util.serving import encode_request, read_message
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('PROB server load test')
+    parser.add_argument('--host', default='127.0.0.1', type=str)
+    parser.add_argument('--port', default=8000, type=int)
+    parser.add_argument('--requests', default=64, type=int)
+    parser.add_argument('--concurrency', default=8, type=int, help='connections sending requests concurrently')
+    parser.add_argument('--image_size', default=[500, 375], type=int, nargs=2, help='width and height of the synthetic images')
+    parser.add_argument('--image_dir', default='', type=str, help='send the images of this directory instead')
+    parser.add_argument('--seed', default=0, type=int)
+    return parser
+
+
+def load_images(args):
+    if args.image_dir:
+        names = sorted(os.listdir(args.image_dir))[:args.requests]
+        images = []
+        for name in names:
+            with open(os.path.join(args.image_dir, name), 'rb') as f:
+                images.append(f.read())
+        return images
+    rng = np.random.RandomState(args.seed)
+    width, height = args.image_size
+    images = []
+    for _ in range(min(args.requests, 8)):
+        buffer = io.BytesIO()
+        Image.fromarray(rng.randint(0, 256, (height, width, 3), dtype=np.uint8)).save(buffer, format='JPEG')
+        images.append(buffer.getvalue())
+    return images
+
+
+async def call(reader, writer, method, path, body=b''):
+    writer.write(encode_request(method, path, body))
+    await writer.drain()
+    (_, status, *_), _, response = await read_message(reader)
+    return int(status), json.loads(response)
+
+
+async def worker(args, images, next_request, latencies, errors):
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    try:
+        while next_request[0] < args.requests:
+            i = next_request[0]
+            next_request[0] += 1
+            start_time = time.perf_counter()
+            status, response = await call(reader, writer, 'POST', '/detect', images[i % len(images)])
+            if status == 200:
+                latencies.append(time.perf_counter() - start_time)
+            else:
+                errors.append(response)
+    finally:
+        writer.close()
+
+
+async def load_test(args):
+    images = load_images(args)
+    next_request, latencies, errors = [0], [], []
+    start_time = time.perf_counter()
+    await asyncio.gather(*[worker(args, images, next_request, latencies, errors) for _ in range(args.concurrency)])
+    total_time = time.perf_counter() - start_time
+
+    print('{} requests ({} errors) from {} connections in {:.2f}s: {:.2f} requests/sec'.format(
+        args.requests, len(errors), args.concurrency, total_time, len(latencies) / total_time))
+    if errors:
+        print('first error: {}'.format(errors[0]))
+    if latencies:
+        latencies = 1000 * np.array(latencies)
+        print('latency ms: mean {:.1f}, p50 {:.1f}, p90 {:.1f}, p99 {:.1f}, max {:.1f}'.format(
+            latencies.mean(), *np.percentile(latencies, [50, 90, 99]), latencies.max()))
+
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    _, stats = await call(reader, writer, 'GET', '/stats')
+    writer.close()
+    print('server: {}'.format(json.dumps(stats)))
+
+
+if __name__ == '__main__':
+    args = get_args_parser().parse_args()
+    asyncio.run(load_test(args))
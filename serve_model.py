@@ -0,0 +1,173 @@
+# ------------------------------------------------------------------------
+# PROB: Probabilistic Objectness for Open World Object Detection
+# Orr Zohar, Jackson Wang, Serena Yeung
+# ------------------------------------------------------------------------
+
+"""
+Online detection server: an asyncio HTTP service running the detector and its PostProcess on single images,
+with concurrent requests grouped into batches (see util.serving.DynamicBatcher).
+    POST /detect  body: an encoded image (JPEG, PNG, ...), returns its detections as json
+                  {"scores": [...], "labels": [...], "names": [...], "boxes": [[x0, y0, x1, y1], ...]}
+    GET  /stats   request, batch size and queue depth counts, and the shape cache statistics
+    GET  /health
+Takes the model arguments of main_open_world.py, e.g.
+python serve_model.py --pretrain exps/MOWODB/PROB/t1.pth --PREV_INTRODUCED_CLS 0 --CUR_INTRODUCED_CLS 20 \
+    --device cpu --serve_max_batch_size 4 --wandb_project ""
+and can be load-tested with serve_client.py.
+"""
+import argparse
+import asyncio
+import io
+import time
+
+import torch
+from PIL import Image
+
+import util.misc as utils
+from datasets.coco import make_coco_transforms
+from datasets.torchvision_datasets.open_world import VOC_COCO_CLASS_NAMES
+from main_open_world import attach_early_exit, get_args_parser as get_main_args_parser
+from models import build_model
+from util.serving import DynamicBatcher, HTTPError, encode_response, read_message
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('PROB server', add_help=False)
+    parser.add_argument('--serve_host', default='127.0.0.1', type=str)
+    parser.add_argument('--serve_port', default=8000, type=int)
+    parser.add_argument('--serve_max_batch_size', default=4, type=int)
+    parser.add_argument('--serve_max_wait_ms', default=10, type=float,
+                        help='how long the first request of a batch waits for others to join it')
+    parser.add_argument('--serve_min_score', default=0.0, type=float,
+                        help='detections with a lower score are not returned')
+    return parser
+
+
+class Detector(object):
+    """Decodes images and runs a batch of them through the model and PostProcess."""
+
+    def __init__(self, model, postprocessor, device, class_names, min_score=0.0):
+        self.model = model
+        self.postprocessor = postprocessor
+        self.device = device
+        self.class_names = class_names
+        self.min_score = min_score
+        self.transform = make_coco_transforms('test')[-1]
+
+    def preprocess(self, data):
+        image = Image.open(io.BytesIO(data)).convert('RGB')
+        width, height = image.size
+        return self.transform(image, None)[0], (height, width)
+
+    @torch.no_grad()
+    def __call__(self, items):
+        samples = utils.nested_tensor_from_tensor_list([image for image, _ in items]).to(self.device)
+        orig_sizes = torch.tensor([size for _, size in items], device=self.device)
+        results = self.postprocessor(self.model(samples), orig_sizes)
+        detections = []
+        for r in results:
+            keep = r['scores'] >= self.min_score
+            labels = r['labels'][keep].tolist()
+            detections.append({'scores': r['scores'][keep].tolist(), 'labels': labels,
+                               'names': [self.class_names[l] for l in labels],
+                               'boxes': r['boxes'][keep].tolist()})
+        return detections
+
+
+class Server(object):
+    def __init__(self, detector, batcher):
+        self.detector = detector
+        self.batcher = batcher
+        self.start_time = time.time()
+
+    async def route(self, method, path, body):
+        if path == '/detect':
+            if method != 'POST':
+                raise HTTPError(405, 'POST an encoded image to /detect')
+            loop = asyncio.get_running_loop()
+            try:
+                # decoding and resizing run on the default executor, off the event loop and the model thread
+                item = await loop.run_in_executor(None, self.detector.preprocess, body)
+            except Exception as e:
+                raise HTTPError(400, 'cannot decode image: {}'.format(e))
+            return await self.batcher.submit(item)
+        if path == '/stats':
+            stats = self.batcher.stats()
+            stats['uptime_s'] = time.time() - self.start_time
+            shape_cache = getattr(self.detector.model, 'shape_cache', None)
+            stats['shape_cache'] = shape_cache.stats() if shape_cache is not None else None
+            return stats
+        if path == '/health':
+            return {'status': 'ok'}
+        raise HTTPError(404, 'unknown path {}'.format(path))
+
+    async def handle(self, reader, writer):
+        """Serves the requests of one (keep-alive) connection."""
+        try:
+            while True:
+                try:
+                    message = await read_message(reader)
+                    if message is None:
+                        break
+                    (method, path, *_), headers, body = message
+                    keep_alive = headers.get('connection', '').lower() != 'close'
+                    status, payload = 200, await self.route(method, path, body)
+                except HTTPError as e:
+                    status, payload, keep_alive = e.status, {'error': str(e)}, e.status != 413
+                except (ValueError, UnicodeDecodeError):
+                    status, payload, keep_alive = 400, {'error': 'malformed request'}, False
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    break
+                except Exception as e:
+                    status, payload, keep_alive = 500, {'error': repr(e)}, False
+                writer.write(encode_response(status, payload, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        batching = asyncio.get_running_loop().create_task(self.batcher.run())
+        server = await asyncio.start_server(self.handle, host, port)
+        print('serving on http://{}:{}, batches of up to {} images, {} ms max wait'.format(
+            host, port, self.batcher.max_batch_size, 1000 * self.batcher.max_wait))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batching.cancel()
+
+
+def main(args):
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+
+    model, _, postprocessors, _ = build_model(args, mode=args.model_type)
+    checkpoint_path = args.resume or args.pretrain
+    if checkpoint_path:
+        checkpoint = torch.load(checkpoint_path, map_location='cpu')
+        print(model.load_state_dict(checkpoint['model'], strict=False))
+    model.to(device)
+    model.eval()
+    attach_early_exit(args, model, postprocessors)
+    if device.type == 'cpu':
+        print('threads: {}'.format(utils.setup_cpu_inference(args.cpu_threads)))
+        model.backbone[0].use_channels_last()
+        if args.quantize_int8:
+            model = utils.quantize_dynamic_int8(model, args.quant_keep_float)
+
+    detector = Detector(model, postprocessors['bbox'], device, VOC_COCO_CLASS_NAMES[args.dataset], args.serve_min_score)
+    batcher = DynamicBatcher(detector, args.serve_max_batch_size, args.serve_max_wait_ms)
+    try:
+        asyncio.run(Server(detector, batcher).serve(args.serve_host, args.serve_port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('PROB server', parents=[get_main_args_parser(), get_args_parser()])
+    args = parser.parse_args()
+    main(args)
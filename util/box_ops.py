@@ -11,7 +11,6 @@
 Utilities for bounding box manipulation and GIoU.
 """
 import torch
-from torchvision.ops.boxes import box_area
 
 
 def box_cxcywh_to_xyxy(x):
@@ -28,18 +27,38 @@ def box_xyxy_to_cxcywh(x):
     return torch.stack(b, dim=-1)
 
 
+# degenerate boxes give inf / nan results. Checking for them waits for the device,
+# so they are only checked for debugging (--check_boxes), asynchronously
+check_boxes = False
+
+
+def assert_valid_boxes(boxes):
+    """
+    If check_boxes is set, checks that the [..., 4] boxes in [x0, y0, x1, y1] format are not degenerate.
+    The check is queued on the boxes' device without waiting for it: on GPU, a failure
+    surfaces as a device-side assert at the next synchronization.
+    """
+    if check_boxes:
+        torch._assert_async((boxes[..., 2:] >= boxes[..., :2]).all())
+
+
+# as torchvision's, for boxes [..., 4] with any leading dimensions
+def box_area(boxes):
+    return (boxes[..., 2] - boxes[..., 0]) * (boxes[..., 3] - boxes[..., 1])
+
+
 # modified from torchvision to also return the union
 def box_iou(boxes1, boxes2):
     area1 = box_area(boxes1)
     area2 = box_area(boxes2)
 
-    lt = torch.max(boxes1[:, None, :2], boxes2[:, :2])  # [N,M,2]
-    rb = torch.min(boxes1[:, None, 2:], boxes2[:, 2:])  # [N,M,2]
+    lt = torch.max(boxes1[..., :, None, :2], boxes2[..., None, :, :2])  # [N,M,2]
+    rb = torch.min(boxes1[..., :, None, 2:], boxes2[..., None, :, 2:])  # [N,M,2]
 
     wh = (rb - lt).clamp(min=0)  # [N,M,2]
-    inter = wh[:, :, 0] * wh[:, :, 1]  # [N,M]
+    inter = wh[..., 0] * wh[..., 1]  # [N,M]
 
-    union = area1[:, None] + area2 - inter
+    union = area1[..., :, None] + area2[..., None, :] - inter
 
     iou = inter / union
     return iou, union
@@ -52,19 +71,57 @@ def generalized_box_iou(boxes1, boxes2):
     The boxes should be in [x0, y0, x1, y1] format
 
     Returns a [N, M] pairwise matrix, where N = len(boxes1)
-    and M = len(boxes2)
+    and M = len(boxes2). Batches of boxes [B, N, 4] and [B, M, 4]
+    give a [B, N, M] matrix.
     """
-    # degenerate boxes gives inf / nan results
-    # so do an early check
-    assert (boxes1[:, 2:] >= boxes1[:, :2]).all()
-    assert (boxes2[:, 2:] >= boxes2[:, :2]).all()
+    assert_valid_boxes(boxes1)
+    assert_valid_boxes(boxes2)
     iou, union = box_iou(boxes1, boxes2)
 
-    lt = torch.min(boxes1[:, None, :2], boxes2[:, :2])
-    rb = torch.max(boxes1[:, None, 2:], boxes2[:, 2:])
+    lt = torch.min(boxes1[..., :, None, :2], boxes2[..., None, :, :2])
+    rb = torch.max(boxes1[..., :, None, 2:], boxes2[..., None, :, 2:])
 
     wh = (rb - lt).clamp(min=0)  # [N,M,2]
-    area = wh[:, :, 0] * wh[:, :, 1]
+    area = wh[..., 0] * wh[..., 1]
+
+    return iou - (area - union) / area
+
+
+def paired_box_iou(boxes1, boxes2):
+    """
+    IoU and union of each pair of boxes (boxes1[i], boxes2[i]), the diagonal of box_iou
+    without its [N, N] matrices. The boxes are [..., 4] of the same shape.
+    """
+    area1 = box_area(boxes1)
+    area2 = box_area(boxes2)
+
+    lt = torch.max(boxes1[..., :2], boxes2[..., :2])  # [N,2]
+    rb = torch.min(boxes1[..., 2:], boxes2[..., 2:])  # [N,2]
+
+    wh = (rb - lt).clamp(min=0)  # [N,2]
+    inter = wh[..., 0] * wh[..., 1]  # [N]
+
+    union = area1 + area2 - inter
+
+    iou = inter / union
+    return iou, union
+
+
+def paired_generalized_box_iou(boxes1, boxes2):
+    """
+    Generalized IoU of each pair of boxes (boxes1[i], boxes2[i]) in [x0, y0, x1, y1] format.
+
+    Returns a [N] vector, the diagonal of generalized_box_iou(boxes1, boxes2)
+    """
+    assert_valid_boxes(boxes1)
+    assert_valid_boxes(boxes2)
+    iou, union = paired_box_iou(boxes1, boxes2)
+
+    lt = torch.min(boxes1[..., :2], boxes2[..., :2])
+    rb = torch.max(boxes1[..., 2:], boxes2[..., 2:])
+
+    wh = (rb - lt).clamp(min=0)  # [N,2]
+    area = wh[..., 0] * wh[..., 1]
 
     return iou - (area - union) / area
 
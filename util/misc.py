@@ -13,10 +13,11 @@ Misc functions, including distributed helpers.
 
 Mostly copy-paste from torchvision references.
 """
+import copy
 import os
 import subprocess
 import time
-from collections import defaultdict, deque
+from collections import OrderedDict, defaultdict, deque
 import datetime
 import pickle
 from typing import Optional, List
@@ -165,6 +166,44 @@ def all_gather(data):
     return data_list
 
 
+def all_gather_columns(columns):
+    """
+    Run all_gather on a dict of tensors sharing their first dimension, whose size may differ between ranks.
+    The per-rank sizes are gathered first, then every column is padded to the largest size and gathered
+    with a single all_gather, without pickling. Tensors are exchanged on the device the backend
+    works with (CUDA for nccl, CPU otherwise, e.g. gloo).
+    Args:
+        columns: dict of tensors with the same first dimension
+    Returns:
+        dict with, for each column, the tensors of all ranks concatenated in rank order
+    """
+    world_size = get_world_size()
+    if world_size == 1:
+        return type(columns)((k, v) for k, v in columns.items())
+
+    device = torch.device("cuda") if dist.get_backend() == "nccl" else torch.device("cpu")
+    local_size = len(next(iter(columns.values())))
+    size_list = [torch.zeros(1, dtype=torch.int64, device=device) for _ in range(world_size)]
+    dist.all_gather(size_list, torch.tensor([local_size], dtype=torch.int64, device=device))
+    size_list = [int(size.item()) for size in size_list]
+    max_size = max(size_list)
+
+    gathered = type(columns)()
+    for k, tensor in columns.items():
+        # bool is not supported by every backend
+        is_bool = tensor.dtype == torch.bool
+        local = tensor.to(device=device, dtype=torch.uint8 if is_bool else tensor.dtype)
+        # we pad the tensor because torch all_gather does not support
+        # gathering tensors of different shapes
+        padded = local.new_zeros((max_size,) + local.shape[1:])
+        padded[:local_size] = local
+        tensor_list = [torch.empty_like(padded) for _ in size_list]
+        dist.all_gather(tensor_list, padded)
+        merged = torch.cat([t[:size] for t, size in zip(tensor_list, size_list)])
+        gathered[k] = merged.to(device=tensor.device, dtype=tensor.dtype)
+    return gathered
+
+
 def reduce_dict(input_dict, average=True):
     """
     Args:
@@ -381,6 +420,68 @@ class NestedTensor(object):
         return str(self.tensors)
 
 
+class ShapeCache(object):
+    """
+    Bounded LRU cache for tensors that depend only on the padded batch shape and the valid size of each image
+    (position embeddings, reference points, valid ratios), so inference on recurring input sizes computes them once.
+    The cached tensors are shared between calls and must not be modified in place.
+    """
+
+    def __init__(self, max_entries=16):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, compute):
+        """Returns the value stored for key, or computes it with compute() and stores it."""
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        value = compute()
+        if self.max_entries > 0:
+            self.entries[key] = value
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def nbytes(self):
+        def size(value):
+            if isinstance(value, Tensor):
+                return value.element_size() * value.nelement()
+            if isinstance(value, (list, tuple)):
+                return sum(size(v) for v in value)
+            return 0
+        return sum(size(v) for v in self.entries.values())
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0, 'mbytes': self.nbytes() / 2 ** 20}
+
+    def clear(self):
+        """Frees the cached tensors, the hit and miss counts are kept."""
+        self.entries.clear()
+
+    def __str__(self):
+        return "{entries} entries ({mbytes:.1f} MB), {hits} hits, {misses} misses, hit rate {hit_rate:.3f}".format(
+            **self.stats())
+
+
+def mask_sizes_key(masks):
+    """
+    Hashable key of a list of padding masks [batch_size x H x W]: their device and shapes and the valid height and
+    width of every image, read with a single device sync. Like get_valid_ratio, it assumes that the valid region
+    of every image is its top-left corner, as in nested_tensor_from_tensor_list.
+    """
+    sizes = torch.cat([torch.stack([(~m[:, :, 0]).sum(1), (~m[:, 0, :]).sum(1)], -1) for m in masks])
+    return (str(masks[0].device),) + tuple(tuple(m.shape) for m in masks) + (tuple(map(tuple, sizes.tolist())),)
+
+
 def setup_for_distributed(is_master):
     """
     This function disables printing when not in master process
@@ -437,6 +538,58 @@ def save_on_master(*args, **kwargs):
         torch.save(*args, **kwargs)
 
 
+def setup_cpu_inference(num_threads=0):
+    """
+    Thread settings for CPU inference: intra-op threads on every core available to the process
+    (or num_threads if > 0) and a single inter-op thread, since the model runs its ops one after the other.
+    Returns the number of intra-op threads.
+    """
+    if num_threads <= 0:
+        num_threads = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # can only be set once, before any inter-op parallel work started
+        pass
+    return num_threads
+
+
+def quantize_dynamic_int8(model, keep_float=('sampling_offsets',)):
+    """
+    Returns a copy of model for CPU inference where every nn.Linear (transformer FFNs, MSDeformAttn projections,
+    class/box heads) has int8 weights and dynamically quantized activations, except the layers whose name contains
+    one of the keep_float keywords, e.g. 'sampling_offsets' (the sub-pixel sampling locations) or
+    'transformer.decoder.layers.5' (the features the objectness BatchNorm sees).
+    Convolutions and normalization layers, including the objectness BatchNorm, have no dynamic int8 version
+    and always stay in float.
+    """
+    model = copy.deepcopy(model)
+    # without box refine class_embed/bbox_embed repeat one head per decoder layer. quantize_dynamic only swaps the
+    # first reference of a shared module, which would leave the last layer's head, the one run in eval, in float:
+    # quantize it once and point the other references at the quantized module
+    first_name, shared = {}, []
+    for name, module in model.named_modules(remove_duplicate=False):
+        if id(module) in first_name:
+            shared.append((name, first_name[id(module)]))
+        else:
+            first_name[id(module)] = name
+    keep = {id(module) for name, module in model.named_modules(remove_duplicate=False)
+            if any(k in name for k in keep_float)}
+    layers = {name for name, module in model.named_modules()
+              # not the nn.Linear subclass MultiheadAttention keeps as out_proj, it reads the float weight directly
+              if type(module) is torch.nn.Linear and id(module) not in keep}
+    torch.ao.quantization.quantize_dynamic(model, layers, dtype=torch.qint8, inplace=True)
+    for name, source in shared:
+        parent, _, attr = name.rpartition('.')
+        setattr(model.get_submodule(parent), attr, model.get_submodule(source))
+
+    float_layers = [name for name, module in model.named_modules(remove_duplicate=False)
+                    if type(module) is torch.nn.Linear and id(module) not in keep]
+    assert not float_layers, 'nn.Linear left in float by quantize_dynamic: {}'.format(float_layers)
+    return model
+
+
 def init_distributed_mode(args):
     if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
         args.rank = int(os.environ["RANK"])
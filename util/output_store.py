@@ -0,0 +1,89 @@
+# ------------------------------------------------------------------------
+# PROB: Probabilistic Objectness for Open World Object Detection
+# Orr Zohar, Jackson Wang, Serena Yeung
+# ------------------------------------------------------------------------
+
+"""
+Memory-mapped store of raw detector outputs, so that post-processing and evaluation
+can be re-run without the model or the images.
+"""
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+# raw model outputs stored per image, as float16
+OUTPUT_FIELDS = ('pred_logits', 'pred_obj', 'pred_boxes')
+
+
+class OutputWriter:
+    """
+    Writes the raw outputs of one rank to <root>/rank<rank>/<field>.npy, one memory-mapped
+    array per field, plus orig_size.npy, image_id.npy and a meta.json with the number of images written.
+    Outputs are stored as float16: values beyond its range (e.g. very large pred_obj) saturate to inf.
+    """
+    def __init__(self, root, num_images, rank=0):
+        self.dir = os.path.join(root, 'rank{}'.format(rank))
+        self.num_images = num_images
+        self.arrays = None
+        self.count = 0
+        os.makedirs(self.dir, exist_ok=True)
+
+    def append(self, outputs, orig_sizes, image_ids):
+        batch = OrderedDict((k, outputs[k].detach().to('cpu', torch.float16).numpy()) for k in OUTPUT_FIELDS)
+        batch['orig_size'] = orig_sizes.detach().cpu().numpy().astype(np.int64)
+        batch['image_id'] = np.asarray(image_ids, dtype=np.int64)
+        if self.arrays is None:
+            self.arrays = OrderedDict(
+                (k, np.lib.format.open_memmap(os.path.join(self.dir, k + '.npy'), mode='w+', dtype=v.dtype,
+                                              shape=(self.num_images,) + v.shape[1:]))
+                for k, v in batch.items())
+        n = len(batch['image_id'])
+        if self.count + n > self.num_images:
+            raise ValueError('OutputWriter was created for {} images, got {}'.format(self.num_images, self.count + n))
+        for k, v in batch.items():
+            self.arrays[k][self.count:self.count + n] = v
+        self.count += n
+
+    def close(self):
+        if self.arrays is not None:
+            for array in self.arrays.values():
+                array.flush()
+        with open(os.path.join(self.dir, 'meta.json'), 'w') as f:
+            json.dump({'count': self.count, 'fields': list(OUTPUT_FIELDS)}, f)
+        self.arrays = None
+
+
+def read_outputs(root):
+    """
+    Returns the stored outputs of every rank as a list of OrderedDicts of read-only memory-mapped arrays.
+    """
+    shards = []
+    for name in sorted(os.listdir(root)):
+        shard_dir = os.path.join(root, name)
+        meta_path = os.path.join(shard_dir, 'meta.json')
+        if not (name.startswith('rank') and os.path.isfile(meta_path)):
+            continue
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta['count'] == 0:
+            continue
+        shards.append(OrderedDict(
+            (k, np.load(os.path.join(shard_dir, k + '.npy'), mmap_mode='r')[:meta['count']])
+            for k in tuple(meta['fields']) + ('orig_size', 'image_id')))
+    if not shards:
+        raise FileNotFoundError('no stored outputs found in {}'.format(root))
+    return shards
+
+
+def iter_output_batches(root, batch_size=64):
+    """
+    Yields (outputs, orig_sizes, image_ids) batches in the format PostProcess expects, with float32 outputs.
+    """
+    for shard in read_outputs(root):
+        for start in range(0, len(shard['image_id']), batch_size):
+            stop = start + batch_size
+            outputs = {k: torch.from_numpy(np.asarray(shard[k][start:stop], dtype=np.float32)) for k in OUTPUT_FIELDS}
+            yield outputs, torch.from_numpy(np.array(shard['orig_size'][start:stop])), shard['image_id'][start:stop].tolist()
@@ -0,0 +1,146 @@
+# ------------------------------------------------------------------------
+# PROB: Probabilistic Objectness for Open World Object Detection
+# Orr Zohar, Jackson Wang, Serena Yeung
+# ------------------------------------------------------------------------
+
+"""
+Minimal asyncio HTTP/1.1 messages and dynamic batching for the inference server (serve_model.py)
+and its load-test client (serve_client.py). Standard library only.
+"""
+import asyncio
+import json
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+# largest accepted request or response body
+MAX_BODY_BYTES = 32 * 2 ** 20
+
+STATUS_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                  413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+async def read_message(reader):
+    """
+    Reads one HTTP/1.1 request or response from an asyncio StreamReader.
+    Returns (start line fields, headers with lower-case names, body), or None if the connection was closed first.
+    """
+    start_line = await reader.readline()
+    if not start_line.strip():
+        return None
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise asyncio.IncompleteReadError(line, None)
+        if line in (b'\r\n', b'\n'):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length > MAX_BODY_BYTES:
+        raise HTTPError(413, 'body larger than {} bytes'.format(MAX_BODY_BYTES))
+    body = await reader.readexactly(length) if length else b''
+    return start_line.decode('latin-1').strip().split(None, 2), headers, body
+
+
+def encode_request(method, path, body=b'', content_type='application/octet-stream'):
+    head = '{} {} HTTP/1.1\r\nHost: localhost\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n'.format(
+        method, path, content_type, len(body))
+    return head.encode('latin-1') + body
+
+
+def encode_response(status, payload, keep_alive=True):
+    body = json.dumps(payload).encode()
+    head = 'HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+        status, STATUS_REASONS.get(status, ''), len(body), 'keep-alive' if keep_alive else 'close')
+    return head.encode('latin-1') + body
+
+
+def histogram(counter):
+    return {str(k): counter[k] for k in sorted(counter)}
+
+
+class DynamicBatcher(object):
+    """
+    Groups concurrent requests into batches for run_batch, a function of a list of inputs returning the list of their
+    results, which runs on a single worker thread so the event loop keeps accepting requests meanwhile.
+    A batch is started as soon as max_batch_size inputs are queued, or max_wait_ms after its first input arrived.
+    Inputs queued while a batch runs are grouped into the next one.
+    """
+
+    def __init__(self, run_batch, max_batch_size=4, max_wait_ms=10.0):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='batcher')
+        # size of every batch, and number of requests still queued when it started
+        self.batch_sizes = Counter()
+        self.queue_depths = Counter()
+        self.num_requests = 0
+        self.num_errors = 0
+        self.run_time = 0.0
+
+    async def submit(self, item):
+        """Queues an input and waits for its result."""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    async def next_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except asyncio.QueueEmpty:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+        return batch
+
+    async def run(self):
+        """Batching loop, to run as a task of the server's event loop."""
+        self.queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            self.batch_sizes[len(batch)] += 1
+            self.queue_depths[self.queue.qsize()] += 1
+            start_time = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(self.executor, self.run_batch, [item for item, _ in batch])
+            except Exception as e:
+                self.num_errors += len(batch)
+                results = [e] * len(batch)
+            self.run_time += time.perf_counter() - start_time
+            self.num_requests += len(batch)
+            for (_, future), result in zip(batch, results):
+                # the client may have disconnected and its handler been cancelled
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def stats(self):
+        num_batches = sum(self.batch_sizes.values())
+        return {'requests': self.num_requests, 'errors': self.num_errors, 'batches': num_batches,
+                'mean_batch_size': self.num_requests / num_batches if num_batches else 0.0,
+                'mean_batch_ms': 1000 * self.run_time / num_batches if num_batches else 0.0,
+                'queue_depth': self.queue.qsize() if self.queue is not None else 0,
+                'batch_size_histogram': histogram(self.batch_sizes),
+                'queue_depth_histogram': histogram(self.queue_depths)}